@@ -64,6 +64,13 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    # Serves collected static files: hashed names, gzip/brotli variants, long-lived Cache-Control
+    # (WhiteNoise's middleware, made async-capable so it does not serialize ASGI requests)
+    'MainApplication.middleware.WhiteNoiseMiddleware',
+    # Server-Timing, slow request/query logs and /metrics; inactive unless PERFORMANCE_METRICS
+    'MainApplication.middleware.PerformanceMiddleware',
+    # Reads of safe, non-admin requests go to the read replica; inactive unless DATABASE_REPLICA
+    'MainApplication.middleware.ReplicaMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -76,7 +83,8 @@ ROOT_URLCONF = 'AI_Model.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # DjangoTemplates that also reports render time to PerformanceMiddleware
+        'BACKEND': 'MainApplication.metrics.TimedDjangoTemplates',
         'DIRS': [],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -104,9 +112,102 @@ DATABASES = {
         'PASSWORD': os.environ.get('POSTGRES_PASSWORD', 'iranmapai'),
         'HOST': os.environ.get('POSTGRES_HOST', 'localhost'),
         'PORT': os.environ.get('POSTGRES_PORT', '5432'),
+        # Keep connections open across requests; checked before reuse so a dropped one is replaced
+        'CONN_MAX_AGE': int(os.environ.get('POSTGRES_CONN_MAX_AGE', 60)),
+        'CONN_HEALTH_CHECKS': True,
+        # Behind PgBouncer in transaction mode, server-side cursors (.iterator()) must be off
+        'DISABLE_SERVER_SIDE_CURSORS': os.environ.get('POSTGRES_TRANSACTION_POOLING', '') in ('1', 'true', 'True'),
+        'OPTIONS': {},
     }
 }
 
+# Connection pool (psycopg 3 only, Django's built-in pool): replaces persistent connections
+if os.environ.get('POSTGRES_POOL', '') in ('1', 'true', 'True'):
+    DATABASES['default']['CONN_MAX_AGE'] = 0
+    DATABASES['default']['OPTIONS']['pool'] = {
+        'min_size': int(os.environ.get('POSTGRES_POOL_MIN_SIZE', 2)),
+        'max_size': int(os.environ.get('POSTGRES_POOL_MAX_SIZE', 10)),
+        'timeout': int(os.environ.get('POSTGRES_POOL_TIMEOUT', 10)),
+    }
+
+# Read replica
+# With POSTGRES_REPLICA_HOST set, reads of the map, city pages, API and exports go to the
+# "replica" alias (MainApplication/routers.py); writes, admin, sessions and users use the
+# primary. After a write, that client, and after any scores change everyone, stays on the
+# primary for DATABASE_REPLICA_STICKY_SECONDS, which should exceed the replication lag.
+
+DATABASE_ROUTERS = ['MainApplication.routers.ReplicaRouter']
+DATABASE_REPLICA = None
+DATABASE_REPLICA_STICKY_SECONDS = int(os.environ.get('DATABASE_REPLICA_STICKY_SECONDS', 5))
+
+if os.environ.get('POSTGRES_REPLICA_HOST'):
+    DATABASES['replica'] = {
+        **DATABASES['default'],
+        'HOST': os.environ['POSTGRES_REPLICA_HOST'],
+        'PORT': os.environ.get('POSTGRES_REPLICA_PORT', DATABASES['default']['PORT']),
+        'OPTIONS': {**DATABASES['default']['OPTIONS']},
+        # Tests run against the primary's test database
+        'TEST': {'MIRROR': 'default'},
+    }
+    DATABASE_REPLICA = 'replica'
+
+
+# Cache
+# Rendered map/detail pages are cached per scores version (MainApplication/caching.py).
+# Use a shared backend (Redis, Memcached or file) when running more than one worker.
+
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('CACHE_LOCATION', 'iranmapai'),
+    }
+}
+
+SCORES_CACHE_TIMEOUT = 60 * 60 * 24
+# Distinct ad-hoc ?weights= strings whose /api/v1/scores/ response is cached per scores version
+SCORES_WEIGHTS_CACHE_LIMIT = int(os.environ.get('SCORES_WEIGHTS_CACHE_LIMIT', 1000))
+
+
+# Chatbot gateway
+# /api/v1/chat/ relays the chatbot to the Persian Assistant API (MainApplication/chatbot.py).
+# CHATBOT_UPSTREAM is the client class; point it at a stub for tests or offline development.
+
+CHATBOT_API_BASE = os.environ.get('CHATBOT_API_BASE', 'http://localhost:8000')
+CHATBOT_UPSTREAM = os.environ.get('CHATBOT_UPSTREAM', 'MainApplication.chatbot.HttpxUpstream')
+CHATBOT_TIMEOUT = 60
+CHATBOT_CACHE_SIZE = 256
+CHATBOT_CACHE_TTL = 60 * 10
+# Upper bound for max_tokens in chat requests; larger requests are cut down to it
+CHATBOT_MAX_TOKENS = int(os.environ.get('CHATBOT_MAX_TOKENS', 5000))
+# Largest voice recording relayed to the assistant; larger uploads get 413
+CHATBOT_MAX_AUDIO_BYTES = int(os.environ.get('CHATBOT_MAX_AUDIO_BYTES', 10 * 1024 * 1024))
+
+
+# Performance instrumentation
+# PerformanceMiddleware adds Server-Timing headers, logs slow requests/queries to the
+# "MainApplication.performance" logger and aggregates per-view histograms served at /metrics.
+# /metrics needs "Authorization: Bearer <PERFORMANCE_METRICS_TOKEN>"; without a token only staff users may read it.
+
+PERFORMANCE_METRICS = os.environ.get('PERFORMANCE_METRICS', '') in ('1', 'true', 'True')
+PERFORMANCE_SLOW_REQUEST_MS = int(os.environ.get('PERFORMANCE_SLOW_REQUEST_MS', 500))
+PERFORMANCE_SLOW_QUERY_MS = int(os.environ.get('PERFORMANCE_SLOW_QUERY_MS', 100))
+PERFORMANCE_METRICS_TOKEN = os.environ.get('PERFORMANCE_METRICS_TOKEN', '')
+
+
+# Async pages
+# Serve the map and city pages with async views and the async ORM (MainApplication/urls.py).
+# Enable under an ASGI server (uvicorn AI_Model.asgi:application); under WSGI every async
+# view would run in its own event loop and only add overhead.
+
+ASYNC_VIEWS = os.environ.get('ASYNC_VIEWS', '') in ('1', 'true', 'True')
+
+
+# Map level of detail
+# The map outlines are simplified ahead of time (manage.py build_map_lods, MainApplication/geometry.py).
+# MAP_LOD is the level the map page inlines unless ?lod= asks for another: high, medium,
+# low, or full for the original paths. /map.svg serves the same levels as a standalone file.
+
+MAP_LOD = os.environ.get('MAP_LOD', 'medium')
 
 
 # Password validation
@@ -144,6 +245,14 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/5.1/howto/static-files/
 
 STATIC_URL = 'static/'
+STATIC_ROOT = BASE_DIR / 'staticfiles'
+
+# collectstatic writes content-hashed copies plus .gz/.br variants; hashed files are
+# served by WhiteNoise with a one-year immutable Cache-Control
+STORAGES = {
+    'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+    'staticfiles': {'BACKEND': 'MainApplication.storage.StaticStorage'},
+}
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
@@ -6,3 +6,17 @@ DATABASES = {
         "NAME": BASE_DIR / "db.sqlite3",  # noqa: F405
     }
 }
+
+# Local development and tests run without collectstatic: no manifest, and
+# WhiteNoise serves files straight from the apps' static/ directories
+STORAGES = {
+    **STORAGES,  # noqa: F405
+    "staticfiles": {"BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"},
+}
+STATIC_ROOT = None
+WHITENOISE_USE_FINDERS = True
+
+# A second alias on the same file stands in for a read replica. Routing is only active
+# when DATABASE_REPLICA names it; the tests switch it on and get a separate test
+# database for it, so they can tell which side a read went to.
+DATABASES["replica"] = {**DATABASES["default"]}
@@ -0,0 +1,50 @@
+# Generated by Django 5.2.9 on 2026-10-18 13:02
+
+import django.contrib.auth.models
+import django.contrib.auth.validators
+import django.utils.timezone
+import django_jalali.db.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='User',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('password', models.CharField(max_length=128, verbose_name='password')),
+                ('last_login', models.DateTimeField(blank=True, null=True, verbose_name='last login')),
+                ('username', models.CharField(error_messages={'unique': 'A user with that username already exists.'}, help_text='Required. 150 characters or fewer. Letters, digits and @/./+/-/_ only.', max_length=150, unique=True, validators=[django.contrib.auth.validators.UnicodeUsernameValidator()], verbose_name='username')),
+                ('first_name', models.CharField(max_length=150, verbose_name='first name')),
+                ('last_name', models.CharField(max_length=150, verbose_name='last name')),
+                ('profile', models.ImageField(blank=True, default='', help_text='لطفا سایز عکس ۱*۱ باشد تا دیزاین سایت زیباتر باشد و دقت کنید پسوند فایل موردنظر نیز jpeg یا jpg یا png باشد', null=True, upload_to='profile_image/', verbose_name='تصویر پروفایل')),
+                ('nationality_id', models.CharField(blank=True, max_length=10, null=True, unique=True, verbose_name='کد ملی')),
+                ('phone_number', models.CharField(blank=True, max_length=11, null=True, unique=True, verbose_name='شماره تلفن')),
+                ('date_of_birth', django_jalali.db.models.jDateField(blank=True, null=True, verbose_name='تاریخ تولد')),
+                ('email', models.EmailField(blank=True, max_length=254, null=True, verbose_name='email address')),
+                ('is_active', models.BooleanField(default=True, help_text='بجای حذف کاربر کافی است تیک این فیلد را بردارید تا این کاربر دیگر هیچ نوع دسترسی ای به وب اپلیکیشن نداشته باشد .', verbose_name='فعال')),
+                ('is_staff', models.BooleanField(default=True, help_text='این فیلد نشان می\u200cدهد که آیا کاربر باید به عنوان کارمند فعالیت کند (اخطار : به کاربران کیوسک و اسکنر این دسترسی را ندهید)', verbose_name='کارمند')),
+                ('is_superuser', models.BooleanField(default=False, help_text='این فیلد نشان می\u200cدهد که آیا کاربر دسترسی کامل به تمامی بخش هارا دارد یا خیر. (اخطار : به کاربران کیوسک و اسکنر این دسترسی را ندهید)', verbose_name='ادمین')),
+                ('date_joined', models.DateTimeField(default=django.utils.timezone.now, verbose_name='date joined')),
+                ('update', models.DateTimeField(auto_now=True, verbose_name='زمان ویرایش')),
+                ('groups', models.ManyToManyField(blank=True, help_text='The groups this user belongs to. A user will get all permissions granted to each of their groups.', related_name='user_set', related_query_name='user', to='auth.group', verbose_name='groups')),
+                ('user_permissions', models.ManyToManyField(blank=True, help_text='Specific permissions for this user.', related_name='custom_user_permissions', related_query_name='user', to='auth.permission', verbose_name='user permissions')),
+            ],
+            options={
+                'verbose_name': 'user',
+                'verbose_name_plural': 'users',
+                'ordering': ('-update',),
+            },
+            managers=[
+                ('objects', django.contrib.auth.models.UserManager()),
+            ],
+        ),
+    ]
@@ -1,6 +1,64 @@
 # myapp/admin.py
+from django import forms
 from django.contrib import admin
-from .models import City, FieldType, CityFieldScore, get_city_average_score
+from django.contrib.admin.widgets import AutocompleteSelect
+from django.db.models import F
+from .models import (
+    City,
+    FieldType,
+    CityFieldScore,
+    CityFieldScoreHistory,
+    IngestedFile,
+    ScoringProfile,
+    ScoringProfileWeight,
+)
+from .paginators import EstimatedCountPaginator
+
+
+# Sidebar filter that picks the related object with the admin's select2 autocomplete
+# instead of listing every city/field (which loads the whole table on each changelist)
+class AutocompleteFilter(admin.FieldListFilter):
+    template = "admin/MainApplication/autocomplete_filter.html"
+
+    def __init__(self, field, request, params, model, model_admin, field_path):
+        self.lookup_kwarg = f"{field_path}__{field.target_field.attname}__exact"
+        super().__init__(field, request, params, model, model_admin, field_path)
+        value = self.used_parameters.get(self.lookup_kwarg)
+        self.lookup_val = value[-1] if isinstance(value, list) else value
+        self.admin_site = model_admin.admin_site
+
+    def expected_parameters(self):
+        return [self.lookup_kwarg]
+
+    def has_output(self):
+        return True
+
+    def widget_html(self):
+        # Only the selected object is loaded; the rest come from the autocomplete view as the user types
+        form_field = forms.ModelChoiceField(
+            queryset=self.field.remote_field.model._default_manager.all(),
+            widget=AutocompleteSelect(self.field, self.admin_site),
+            required=False,
+        )
+        return form_field.widget.render(self.lookup_kwarg, self.lookup_val, attrs={"id": f"id_{self.lookup_kwarg}"})
+
+    def choices(self, changelist):
+        yield {
+            "selected": self.lookup_val is None,
+            "query_string": changelist.get_query_string(remove=[self.lookup_kwarg]),
+            "display": "همه",
+        }
+
+
+class AutocompleteFilterMediaMixin:
+    # select2 assets for the AutocompleteFilter widgets in the changelist sidebar
+    @property
+    def media(self):
+        media = super().media
+        for name in self.autocomplete_filter_fields:
+            media += AutocompleteSelect(self.model._meta.get_field(name), self.admin_site).media
+        return media
+
 
 # Inline admin to show/edit scores directly in the city page
 class CityFieldScoreInline(admin.TabularInline):
@@ -9,19 +67,34 @@ class CityFieldScoreInline(admin.TabularInline):
     min_num = 1
     verbose_name = "امتیاز فیلد"
     verbose_name_plural = "امتیازات فیلدها"
+    # One select2 per row instead of rendering every FieldType into every row
+    autocomplete_fields = ('field',)
 
 
 @admin.register(City)
 class CityAdmin(admin.ModelAdmin):
-    list_display = ('name', 'population', 'city_type', 'is_capital', 'average_score')
-    list_filter = ('city_type',)
-    search_fields = ('name',)
+    list_display = ('name', 'parent', 'slug', 'population', 'city_type', 'is_capital', 'average_score', 'rollup_score')
+    list_filter = ('city_type', 'depth')
+    search_fields = ('name', 'slug')
+    list_select_related = ('summary', 'parent')
+    # Tens of thousands of counties and cities: pick the parent with select2
+    autocomplete_fields = ('parent',)
     inlines = [CityFieldScoreInline]
 
-    # Show average score for the city in the admin list
+    def get_queryset(self, request):
+        # Averages come from CityScoreSummary in the same query, so they can also be sorted on
+        return super().get_queryset(request).annotate(
+            average=F('summary__avg_score'), rollup=F('summary__rollup_avg')
+        )
+
+    # Show average score for the city in the admin list (read from CityScoreSummary)
+    @admin.display(description="میانگین امتیاز", ordering='average')
     def average_score(self, obj):
-        return round(get_city_average_score(obj.id), 2)
-    average_score.short_description = "میانگین امتیاز"
+        return round(obj.average, 2) if obj.average is not None else 0
+
+    @admin.display(description="میانگین با زیرمجموعه ها", ordering='rollup')
+    def rollup_score(self, obj):
+        return round(obj.rollup, 2) if obj.rollup is not None else 0
 
 
 @admin.register(FieldType)
@@ -31,7 +104,59 @@ class FieldTypeAdmin(admin.ModelAdmin):
 
 
 @admin.register(CityFieldScore)
-class CityFieldScoreAdmin(admin.ModelAdmin):
+class CityFieldScoreAdmin(AutocompleteFilterMediaMixin, admin.ModelAdmin):
     list_display = ('city', 'field', 'score')
-    list_filter = ('field', 'city')
+    list_filter = (('field', AutocompleteFilter), ('city', AutocompleteFilter))
+    autocomplete_filter_fields = ('field', 'city')
+    list_select_related = ('city', 'field')
+    autocomplete_fields = ('city', 'field')
     search_fields = ('city__name', 'field__name')
+    # Millions of rows: no COUNT(*) of the whole table per page view
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+
+# History is written by signals and importers; the admin only browses it
+@admin.register(CityFieldScoreHistory)
+class CityFieldScoreHistoryAdmin(AutocompleteFilterMediaMixin, admin.ModelAdmin):
+    list_display = ('city', 'field', 'score', 'effective_at')
+    list_filter = (('field', AutocompleteFilter), ('city', AutocompleteFilter))
+    autocomplete_filter_fields = ('field', 'city')
+    list_select_related = ('city', 'field')
+    search_fields = ('city__name', 'field__name')
+    date_hierarchy = 'effective_at'
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+# The ingest_scores manifest; deleting a row makes the next run ingest that file again
+@admin.register(IngestedFile)
+class IngestedFileAdmin(admin.ModelAdmin):
+    list_display = ('path', 'cells', 'effective_at', 'ingested_at')
+    search_fields = ('path', 'sha256')
+    date_hierarchy = 'ingested_at'
+    readonly_fields = ('sha256', 'path', 'size', 'cells', 'effective_at', 'ingested_at')
+
+    def has_add_permission(self, request):
+        return False
+
+
+class ScoringProfileWeightInline(admin.TabularInline):
+    model = ScoringProfileWeight
+    extra = 1
+    verbose_name = "وزن فیلد"
+    verbose_name_plural = "وزن فیلدها (فیلدهای بدون وزن یک بار و با جهت «بیشتر بهتر است» حساب می شوند)"
+    autocomplete_fields = ('field',)
+
+
+@admin.register(ScoringProfile)
+class ScoringProfileAdmin(admin.ModelAdmin):
+    list_display = ('name', 'slug')
+    search_fields = ('name', 'slug')
+    inlines = [ScoringProfileWeightInline]
@@ -0,0 +1,159 @@
+import numpy as np
+
+# City similarity, field correlations and k-means clusters over the ScoreMatrix
+# (MainApplication/scoring.py). Everything is NumPy on the dense matrix, and
+# anything reused across requests is memoized on the matrix itself, so it is
+# computed once per scores version.
+
+SIMILARITY_METRICS = ("cosine", "euclidean")
+MIN_CORRELATION_CITIES = 3
+KMEANS_MAX_ITERATIONS = 100
+KMEANS_SEED = 0
+CLUSTER_FIELDS = 3  # strongest/weakest fields named per cluster
+
+
+def field_means(matrix):
+    """Mean score of every field over the cities that have one (0 for unscored fields)."""
+    def compute():
+        counts = matrix.present.sum(axis=0)
+        sums = matrix.values.sum(axis=0)
+        return np.divide(sums, counts, out=np.zeros_like(sums), where=counts > 0)
+
+    return matrix.memoized("field_means", compute)
+
+
+def imputed_values(matrix):
+    """Scores with each missing one replaced by its field's mean, so every city is a full vector."""
+    return matrix.memoized(
+        "imputed_values", lambda: np.where(matrix.present > 0, matrix.values, field_means(matrix))
+    )
+
+
+def _unit_vectors(matrix):
+    def compute():
+        centered = imputed_values(matrix) - field_means(matrix)
+        norms = np.linalg.norm(centered, axis=1, keepdims=True)
+        return np.divide(centered, norms, out=np.zeros_like(centered), where=norms > 0)
+
+    return matrix.memoized("unit_vectors", compute)
+
+
+def _standardized_values(matrix):
+    def compute():
+        values = imputed_values(matrix)
+        deviations = values.std(axis=0)
+        return (values - field_means(matrix)) / np.where(deviations > 0, deviations, 1)
+
+    return matrix.memoized("standardized_values", compute)
+
+
+def similar_cities(matrix, slug, limit=5, metric="cosine"):
+    """
+    The ``limit`` cities closest to ``slug`` as ``[(slug, name, value), ...]``.
+
+    ``cosine`` compares the score vectors centered on the field means (value:
+    similarity, higher is closer); ``euclidean`` is the plain distance between
+    score vectors (lower is closer). Missing scores count as the field mean.
+    Raises KeyError for a city that is not on the map.
+    """
+    index = matrix.slug_index[slug]
+    if metric == "cosine":
+        vectors = _unit_vectors(matrix)
+        values = vectors @ vectors[index]
+        order = np.argsort(-values, kind="stable")
+    else:
+        vectors = imputed_values(matrix)
+        values = np.linalg.norm(vectors - vectors[index], axis=1)
+        order = np.argsort(values, kind="stable")
+    order = order[order != index][:limit]
+    return [(matrix.slugs[i], matrix.names[i], float(values[i])) for i in order.tolist()]
+
+
+def field_correlations(matrix):
+    """
+    Pearson correlation of every pair of fields over the cities scored in both,
+    as a ``fields x fields`` array. NaN where fewer than MIN_CORRELATION_CITIES
+    cities share the pair or a field does not vary among them.
+    """
+    def compute():
+        values, present = matrix.values, matrix.present
+        # Pairwise-complete sums for all pairs at once; entry [i, j] only covers
+        # cities scored in both fields because missing scores are 0 in ``values``
+        shared = present.T @ present
+        sums = values.T @ present
+        squares = (values**2).T @ present
+        products = values.T @ values
+        with np.errstate(divide="ignore", invalid="ignore"):
+            covariance = products - sums * sums.T / shared
+            variance = squares - sums**2 / shared
+            correlation = covariance / np.sqrt(variance * variance.T)
+        undefined = (shared < MIN_CORRELATION_CITIES) | (variance <= 1e-9) | (variance.T <= 1e-9)
+        correlation[undefined] = np.nan
+        return np.clip(correlation, -1, 1)
+
+    return matrix.memoized("field_correlations", compute)
+
+
+def kmeans(points, k, max_iterations=KMEANS_MAX_ITERATIONS, seed=KMEANS_SEED):
+    """
+    Lloyd's k-means with k-means++ seeding; returns ``(labels, centroids)``.
+
+    The seed is fixed, so the same points always give the same clusters. A
+    cluster that loses all its points keeps its previous centroid.
+    """
+    count = len(points)
+    k = min(k, count)
+    if k == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros((0, points.shape[1]))
+    rng = np.random.default_rng(seed)
+
+    # k-means++: every next center is drawn proportionally to the squared distance to the closest one so far
+    centers = [int(rng.integers(count))]
+    closest = ((points - points[centers[0]]) ** 2).sum(axis=1)
+    for _ in range(1, k):
+        total = closest.sum()
+        center = int(rng.choice(count, p=closest / total)) if total > 0 else int(rng.integers(count))
+        centers.append(center)
+        closest = np.minimum(closest, ((points - points[center]) ** 2).sum(axis=1))
+    centroids = points[centers].copy()
+
+    point_norms = (points**2).sum(axis=1)[:, None]
+    labels = None
+    for _ in range(max_iterations):
+        # |p - c|^2 = |p|^2 - 2 p.c + |c|^2: one matrix product per iteration
+        distances = point_norms - 2 * points @ centroids.T + (centroids**2).sum(axis=1)
+        new_labels = distances.argmin(axis=1)
+        if labels is not None and np.array_equal(labels, new_labels):
+            break
+        labels = new_labels
+        members = np.zeros((count, k))
+        members[np.arange(count), labels] = 1
+        sizes = members.sum(axis=0)
+        filled = sizes > 0
+        centroids[filled] = (members.T @ points)[filled] / sizes[filled, None]
+    return labels, centroids
+
+
+def city_clusters(matrix, k):
+    """
+    ``k`` k-means clusters of the map cities over z-scored scores, largest first,
+    as ``[(slugs, mean average, strongest field names, weakest field names), ...]``.
+    """
+    def compute():
+        labels, centroids = kmeans(_standardized_values(matrix), k)
+        averages = matrix.averages()
+        clusters = []
+        for label in np.argsort(-np.bincount(labels, minlength=len(centroids)), kind="stable").tolist():
+            members = np.flatnonzero(labels == label)
+            if not len(members):
+                continue
+            ranked = np.argsort(-centroids[label], kind="stable").tolist()
+            clusters.append((
+                [matrix.slugs[i] for i in members.tolist()],
+                round(float(averages[members].mean()), 2),
+                [matrix.field_names[i] for i in ranked[:CLUSTER_FIELDS]],
+                [matrix.field_names[i] for i in ranked[::-1][:CLUSTER_FIELDS]],
+            ))
+        return clusters
+
+    return matrix.memoized(("city_clusters", k), compute)
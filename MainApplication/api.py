@@ -0,0 +1,390 @@
+import json
+import logging
+import math
+import tempfile
+
+import numpy as np
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import BadRequest
+from django.core.handlers.asgi import ASGIRequest
+from django.http import FileResponse, Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.views.decorators.http import require_POST
+
+from . import analytics, chatbot, exporters
+from .caching import admit_cache_variant, cache_by_scores_version, get_scores_version
+from .metrics import record_cache_lookup
+from .models import City, get_color_for_score, get_field_rankings, get_subtree
+from .scoring import get_score_matrix, parse_weights
+from .views import get_as_of, get_city_field_data, get_map_data
+
+# Read-only JSON endpoints for the map and dashboards. Payloads use short keys
+# and no whitespace so the whole map fits in a few KB:
+#   map:  {"v": version, "c": [{"s": slug, "n": name, "a": average, "c": color}, ...]}
+#   city: {"v": version, "s": slug, "n": name, "a": average, "f": [[field, score], ...]}
+#   city context: {"v": version, "s": slug, "t": assistant summary text}
+#   rankings: {"v": version, "f": [{"i": field id, "n": field, "r": [[position, slug, name, score], ...]}, ...]}
+#   profiles: {"v": version, "p": [{"s": slug, "n": name, "w": [[field id, weight, lower is better 0/1], ...]}, ...]}
+#   scores: {"v": version, "p": profile slug or null, "c": [[slug, weighted average, color], ...]}
+#   similar: {"v": version, "s": slug, "m": metric, "r": [[slug, name, similarity or distance], ...]}
+#   correlations: {"v": version, "f": [[field id, field], ...], "r": [[correlation or null, ...], ...]}
+#   units: {"v": version, "u": [[id, parent id, depth, name, own average, roll-up average, roll-up color], ...]}
+#   clusters: {"v": version, "k": k, "c": [{"s": [slug, ...], "a": average, "t": [strongest field, ...], "b": [weakest field, ...]}, ...]}
+# map and city accept ?as_of=YYYY-MM-DD (or an ISO datetime) and then also carry "t": the resolved time.
+# The score exports (export/scores.csv, export/scores.xlsx) are files in the import_scores layout instead.
+
+API_MAX_AGE = 60
+MAX_RANKING_SIZE = 100
+MAX_SIMILAR_CITIES = 50
+MAX_CLUSTERS = 20
+XLSX_CONTENT_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+CHAT_TEMPERATURE_RANGE = (0.0, 2.0)
+
+logger = logging.getLogger(__name__)
+
+
+def compact_json_response(data):
+    return JsonResponse(data, json_dumps_params={"ensure_ascii": False, "separators": (",", ":")})
+
+
+@cache_by_scores_version(query_params=("as_of",), per_user=False, max_age=API_MAX_AGE)
+def map_data(request):
+    as_of = get_as_of(request)
+    cities = [
+        {"s": item["slug"], "n": item["name"], "a": item["avg"], "c": item["color"]}
+        for item in get_map_data(as_of)
+    ]
+    payload = {"v": get_scores_version(), "c": cities}
+    if as_of is not None:
+        payload["t"] = as_of.isoformat()
+    return compact_json_response(payload)
+
+
+@cache_by_scores_version(query_params=("as_of",), per_user=False, max_age=API_MAX_AGE)
+def city_data(request, slug: str):
+    as_of = get_as_of(request)
+    city, _, field_data = get_city_field_data(slug, as_of)
+    if as_of is not None:
+        # Scores are 1..100, so 0 marks a field the city had no score for at that time
+        scores = [item["score"] for item in field_data if item["score"]]
+        avg = sum(scores) / len(scores) if scores else 0
+    else:
+        summary = getattr(city, "summary", None)
+        avg = summary.avg_score if summary else 0
+    payload = {
+        "v": get_scores_version(),
+        "s": slug,
+        "n": city.name,
+        "a": round(avg, 2),
+        "f": [[item["name"], item["score"]] for item in field_data],
+    }
+    if as_of is not None:
+        payload["t"] = as_of.isoformat()
+    return compact_json_response(payload)
+
+
+@cache_by_scores_version(per_user=False, max_age=API_MAX_AGE)
+def city_context(request, slug: str):
+    """The assistant's summary of a city (average, rank, strongest and weakest fields) as plain text."""
+    text = chatbot.get_city_context(slug)
+    if not text:
+        raise Http404("City not found")
+    return compact_json_response({"v": get_scores_version(), "s": slug, "t": text})
+
+
+def _int_param(request, name, default, maximum):
+    try:
+        value = int(request.GET.get(name, default))
+    except ValueError:
+        value = default
+    return min(max(value, 1), maximum)
+
+
+@cache_by_scores_version(query_params=("n", "order", "field"), per_user=False, max_age=API_MAX_AGE)
+def field_rankings(request):
+    """Top (``?order=top``, default) or bottom ``?n=`` cities per field; ``?field=<id>`` narrows it down."""
+    limit = _int_param(request, "n", 10, MAX_RANKING_SIZE)
+    field_ids = [int(value) for value in request.GET.getlist("field") if value.isdigit()] or None
+    rows = get_field_rankings(limit, bottom=request.GET.get("order") == "bottom", field_ids=field_ids)
+
+    fields = []
+    for row in rows:
+        if not fields or fields[-1]["i"] != row["field_id"]:
+            fields.append({"i": row["field_id"], "n": row["field__name"], "r": []})
+        fields[-1]["r"].append([
+            row["position"],
+            row["city__slug"],
+            row["city__name"],
+            row["score"],
+        ])
+    return compact_json_response({"v": get_scores_version(), "f": fields})
+
+
+@cache_by_scores_version(per_user=False, max_age=API_MAX_AGE)
+def scoring_profiles(request):
+    profiles = [
+        {
+            "s": slug,
+            "n": name,
+            "w": [[field_id, weight, int(lower)] for field_id, (weight, lower) in sorted(weights.items())],
+        }
+        for slug, (name, weights) in sorted(get_score_matrix().profiles.items())
+    ]
+    return compact_json_response({"v": get_scores_version(), "p": profiles})
+
+
+@cache_by_scores_version(query_params=("profile", "weights"), per_user=False, max_age=API_MAX_AGE)
+def weighted_scores(request):
+    """
+    Map averages and colors under ``?profile=<slug>`` and/or ad-hoc
+    ``?weights=12:2,15:-1`` (field id: weight, negative = lower is better,
+    overriding the profile); computed from the in-memory ScoreMatrix.
+    """
+    matrix = get_score_matrix()
+    slug = request.GET.get("profile") or None
+    weights = {}
+    if slug is not None:
+        if slug not in matrix.profiles:
+            raise Http404("Scoring profile not found")
+        weights.update(matrix.profiles[slug][1])
+    try:
+        weights.update(parse_weights(request.GET.get("weights", "")))
+    except ValueError as exc:
+        raise BadRequest(str(exc))
+    cities = [[city_slug, avg, color] for city_slug, _, avg, color in matrix.colored_scores(weights)]
+    response = compact_json_response({"v": get_scores_version(), "p": slug, "c": cities})
+    if request.GET.get("weights") and not admit_cache_variant("weighted_scores", settings.SCORES_WEIGHTS_CACHE_LIMIT):
+        # Past the limit, further weight strings are computed on every request
+        response.skip_scores_cache = True
+    return response
+
+
+def _subtree_response(request, city):
+    depth = request.GET.get("depth", "")
+    units = []
+    for unit in get_subtree(city, int(depth) if depth.isdigit() else None):
+        summary = getattr(unit, "summary", None)
+        units.append([
+            unit.id,
+            unit.parent_id,
+            unit.depth,
+            unit.name,
+            round(summary.avg_score, 2) if summary else 0,
+            round(summary.rollup_avg, 2) if summary else 0,
+            summary.rollup_color if summary else get_color_for_score(0),
+        ])
+    return compact_json_response({"v": get_scores_version(), "u": units})
+
+
+@cache_by_scores_version(query_params=("depth",), per_user=False, max_age=API_MAX_AGE)
+def city_units(request, slug: str):
+    """A map city and its sub-units depth-first (parents before children), ``?depth=`` levels down."""
+    return _subtree_response(request, get_object_or_404(City.objects.only("path", "depth"), slug=slug))
+
+
+@cache_by_scores_version(query_params=("depth",), per_user=False, max_age=API_MAX_AGE)
+def unit_subtree(request, pk: int):
+    """The same drill-down from any unit, including ones below the map level (no slug)."""
+    return _subtree_response(request, get_object_or_404(City.objects.only("path", "depth"), pk=pk))
+
+
+@cache_by_scores_version(query_params=("metric", "n"), per_user=False, max_age=API_MAX_AGE)
+def similar_cities(request, slug: str):
+    """The ``?n=`` cities most like ``slug`` by ``?metric=cosine`` (default) or ``euclidean``."""
+    metric = request.GET.get("metric", "cosine")
+    if metric not in analytics.SIMILARITY_METRICS:
+        raise BadRequest(f"Unknown metric {metric!r}")
+    limit = _int_param(request, "n", 5, MAX_SIMILAR_CITIES)
+    try:
+        rows = analytics.similar_cities(get_score_matrix(), slug, limit, metric)
+    except KeyError:
+        raise Http404("City not found")
+    similar = [[city_slug, name, round(value, 4)] for city_slug, name, value in rows]
+    return compact_json_response({"v": get_scores_version(), "s": slug, "m": metric, "r": similar})
+
+
+@cache_by_scores_version(per_user=False, max_age=API_MAX_AGE)
+def field_correlations(request):
+    matrix = get_score_matrix()
+    rows = np.round(analytics.field_correlations(matrix), 3).tolist()
+    payload = {
+        "v": get_scores_version(),
+        "f": [list(field) for field in zip(matrix.field_ids, matrix.field_names)],
+        # NaN (undefined) is not valid JSON
+        "r": [[None if value != value else value for value in row] for row in rows],
+    }
+    return compact_json_response(payload)
+
+
+@cache_by_scores_version(query_params=("k",), per_user=False, max_age=API_MAX_AGE)
+def city_clusters(request):
+    """k-means clusters of the map cities, ``?k=`` (default 4) of them."""
+    k = _int_param(request, "k", 4, MAX_CLUSTERS)
+    clusters = [
+        {"s": slugs, "a": avg, "t": strongest, "b": weakest}
+        for slugs, avg, strongest, weakest in analytics.city_clusters(get_score_matrix(), k)
+    ]
+    return compact_json_response({"v": get_scores_version(), "k": k, "c": clusters})
+
+
+def export_scores(request, export_format: str):
+    """
+    Download the cities x fields score matrix as ``scores.csv`` or ``scores.xlsx``
+    (MainApplication/exporters.py), optionally ``?as_of=`` and ``?type=county`` etc.
+
+    CSV is streamed while the scores are read; the workbook is spooled to a
+    temporary file first, since an XLSX file is a zip archive written at the end.
+    """
+    if export_format not in exporters.EXPORT_FORMATS:
+        raise Http404("Unknown export format")
+    as_of = get_as_of(request)
+    city_type = None
+    if request.GET.get("type"):
+        try:
+            city_type = exporters.parse_city_type(request.GET["type"])
+        except ValueError as exc:
+            raise BadRequest(str(exc))
+    try:
+        rows = exporters.iter_export_rows(as_of, city_type)
+    except ValueError as exc:
+        raise BadRequest(str(exc))
+    filename = f"scores-{as_of.date().isoformat()}.{export_format}" if as_of else f"scores.{export_format}"
+
+    if export_format == "csv":
+        response = StreamingHttpResponse(exporters.iter_csv(rows), content_type="text/csv; charset=utf-8")
+        response["Content-Disposition"] = f'attachment; filename="{filename}"'
+        return response
+    spool = tempfile.TemporaryFile()
+    exporters.write_xlsx(rows, spool)
+    spool.seek(0)
+    return FileResponse(spool, as_attachment=True, filename=filename, content_type=XLSX_CONTENT_TYPE)
+
+
+def _chat_error(message, status):
+    return JsonResponse({"message": message}, status=status, json_dumps_params={"ensure_ascii": False})
+
+
+def parse_chat_options(body):
+    """
+    ``(temperature, max_tokens)`` of a chat request. Raises ValueError unless
+    the temperature is a number in CHAT_TEMPERATURE_RANGE and max_tokens a
+    positive integer; max_tokens above settings.CHATBOT_MAX_TOKENS is cut down to it.
+    """
+    limit = settings.CHATBOT_MAX_TOKENS
+    temperature, max_tokens = body.get("temperature", 0.7), body.get("max_tokens", limit)
+    if isinstance(temperature, bool) or isinstance(max_tokens, bool):
+        raise ValueError("Invalid chat options")
+    temperature, max_tokens = float(temperature), float(max_tokens)
+    low, high = CHAT_TEMPERATURE_RANGE
+    # NaN fails both comparisons
+    if not low <= temperature <= high:
+        raise ValueError(f"temperature must be between {low:g} and {high:g}")
+    if not (math.isfinite(max_tokens) and max_tokens.is_integer() and max_tokens >= 1):
+        raise ValueError("max_tokens must be a positive integer")
+    return temperature, min(int(max_tokens), limit)
+
+
+# The chat endpoints spend the assistant's quota, so they take CSRF-protected POSTs from our pages only;
+# script_ChatBot.js sends the csrftoken cookie that the pages set
+@require_POST
+async def chat_text(request):
+    """
+    Relay a chatbot question to the assistant and stream the answer back as text.
+
+    The browser sends the bare ``query``, the active ``city`` slug and recent
+    ``history``; the city context is built here from the database. Finished
+    answers are kept in an LRU/TTL cache keyed on the normalized question,
+    history, city context version and temperature (``X-Chat-Cache: hit``).
+    """
+    try:
+        body = json.loads(request.body or b"{}")
+        query = str(body.get("query", "")).strip()
+    except (ValueError, TypeError, AttributeError):
+        return _chat_error("Invalid request body", 400)
+    try:
+        temperature, max_tokens = parse_chat_options(body)
+    except (ValueError, TypeError) as exc:
+        return _chat_error(str(exc), 400)
+    if not query:
+        return _chat_error("Empty query", 400)
+    history = body.get("history") if isinstance(body.get("history"), list) else []
+
+    prompt, cache_key = await sync_to_async(chatbot.prepare_chat)(query, history, body.get("city"), temperature)
+    answer = chatbot.answer_cache.get(cache_key)
+    record_cache_lookup(answer is not None)
+    if answer is not None:
+        response = HttpResponse(answer, content_type="text/plain; charset=utf-8")
+        response["X-Chat-Cache"] = "hit"
+        return response
+
+    payload = {"query": prompt, "temperature": temperature, "max_tokens": max_tokens}
+    if not isinstance(request, ASGIRequest):
+        # Under WSGI Django reads an async stream to the end before sending any of it, and this
+        # view's event loop ends with the request: read the answer here, over a client closed after
+        try:
+            async with chatbot.upstream_scope(request):
+                answer = "".join([chunk async for chunk in chatbot.get_upstream().stream_text(payload)])
+        except chatbot.UpstreamError as exc:
+            return _chat_error(str(exc), exc.status)
+        chatbot.answer_cache.set(cache_key, answer)
+        response = HttpResponse(answer, content_type="text/plain; charset=utf-8")
+        response["X-Chat-Cache"] = "miss"
+        response["Cache-Control"] = "no-store"
+        return response
+
+    chunks = chatbot.get_upstream().stream_text(payload)
+    # Wait for the first chunk so upstream failures still get a proper status code
+    try:
+        first = await anext(chunks, "")
+    except chatbot.UpstreamError as exc:
+        return _chat_error(str(exc), exc.status)
+
+    async def stream():
+        parts = [first]
+        yield first
+        try:
+            async for chunk in chunks:
+                parts.append(chunk)
+                yield chunk
+        except chatbot.UpstreamError:
+            # The 200 is already sent: re-raising aborts the response, so the client sees an
+            # incomplete body instead of a short answer that looks finished (and nothing is cached)
+            logger.warning("Assistant stream failed after %d chunks", len(parts), exc_info=True)
+            raise
+        chatbot.answer_cache.set(cache_key, "".join(parts))
+
+    response = StreamingHttpResponse(stream(), content_type="text/plain; charset=utf-8")
+    response["X-Chat-Cache"] = "miss"
+    response["Cache-Control"] = "no-store"
+    return response
+
+
+@require_POST
+async def chat_voice(request):
+    """Relay a recorded question to the assistant's voice endpoint (see chatbot.upstream_scope())."""
+    # Refuse oversized bodies before Django spools them to disk; the other fields are bounded by
+    # DATA_UPLOAD_MAX_MEMORY_SIZE, so anything beyond both limits cannot be an acceptable upload
+    content_length = request.META.get("CONTENT_LENGTH") or ""
+    if settings.DATA_UPLOAD_MAX_MEMORY_SIZE is not None and content_length.isdigit() and (
+        int(content_length) > settings.CHATBOT_MAX_AUDIO_BYTES + settings.DATA_UPLOAD_MAX_MEMORY_SIZE
+    ):
+        return _chat_error("Audio is too large", 413)
+    audio = request.FILES.get("audio")
+    if audio is None:
+        return _chat_error("Missing audio", 400)
+    if audio.size > settings.CHATBOT_MAX_AUDIO_BYTES:
+        return _chat_error("Audio is too large", 413)
+    if not (audio.content_type or "").startswith("audio/"):
+        return _chat_error("Unsupported audio type", 415)
+    data = {key: request.POST[key] for key in ("language", "context") if key in request.POST}
+    try:
+        async with chatbot.upstream_scope(request):
+            status, content_type, transcription, content = await chatbot.get_upstream().query_voice(audio, data)
+    except chatbot.UpstreamError as exc:
+        return _chat_error(str(exc), exc.status)
+
+    response = HttpResponse(content, status=status, content_type=content_type)
+    if transcription:
+        response["X-Transcription"] = transcription
+    return response
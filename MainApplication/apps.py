@@ -6,3 +6,12 @@ class MainapplicationConfig(AppConfig):
     name = 'MainApplication'
     verbose_name = "پنل دیتابیس اطلاعات شهر ها و جزایر"
 
+    def ready(self):
+        from django.db.backends.signals import connection_created
+
+        from . import signals  # noqa: F401
+        from .middleware import install_query_recorder
+
+        # Queries are charged to the request PerformanceMiddleware is measuring (a no-op otherwise)
+        connection_created.connect(install_query_recorder, dispatch_uid="MainApplication.performance")
+
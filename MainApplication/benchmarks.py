@@ -0,0 +1,483 @@
+import asyncio
+import functools
+import gc
+import itertools
+import json
+import math
+import random
+import statistics
+import tempfile
+import threading
+import time
+import tracemalloc
+import warnings
+from contextlib import contextmanager, nullcontext
+from io import StringIO
+from pathlib import Path
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, connections, transaction
+from django.test import AsyncClient, Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import include, path, reverse
+
+from . import chatbot
+from .caching import bump_scores_version
+from .models import City, CityFieldScore, FieldType, fill_root_paths, rebuild_city_summaries
+from .names import SLUG_TO_CITY_NAME, normalize_name
+
+# Synthetic datasets and timing harness behind the ``benchmark`` management command.
+# Everything here writes to whatever database is active, so the command only runs it
+# against a throwaway test database.
+
+METRICS = ("p50_ms", "p95_ms", "queries", "peak_kb", "rps")
+# Timing changes smaller than this are noise on any machine, whatever the threshold says
+MIN_TIME_DELTA_MS = 1.0
+
+
+def parse_dataset(value):
+    """Parse ``"500x300"`` into ``(500, 300)`` (cities x fields)."""
+    try:
+        cities, fields = (int(part) for part in value.lower().split("x"))
+    except ValueError:
+        raise ValueError(f"Dataset must look like CITIESxFIELDS (e.g. 500x300), got {value!r}")
+    if cities < 1 or fields < 1:
+        raise ValueError(f"Dataset needs at least one city and one field, got {value!r}")
+    return cities, fields
+
+
+def dataset_city_names(count):
+    # Real provinces first so map links and city_detail resolve, then synthetic cities
+    names = list(dict.fromkeys(SLUG_TO_CITY_NAME.values()))[:count]
+    names += [f"شهر آزمایشی {index:05d}" for index in range(len(names), count)]
+    return names
+
+
+def seed_dataset(cities, fields, seed=0, batch_size=5000):
+    """Fill an empty database with ``cities`` x ``fields`` random scores; returns the first city's slug."""
+    rng = random.Random(seed)
+    slug_by_name = {}
+    for slug, name in SLUG_TO_CITY_NAME.items():
+        slug_by_name.setdefault(name, slug)
+
+    # bulk_create skips MainApplication.signals, so keys, paths, summaries and the version are set here
+    City.objects.bulk_create(
+        (
+            City(name=name, slug=slug_by_name.get(name), name_key=normalize_name(name), city_type=City.CityType.city)
+            for name in dataset_city_names(cities)
+        ),
+        batch_size=batch_size,
+    )
+    fill_root_paths()
+    FieldType.objects.bulk_create(
+        (FieldType(name=f"شاخص {index:04d}") for index in range(fields)),
+        batch_size=batch_size,
+    )
+    city_ids = list(City.objects.order_by("id").values_list("id", flat=True))
+    field_ids = list(FieldType.objects.order_by("id").values_list("id", flat=True))
+    CityFieldScore.objects.bulk_create(
+        (
+            CityFieldScore(city_id=city_id, field_id=field_id, score=rng.randint(1, 100))
+            for city_id in city_ids
+            for field_id in field_ids
+        ),
+        batch_size=batch_size,
+    )
+    rebuild_city_summaries()
+    bump_scores_version()
+    return City.objects.filter(slug__isnull=False).order_by("id").values_list("slug", flat=True).first()
+
+
+def write_import_files(directory, cities, fields, seed=0):
+    """
+    Write the converter inputs for a dataset: a CSV sheet for json_converter and
+    its JSON output for sql_converter. Cities are new names so every import
+    creates cities and scores instead of finding them unchanged.
+    """
+    rng = random.Random(seed + 1)
+    city_names = [f"شهر واردشده {index:05d}" for index in range(cities)]
+    field_names = [f"شاخص {index:04d}" for index in range(fields)]
+    scores = {city: {field: rng.randint(1, 100) for field in field_names} for city in city_names}
+
+    csv_path = Path(directory) / "benchmark.csv"
+    with open(csv_path, "w", encoding="utf-8") as f:
+        f.write(",".join(["شاخص", *city_names]) + "\n")
+        for field in field_names:
+            f.write(",".join([field, *(str(scores[city][field]) for city in city_names)]) + "\n")
+    json_path = Path(directory) / "benchmark.json"
+    with open(json_path, "w", encoding="utf-8") as f:
+        json.dump(scores, f, ensure_ascii=False)
+    return csv_path, json_path
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a non-empty list."""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+@contextmanager
+def traced_memory(result):
+    """Store the peak traced allocation (bytes) of the block in ``result["peak"]``."""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        yield
+        result["peak"] = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def measure(run, repeat=5, warmup=1, setup=None):
+    """
+    Time ``run()`` ``repeat`` times and return p50/p95 latency, the SQL query
+    count of one run and the peak traced memory of another.
+
+    Each run happens inside a rolled-back transaction, so imports can be
+    measured repeatedly against the same data. ``setup()`` runs before every
+    call, outside the measurement (e.g. clearing the response cache).
+    """
+
+    def call(around=nullcontext):
+        with transaction.atomic():
+            if setup is not None:
+                setup()
+            with around():
+                started = time.perf_counter()
+                run()
+                elapsed = time.perf_counter() - started
+            transaction.set_rollback(True)
+        return elapsed
+
+    for _ in range(warmup):
+        call()
+    timings = []
+    for _ in range(repeat):
+        gc.collect()
+        timings.append(call() * 1000)
+    # With DEBUG on, the bounded query log may already be full, which would hide new queries
+    connection.queries_log.clear()
+    queries = CaptureQueriesContext(connection)
+    call(lambda: queries)
+    # tracemalloc slows Python code down, so memory gets its own run
+    memory = {}
+    call(lambda: traced_memory(memory))
+    return {
+        "p50_ms": round(statistics.median(timings), 3),
+        "p95_ms": round(percentile(timings, 0.95), 3),
+        "mean_ms": round(statistics.fmean(timings), 3),
+        "queries": len(queries),
+        "peak_kb": round(memory["peak"] / 1024, 1),
+    }
+
+
+def get_response(client, url, status=200):
+    response = client.get(url)
+    if response.status_code != status:
+        raise RuntimeError(f"GET {url} returned {response.status_code}")
+    # Drain streamed bodies so their cost is counted
+    return b"".join(response) if response.streaming else response.content
+
+
+def build_scenarios(city_slug, import_files):
+    """Return ``{name: (run, setup)}`` for every benchmarked code path."""
+    client = Client()
+    admin_client = Client()
+    user_model = get_user_model()
+    admin_user = user_model.objects.filter(username="benchmark").first()
+    if admin_user is None:
+        admin_user = user_model.objects.create_superuser("benchmark", "benchmark@example.com", None)
+    admin_client.force_login(admin_user)
+
+    main_url = reverse("Authenticate:Main")
+    city_url = reverse("Authenticate:city_detail", args=[city_slug])
+    city_admin_url = reverse("admin:MainApplication_city_changelist")
+    score_admin_url = reverse("admin:MainApplication_cityfieldscore_changelist")
+    scores_url = reverse("Authenticate:api_scores")
+    similar_url = reverse("Authenticate:api_city_similar", args=[city_slug])
+    correlations_url = reverse("Authenticate:api_correlations")
+    clusters_url = reverse("Authenticate:api_clusters")
+    csv_export_url = reverse("Authenticate:api_export", args=["csv"])
+    xlsx_export_url = reverse("Authenticate:api_export", args=["xlsx"])
+    first_field_id = FieldType.objects.order_by("id").values_list("id", flat=True).first()
+    # A different weight per call, so the response cache never answers
+    weight_counter = itertools.count(1)
+    csv_path, json_path = import_files
+
+    def quiet_command(*args):
+        call_command(*args, stdout=StringIO(), stderr=StringIO())
+
+    def discard_response(url):
+        # Read the body without keeping it, so peak memory is the export's own
+        response = client.get(url)
+        if response.status_code != 200:
+            raise RuntimeError(f"GET {url} returned {response.status_code}")
+        for _ in response:
+            pass
+        response.close()
+
+    return {
+        # Views are measured cold (rendered page cache cleared) and warm
+        "main": (lambda: get_response(client, main_url), cache.clear),
+        "main:cached": (lambda: get_response(client, main_url), None),
+        "city_detail": (lambda: get_response(client, city_url), cache.clear),
+        "city_detail:cached": (lambda: get_response(client, city_url), None),
+        "admin:city_changelist": (lambda: get_response(admin_client, city_admin_url), None),
+        "admin:score_changelist": (lambda: get_response(admin_client, score_admin_url), None),
+        "json_converter": (
+            lambda: quiet_command("json_converter", str(csv_path), "--output-dir", str(csv_path.parent)),
+            None,
+        ),
+        "sql_converter": (lambda: quiet_command("sql_converter", "--file", str(json_path)), None),
+        # Re-weighting with the cached ScoreMatrix, and with the matrix rebuilt first
+        "scores:weighted": (
+            lambda: get_response(client, f"{scores_url}?weights={first_field_id}:{next(weight_counter)}"),
+            None,
+        ),
+        "scores:rebuild": (lambda: get_response(client, scores_url), cache.clear),
+        # Analytics from a cold start: the ScoreMatrix is rebuilt too (see scores:rebuild)
+        "analytics:similar": (lambda: get_response(client, similar_url), cache.clear),
+        "analytics:correlations": (lambda: get_response(client, correlations_url), cache.clear),
+        "analytics:clusters": (lambda: get_response(client, f"{clusters_url}?k=8"), cache.clear),
+        # Streamed exports: memory should not grow with the number of scores
+        "export:csv": (lambda: discard_response(csv_export_url), None),
+        "export:xlsx": (lambda: discard_response(xlsx_export_url), None),
+    }
+
+
+@contextmanager
+def seeded_dataset(cities, fields, seed=0, log=None):
+    """Seed one dataset for the duration of the block; yields the first map city's slug."""
+    started = time.perf_counter()
+    city_slug = seed_dataset(cities, fields, seed=seed)
+    if log:
+        log(f"Seeded {cities}x{fields} ({cities * fields} scores) in {time.perf_counter() - started:.1f}s")
+    try:
+        yield city_slug
+    finally:
+        # Scores and summaries go with their cities
+        City.objects.all().delete()
+        FieldType.objects.all().delete()
+
+
+def run_benchmarks(datasets, scenarios=None, repeat=5, warmup=1, seed=0, log=None):
+    """
+    Seed each ``(cities, fields)`` dataset into the current (empty) database
+    and measure every scenario against it. Data is removed between datasets.
+    """
+    results = {}
+    for cities, fields in datasets:
+        name = f"{cities}x{fields}"
+        with seeded_dataset(cities, fields, seed=seed, log=log) as city_slug, tempfile.TemporaryDirectory() as directory:
+            available = build_scenarios(city_slug, write_import_files(directory, cities, fields, seed=seed))
+            results[name] = {}
+            for scenario, (run, setup) in available.items():
+                if scenarios and scenario not in scenarios:
+                    continue
+                results[name][scenario] = measure(run, repeat=repeat, warmup=warmup, setup=setup)
+                if log:
+                    stats = results[name][scenario]
+                    log(
+                        f"  {scenario}: p50 {stats['p50_ms']:.1f}ms, p95 {stats['p95_ms']:.1f}ms, "
+                        f"{stats['queries']} queries, peak {stats['peak_kb']:.0f}KB"
+                    )
+    return results
+
+
+class LatencyUpstream:
+    """Chat upstream stand-in that answers after ``latency`` seconds, like the remote assistant."""
+
+    latency = 0.05
+
+    def __init__(self, base_url, timeout):
+        pass
+
+    async def stream_text(self, payload):
+        await asyncio.sleep(self.latency)
+        yield "پاسخ آزمایشی"
+
+    async def query_voice(self, audio, data):
+        raise chatbot.UpstreamError("Voice is not benchmarked", 501)
+
+
+def load_requests(city_slug, count):
+    """``{scenario: [(method, path, json body), ...]}`` for the concurrency benchmark."""
+    return {
+        "main": [("get", reverse("Authenticate:Main"), None)] * count,
+        "city_detail": [("get", reverse("Authenticate:city_detail", args=[city_slug]), None)] * count,
+        # Distinct questions, so every request waits on the upstream instead of the answer cache
+        "chat": [
+            ("post", reverse("Authenticate:api_chat_text"), {"query": f"پرسش {index}", "history": []})
+            for index in range(count)
+        ],
+    }
+
+
+def load_stats(latencies, elapsed):
+    latencies = [latency * 1000 for latency in latencies]
+    return {
+        "rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(statistics.median(latencies), 3),
+        "p95_ms": round(percentile(latencies, 0.95), 3),
+    }
+
+
+def _send(client, method, path, body):
+    if method == "post":
+        response = client.post(path, json.dumps(body), content_type="application/json")
+    else:
+        response = client.get(path)
+    if response.status_code != 200:
+        raise RuntimeError(f"{method.upper()} {path} returned {response.status_code}")
+    return b"".join(response) if response.streaming else response.content
+
+
+def run_wsgi_load(requests, concurrency):
+    """Thread-per-request serving: ``concurrency`` threads each push requests through the WSGI handler."""
+    pending = list(reversed(requests))
+    lock = threading.Lock()
+    latencies = []
+    errors = []
+
+    def worker():
+        client = Client()
+        try:
+            while True:
+                with lock:
+                    if not pending:
+                        return
+                    method, path, body = pending.pop()
+                started = time.perf_counter()
+                _send(client, method, path, body)
+                latencies.append(time.perf_counter() - started)
+        except Exception as exc:
+            errors.append(exc)
+        finally:
+            connections.close_all()
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.perf_counter()
+    with warnings.catch_warnings():
+        # Under WSGI Django buffers async streams (the chat view); that cost is what is measured
+        warnings.filterwarnings("ignore", message="StreamingHttpResponse must consume asynchronous iterators")
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    elapsed = time.perf_counter() - started
+    if errors:
+        raise errors[0]
+    return load_stats(latencies, elapsed)
+
+
+async def run_asgi_load(requests, concurrency):
+    """One event loop serving up to ``concurrency`` requests at once through the ASGI handler."""
+    client = AsyncClient()
+    slots = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def send(method, path, body):
+        async with slots:
+            started = time.perf_counter()
+            if method == "post":
+                response = await client.post(path, json.dumps(body), content_type="application/json")
+            else:
+                response = await client.get(path)
+            if response.status_code != 200:
+                raise RuntimeError(f"{method.upper()} {path} returned {response.status_code}")
+            if response.streaming:
+                b"".join([chunk async for chunk in response])
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(send(*request) for request in requests))
+    return load_stats(latencies, time.perf_counter() - started)
+
+
+class AppURLConf:
+    """Root URLconf (ROOT_URLCONF) with only this app's URLs and sync or async pages; for benchmarks and tests."""
+
+    def __init__(self, async_views):
+        from .urls import app_name, build_urlpatterns
+
+        self.urlpatterns = [path("", include((build_urlpatterns(async_views), app_name)))]
+
+
+@functools.cache
+def app_urlconf(async_views):
+    return AppURLConf(async_views)
+
+
+def run_concurrency_benchmarks(
+    datasets, concurrency=20, requests=200, upstream_latency=0.05, scenarios=None, seed=0, log=None
+):
+    """
+    Compare WSGI (sync views, a thread per in-flight request) with ASGI (async
+    views on one event loop) for the map page, the city page and chat streams
+    whose upstream takes ``upstream_latency`` seconds.
+
+    Results are keyed ``"wsgi:main@20"`` / ``"asgi:main@20"`` with rps, p50 and p95.
+    Runs outside any transaction so the worker threads see the seeded data.
+    """
+    LatencyUpstream.latency = upstream_latency
+    results = {}
+    for cities, fields in datasets:
+        name = f"{cities}x{fields}"
+        results[name] = {}
+        with seeded_dataset(cities, fields, seed=seed, log=log) as city_slug, override_settings(
+            CHATBOT_UPSTREAM="MainApplication.benchmarks.LatencyUpstream"
+        ):
+            chatbot.reset_upstream()
+            for scenario, load in load_requests(city_slug, requests).items():
+                if scenarios and scenario not in scenarios:
+                    continue
+                for server in ("wsgi", "asgi"):
+                    cache.clear()
+                    chatbot.answer_cache.clear()
+                    with override_settings(ROOT_URLCONF=app_urlconf(async_views=server == "asgi")):
+                        if server == "wsgi":
+                            stats = run_wsgi_load(load, concurrency)
+                        else:
+                            stats = asyncio.run(run_asgi_load(load, concurrency))
+                    key = f"{server}:{scenario}@{concurrency}"
+                    results[name][key] = stats
+                    if log:
+                        log(f"  {key}: {stats['rps']:.0f} req/s, p50 {stats['p50_ms']:.1f}ms, p95 {stats['p95_ms']:.1f}ms")
+            chatbot.reset_upstream()
+    return results
+
+
+def compare_results(baseline, current, threshold=0.2):
+    """
+    Compare two result documents and return a list of rows
+    ``(dataset, scenario, metric, old, new, change, regressed)``.
+
+    A metric regresses when it grew by more than ``threshold`` (0.2 = 20%),
+    or for throughput (rps) when it dropped by more than that; timings must
+    also grow by at least MIN_TIME_DELTA_MS, and any extra SQL query counts
+    as a regression.
+    """
+    rows = []
+    for dataset, scenarios in current.get("results", {}).items():
+        for scenario, stats in scenarios.items():
+            old_stats = baseline.get("results", {}).get(dataset, {}).get(scenario)
+            if old_stats is None:
+                continue
+            for metric in METRICS:
+                old, new = old_stats.get(metric), stats.get(metric)
+                if old is None or new is None:
+                    continue
+                change = (new - old) / old if old else (0.0 if new == old else math.inf)
+                if metric == "queries":
+                    regressed = new > old
+                elif metric == "rps":
+                    # Throughput regresses when it drops
+                    regressed = -change > threshold
+                else:
+                    regressed = change > threshold
+                    if metric.endswith("_ms"):
+                        regressed = regressed and new - old >= MIN_TIME_DELTA_MS
+                rows.append((dataset, scenario, metric, old, new, change, regressed))
+    return rows
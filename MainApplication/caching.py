@@ -0,0 +1,174 @@
+import hashlib
+import time
+from functools import partial, wraps
+from inspect import iscoroutinefunction
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import urlencode
+
+from .metrics import record_cache_lookup
+from .routers import pin_primary
+
+SCORES_VERSION_KEY = "MainApplication:scores_version"
+
+
+def get_scores_version():
+    """Return the global version of City/FieldType/CityFieldScore data."""
+    version = cache.get(SCORES_VERSION_KEY)
+    if version is None:
+        # Seed with the clock so a flushed cache never reuses an old version number
+        cache.add(SCORES_VERSION_KEY, time.time_ns(), timeout=None)
+        version = cache.get(SCORES_VERSION_KEY)
+    return version
+
+
+async def aget_scores_version():
+    """Async get_scores_version() for async views."""
+    version = await cache.aget(SCORES_VERSION_KEY)
+    if version is None:
+        await cache.aadd(SCORES_VERSION_KEY, time.time_ns(), timeout=None)
+        version = await cache.aget(SCORES_VERSION_KEY)
+    return version
+
+
+def _bump_scores_version():
+    # Readers use the primary until the replica has the change, so nothing stale is cached as the new version
+    pin_primary()
+    try:
+        cache.incr(SCORES_VERSION_KEY)
+    except ValueError:
+        cache.set(SCORES_VERSION_KEY, time.time_ns(), timeout=None)
+
+
+def bump_scores_version():
+    """
+    Invalidate every response cached for the previous scores version, once the
+    current transaction commits (at once outside one). Bumped earlier, a
+    concurrent reader could render the uncommitted state's predecessor and
+    cache it under the new version, where it would stay until the next write.
+    """
+    transaction.on_commit(_bump_scores_version)
+
+
+def admit_cache_variant(name, limit):
+    """
+    Count one more response of ``name`` about to be cached for a query string of
+    the client's choosing (e.g. ad-hoc weights) and return whether it may be:
+    at most ``limit`` per scores version, so such queries cannot fill the cache.
+    Views mark the rest with ``response.skip_scores_cache = True``.
+    """
+    key = f"MainApplication:variants:{name}:{get_scores_version()}"
+    cache.add(key, 0, timeout=getattr(settings, "SCORES_CACHE_TIMEOUT", 60 * 60 * 24))
+    try:
+        return cache.incr(key) <= limit
+    except ValueError:
+        # Evicted in between; start counting again
+        return True
+
+
+def _is_cacheable(response):
+    return response.status_code == 200 and not response.streaming and not getattr(response, "skip_scores_cache", False)
+
+
+def _response_cache_key(request, view_name, query_params, per_user, version):
+    # Pages embed the username for the chatbot, so the user is part of the key
+    username = ""
+    if per_user:
+        user = getattr(request, "user", None)
+        username = user.get_username() if user is not None and user.is_authenticated else ""
+    # Only the parameters the view reads: anything else appended to the URL maps to the same entry
+    query = urlencode([(name, request.GET.getlist(name)) for name in query_params if name in request.GET], doseq=True)
+    raw_key = f"{request.path}?{query}|{username}"
+    digest = hashlib.md5(raw_key.encode("utf-8")).hexdigest()
+    return f"MainApplication:response:{view_name}:{version}:{digest}"
+
+
+def cache_by_scores_version(view=None, *, query_params=(), per_user=True, max_age=0):
+    """
+    Cache a GET view's rendered body until the scores version changes.
+
+    Responses are keyed on the path and the ``query_params`` the view reads, so
+    views must list every query parameter their output depends on; others are
+    ignored and cannot be used to mint fresh entries. Cached responses carry a
+    strong ETag, so conditional requests are answered with 304 without touching
+    the database or the template engine. Views whose output does not depend on
+    the user pass ``per_user=False``; ``max_age`` lets clients reuse a response
+    for that many seconds before revalidating. Only 200 responses are cached,
+    and not those a view sets ``skip_scores_cache`` on.
+    """
+    if view is None:
+        return partial(cache_by_scores_version, query_params=query_params, per_user=per_user, max_age=max_age)
+
+    view_name = f"{view.__module__}.{view.__name__}"
+
+    def cached_response(cached):
+        content, content_type, etag = cached
+        return HttpResponse(content, content_type=content_type), etag
+
+    def cache_entry(response):
+        """Return (cached value, timeout) for a fresh 200 response."""
+        etag = '"%s"' % hashlib.sha256(response.content).hexdigest()
+        timeout = getattr(settings, "SCORES_CACHE_TIMEOUT", 60 * 60 * 24)
+        return (response.content, response["Content-Type"], etag), timeout
+
+    def finish(request, response, etag):
+        response["ETag"] = etag
+        if max_age:
+            patch_cache_control(response, public=True, max_age=max_age)
+        else:
+            patch_cache_control(response, no_cache=True)
+        if per_user:
+            patch_vary_headers(response, ("Cookie",))
+        return get_conditional_response(request, etag=etag, response=response)
+
+    if iscoroutinefunction(view):
+
+        @wraps(view)
+        async def async_wrapper(request, *args, **kwargs):
+            if request.method not in ("GET", "HEAD"):
+                return await view(request, *args, **kwargs)
+
+            if per_user:
+                # Load the user once, asynchronously; the key and the templates then never
+                # touch the session from the event loop
+                request.user = await request.auser()
+            key = _response_cache_key(request, view_name, query_params, per_user, await aget_scores_version())
+            cached = await cache.aget(key)
+            record_cache_lookup(cached is not None)
+            if cached is not None:
+                response, etag = cached_response(cached)
+            else:
+                response = await view(request, *args, **kwargs)
+                if not _is_cacheable(response):
+                    return response
+                entry, timeout = cache_entry(response)
+                await cache.aset(key, entry, timeout)
+                etag = entry[2]
+            return finish(request, response, etag)
+
+        return async_wrapper
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if request.method not in ("GET", "HEAD"):
+            return view(request, *args, **kwargs)
+
+        key = _response_cache_key(request, view_name, query_params, per_user, get_scores_version())
+        cached = cache.get(key)
+        record_cache_lookup(cached is not None)
+        if cached is not None:
+            response, etag = cached_response(cached)
+        else:
+            response = view(request, *args, **kwargs)
+            if not _is_cacheable(response):
+                return response
+            entry, timeout = cache_entry(response)
+            cache.set(key, entry, timeout)
+            etag = entry[2]
+        return finish(request, response, etag)
+
+    return wrapper
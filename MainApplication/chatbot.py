@@ -0,0 +1,319 @@
+import asyncio
+import contextlib
+import contextvars
+import hashlib
+import json
+import re
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.handlers.asgi import ASGIRequest
+from django.db.models import Count, Q
+from django.utils.module_loading import import_string
+
+from .caching import get_scores_version
+from .metrics import record_cache_lookup
+from .models import City, CityFieldScore, CityScoreSummary
+from .names import SLUG_TO_CITY_NAME
+
+# Server-side gateway to the Persian Assistant API used by script_ChatBot.js.
+# The upstream client is pluggable (settings.CHATBOT_UPSTREAM) so tests and
+# local development can point it at a stub instead of the real service.
+
+HISTORY_TURNS = 6
+# Strongest/weakest fields named in a city's context; keeps prompts short as FieldTypes grow
+CONTEXT_FIELDS = 3
+
+
+def extract_response_text(data):
+    """Pull the answer out of the assistant's JSON, mirroring extractResponseText in the chatbot JS."""
+    if not data:
+        return None
+    if isinstance(data, str):
+        return data
+    if not isinstance(data, dict):
+        return None
+    if data.get("data"):
+        nested = extract_response_text(data["data"])
+        if nested:
+            return nested
+    for key in ("response", "answer", "content", "text", "result"):
+        if isinstance(data.get(key), str):
+            return data[key]
+    message = data.get("message")
+    if isinstance(message, str) and message.strip().lower() != "query processed successfully":
+        return message
+    try:
+        return data["choices"][0]["message"]["content"]
+    except (KeyError, IndexError, TypeError):
+        pass
+    try:
+        return data["candidates"][0]["content"]["parts"][0]["text"]
+    except (KeyError, IndexError, TypeError):
+        return None
+
+
+class UpstreamError(Exception):
+    def __init__(self, message, status=502):
+        super().__init__(message)
+        self.status = status
+
+
+class HttpxUpstream:
+    """
+    Talks to the assistant over one keep-alive httpx.AsyncClient per event loop.
+
+    Under ASGI there is a single loop, so every request shares the pool. Under
+    WSGI each async view runs on a loop of its own that ends with the request,
+    so a pool could never be reused and its sockets would outlive the loop:
+    those requests run inside request_scope() (see upstream_scope()) and get a
+    client that is closed at the end of the block.
+    """
+
+    def __init__(self, base_url, timeout):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self._clients = weakref.WeakKeyDictionary()
+        self._scoped = contextvars.ContextVar("scoped_client", default=None)
+
+    def _new_client(self):
+        import httpx
+
+        return httpx.AsyncClient(
+            base_url=self.base_url,
+            timeout=self.timeout,
+            limits=httpx.Limits(max_keepalive_connections=20, keepalive_expiry=30),
+        )
+
+    def client(self):
+        client = self._scoped.get()
+        if client is not None:
+            return client
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            client = self._clients[loop] = self._new_client()
+        return client
+
+    @contextlib.asynccontextmanager
+    async def request_scope(self):
+        """Send the calls inside the block over a client of their own, closed on the way out."""
+        client = self._new_client()
+        token = self._scoped.set(client)
+        try:
+            yield
+        finally:
+            self._scoped.reset(token)
+            await client.aclose()
+
+    async def stream_text(self, payload):
+        """Yield the answer in chunks; JSON answers arrive as one chunk, text streams as they come."""
+        import httpx
+
+        try:
+            async with self.client().stream("POST", "/api/v1/query/text", json=payload) as response:
+                if response.status_code >= 400:
+                    body = await response.aread()
+                    raise UpstreamError(_error_message(body), response.status_code)
+                if response.headers.get("content-type", "").startswith("application/json"):
+                    data = json.loads(await response.aread() or b"null")
+                    yield extract_response_text(data) or ""
+                    return
+                async for chunk in response.aiter_text():
+                    if chunk:
+                        yield chunk
+        except httpx.HTTPError as exc:
+            raise UpstreamError(f"Assistant is unreachable: {exc.__class__.__name__}") from exc
+
+    async def query_voice(self, audio, data):
+        """Forward a voice query; returns (status, content_type, transcription, body)."""
+        import httpx
+
+        try:
+            response = await self.client().post(
+                "/api/v1/query/voice",
+                data=data,
+                files={"audio": (audio.name, audio.read(), audio.content_type)},
+            )
+        except httpx.HTTPError as exc:
+            raise UpstreamError(f"Assistant is unreachable: {exc.__class__.__name__}") from exc
+        return (
+            response.status_code,
+            response.headers.get("content-type", "application/octet-stream"),
+            response.headers.get("x-transcription"),
+            response.content,
+        )
+
+
+def _error_message(body):
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return body.decode("utf-8", "replace") or "Assistant request failed"
+    if isinstance(data, dict):
+        return data.get("message") or data.get("error") or data.get("detail") or "Assistant request failed"
+    return "Assistant request failed"
+
+
+_upstream = None
+
+
+def get_upstream():
+    global _upstream
+    if _upstream is None:
+        upstream_class = import_string(settings.CHATBOT_UPSTREAM)
+        _upstream = upstream_class(settings.CHATBOT_API_BASE, settings.CHATBOT_TIMEOUT)
+    return _upstream
+
+
+def reset_upstream():
+    """Drop the shared upstream so the next request builds it from current settings."""
+    global _upstream
+    _upstream = None
+
+
+def upstream_scope(request):
+    """
+    Context for the upstream calls of ``request``: the shared pool under ASGI,
+    and under WSGI, whose event loops last one request, the upstream's
+    request_scope() (upstreams without one need nothing).
+    """
+    upstream = get_upstream()
+    if isinstance(request, ASGIRequest) or not hasattr(upstream, "request_scope"):
+        return contextlib.nullcontext()
+    return upstream.request_scope()
+
+
+class AnswerCache:
+    """
+    In-process LRU of finished answers that also expire after ``ttl`` seconds.
+
+    Shared by the threads of a WSGI worker, so every access holds the lock.
+    """
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            expires, answer = item
+            if expires < time.monotonic():
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return answer
+
+    def set(self, key, answer):
+        with self._lock:
+            self._items[key] = (time.monotonic() + self.ttl, answer)
+            self._items.move_to_end(key)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+answer_cache = AnswerCache(settings.CHATBOT_CACHE_SIZE, settings.CHATBOT_CACHE_TTL)
+
+
+def normalize_query(query):
+    """Casefold and collapse whitespace so trivially different questions share a cache entry."""
+    return re.sub(r"\s+", " ", query).strip().casefold()
+
+
+def answer_cache_key(query, history_text, city_slug, temperature):
+    # City context changes with the scores version, so it is part of the key instead of its text
+    context_version = f"{city_slug or ''}:{get_scores_version()}"
+    history_digest = hashlib.md5(history_text.encode("utf-8")).hexdigest() if history_text else ""
+    return (normalize_query(query), history_digest, context_version, temperature)
+
+
+def build_city_context(city):
+    """
+    Summarize a city for the prompt in a few lines, however many fields exist.
+
+    Lists every score while there are at most ``2 * CONTEXT_FIELDS`` of them,
+    otherwise only the strongest and weakest ``CONTEXT_FIELDS``, plus the
+    average and its rank among the cities of the same level that have scores.
+    """
+    summary = getattr(city, "summary", None)
+    average = round(summary.avg_score, 2) if summary else 0
+    scores = list(
+        CityFieldScore.objects.filter(city=city).order_by("-score", "field__name").values_list("field__name", "score")
+    )
+    lines = [f"شهر: {city.name}"]
+    if summary and summary.score_count:
+        ranks = CityScoreSummary.objects.filter(score_count__gt=0, city__depth=city.depth).aggregate(
+            total=Count("id"), above=Count("id", filter=Q(avg_score__gt=summary.avg_score))
+        )
+        lines.append(f"میانگین امتیازها: {average:g} (رتبه {ranks['above'] + 1} از {ranks['total']})")
+    else:
+        lines.append(f"میانگین امتیازها: {average:g}")
+
+    def fields_text(items):
+        return "، ".join(f"{name}: {score}" for name, score in items)
+
+    if len(scores) <= 2 * CONTEXT_FIELDS:
+        lines.append(f"امتیازها: {fields_text(scores)}")
+    else:
+        lines.append(f"بهترین شاخص ها: {fields_text(scores[:CONTEXT_FIELDS])}")
+        lines.append(f"ضعیف ترین شاخص ها: {fields_text(reversed(scores[-CONTEXT_FIELDS:]))}")
+        lines.append(f"تعداد شاخص ها: {len(scores)}")
+    return "\n".join(lines)
+
+
+def get_city_context(city_slug):
+    """Return the cached context blob for ``city_slug`` ("" for unknown cities); rebuilt when scores change."""
+    # Slugs come from the browser; only cache ones the map knows about
+    if city_slug not in SLUG_TO_CITY_NAME:
+        return ""
+    key = f"MainApplication:city_context:{get_scores_version()}:{city_slug}"
+    text = cache.get(key)
+    record_cache_lookup(text is not None)
+    if text is None:
+        city = City.objects.select_related("summary").filter(slug=city_slug).first()
+        text = build_city_context(city) if city else ""
+        cache.set(key, text, getattr(settings, "SCORES_CACHE_TIMEOUT", 60 * 60 * 24))
+    return text
+
+
+def build_history_text(history):
+    lines = []
+    for item in history[-HISTORY_TURNS:]:
+        if not isinstance(item, dict):
+            continue
+        label = "کاربر" if item.get("role") == "user" else "دستیار"
+        text = "پیام صوتی" if item.get("type") == "audio" else str(item.get("text", ""))
+        lines.append(f"{label}: {text}")
+    return "\n".join(lines)
+
+
+def prepare_chat(query, history, city_slug, temperature):
+    """Return (prompt sent upstream, answer cache key); reads the database and cache, so call it sync."""
+    history_text = build_history_text(history)
+    prompt = build_prompt(query, get_city_context(city_slug), history_text)
+    return prompt, answer_cache_key(query, history_text, city_slug, temperature)
+
+
+def build_prompt(query, city_text, history_text):
+    parts = []
+    if city_text:
+        parts.append(f"اطلاعات شهر:\n{city_text}")
+    if history_text:
+        parts.append(f"گفتگوی اخیر:\n{history_text}")
+    if not parts:
+        return query
+    return "<<<\n" + "\n\n".join(parts) + f"\n>>>\n\nپرسش کاربر: {query}"
+
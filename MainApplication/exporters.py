@@ -0,0 +1,147 @@
+import csv
+from itertools import groupby
+from operator import itemgetter
+
+from .models import City, CityFieldScore, FieldType, get_score_sources_as_of, path_ids
+from .names import CITY_PATH_SEPARATOR
+
+# Score exports in the layout the importers read (sample_maker's): a header of
+# city names, then one row per field with its scores, empty where a city has
+# none. Scores are read in field order through .iterator(), a server-side cursor
+# on Postgres, and written a row at a time, so memory grows with the number of
+# cities, not with the number of scores. Exports round-trip through
+# import_scores and json_converter, which find cities by name and sub-units by
+# their path: an export whose names would resolve to other cities (two
+# spellings of one province) is refused rather than written.
+
+EXPORT_FORMATS = ("csv", "xlsx")
+EXPORT_CHUNK_SIZE = 2000
+
+
+def parse_city_type(value):
+    """Map a CityType name (``city``, ``island``, ``county``, ``town``) to its stored value."""
+    try:
+        return City.CityType[value].value
+    except KeyError:
+        raise ValueError(f"Invalid city type {value!r}; expected one of {', '.join(City.CityType.names)}")
+
+
+def _field_cells(queryset, chunk_size):
+    # Ordered by field only: a field's cells are contiguous and the (field, score) index serves the order
+    cells = queryset.order_by("field_id").values_list("field_id", "city_id", "score").iterator(chunk_size=chunk_size)
+    return groupby(cells, key=itemgetter(0))
+
+
+def iter_field_scores(as_of=None, city_type=None, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Yield ``(field_id, [(city_id, score), ...])`` for every field with scores, in
+    field id order, from the current scores or as they were at ``as_of``.
+    """
+    city_filter = {"city__city_type": city_type} if city_type else {}
+    if as_of is None:
+        for field_id, cells in _field_cells(CityFieldScore.objects.filter(**city_filter), chunk_size):
+            yield field_id, [(city_id, score) for _, city_id, score in cells]
+        return
+
+    # A snapshot and the changes after it, merged one field at a time; changes win
+    values, changes = get_score_sources_as_of(as_of)
+    sources = [_field_cells(changes.filter(**city_filter), chunk_size)]
+    if values is not None:
+        sources.insert(0, _field_cells(values.filter(**city_filter), chunk_size))
+    heads = [next(source, None) for source in sources]
+    while any(heads):
+        field_id = min(head[0] for head in heads if head)
+        scores = {}
+        for index, head in enumerate(heads):
+            if head and head[0] == field_id:
+                scores.update((city_id, score) for _, city_id, score in head[1])
+                heads[index] = next(sources[index], None)
+        cells = [(city_id, score) for city_id, score in scores.items() if score is not None]
+        if cells:
+            yield field_id, cells
+
+
+def get_export_cities(city_type=None):
+    """
+    ``[(id, name), ...]`` of the export's columns in path order, so sub-units
+    follow their parent. Sub-units are named by their path ("قم/قم" for the
+    county of Qom), which the importers resolve a step at a time (see
+    CityResolver). Raises ValueError when a name would not import back as that
+    city: a step shares its parent and normalize_name() key with an older
+    city, which the importers would pick instead, or holds the path separator.
+    """
+    units, first = {}, {}
+    for city_id, parent_id, name, key in City.objects.order_by("-id").values_list("id", "parent_id", "name", "name_key"):
+        units[city_id] = (parent_id, name, key)
+        first[(parent_id, key)] = city_id
+
+    cities = City.objects.order_by("path", "id")
+    if city_type:
+        cities = cities.filter(city_type=city_type)
+    columns, ambiguous = [], set()
+    for city_id, path in cities.values_list("id", "path"):
+        names = []
+        for step in path_ids(path) or [city_id]:
+            parent_id, name, key = units[step]
+            if first[(parent_id, key)] != step or CITY_PATH_SEPARATOR in name:
+                ambiguous.add(name)
+            names.append(name)
+        columns.append((city_id, CITY_PATH_SEPARATOR.join(names)))
+    if ambiguous:
+        raise ValueError(
+            f"Cannot export: other cities share the names {', '.join(sorted(ambiguous))}, "
+            "so the file would not import back as the same cities"
+        )
+    return columns
+
+
+def iter_export_rows(as_of=None, city_type=None, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    The export as rows: ``["", city name, ...]``, then ``[field name, score or
+    None, ...]`` per field. The columns are checked here, before any row is
+    produced (see get_export_cities()), so a refused export fails up front.
+    """
+    return _iter_rows(get_export_cities(city_type), as_of, city_type, chunk_size)
+
+
+def _iter_rows(cities, as_of, city_type, chunk_size):
+    columns = {city_id: index for index, (city_id, _) in enumerate(cities)}
+    field_names = dict(FieldType.objects.values_list("id", "name"))
+    yield ["", *(name for _, name in cities)]
+
+    for field_id, cells in iter_field_scores(as_of, city_type, chunk_size):
+        row = [None] * len(cities)
+        for city_id, score in cells:
+            column = columns.get(city_id)
+            if column is not None:
+                row[column] = score
+        yield [field_names[field_id], *row]
+
+
+class _Echo:
+    # csv.writer needs a file; this one hands every formatted row back instead
+    def write(self, value):
+        return value
+
+
+def iter_csv(rows):
+    """Format rows as CSV text chunks, starting with the BOM sample_maker also writes for Excel."""
+    writer = csv.writer(_Echo())
+    yield "\ufeff"
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def write_xlsx(rows, target):
+    """
+    Write rows to ``target`` (a path or binary file) as a workbook. openpyxl's
+    write-only mode streams the rows to a temporary file instead of keeping the
+    sheet in memory.
+    """
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet("scores")
+    for row in rows:
+        sheet.append(row)
+    workbook.save(target)
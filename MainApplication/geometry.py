@@ -0,0 +1,226 @@
+import hashlib
+import json
+import logging
+import re
+from functools import cache
+from pathlib import Path
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Map outlines and their levels of detail. The source geometry (map_data/iran.json)
+# is the paths as drawn: layers of shapes whose class is the map slug. build_levels()
+# flattens every path to polylines, simplifies them with Douglas-Peucker and quantizes
+# the coordinates to a grid; the build_map_lods command stores the result next to the
+# source, so requests only read a file once per process.
+
+DATA_DIR = Path(__file__).resolve().parent / "map_data"
+SOURCE_FILE = DATA_DIR / "iran.json"
+LEVELS_FILE = DATA_DIR / "iran.lods.json"
+
+# name: (Douglas-Peucker tolerance, coordinate grid) in viewBox units. The map is about
+# 970 units wide and drawn 500px wide, so "medium" stays under a pixel there and "high"
+# holds up on 2x screens; "low" is for thumbnails.
+LEVELS = {
+    "high": (0.25, 0.1),
+    "medium": (0.75, 0.5),
+    "low": (2.0, 1.0),
+}
+FULL = "full"  # the source paths, unchanged
+LODS = (*LEVELS, FULL)
+CURVE_STEPS = 4  # line segments per cubic Bezier when flattening
+
+_TOKEN = re.compile(r"[A-Za-z]|[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?")
+
+
+def parse_path(d):
+    """
+    Split absolute ``M``/``L``/``C``/``Z`` path data into ``[(points, closed), ...]``
+    subpaths, with every cubic Bezier flattened into CURVE_STEPS line segments.
+    """
+    tokens = _TOKEN.findall(d)
+    steps = np.linspace(1 / CURVE_STEPS, 1, CURVE_STEPS)[:, None]
+    subpaths, points, command, position = [], None, None, 0
+    while position < len(tokens):
+        if tokens[position].isalpha():
+            command = tokens[position]
+            position += 1
+            if command == "Z":
+                if points:
+                    subpaths.append((points, True))
+                points = None
+            continue
+        if command == "M":
+            if points:
+                subpaths.append((points, False))
+            points = [(float(tokens[position]), float(tokens[position + 1]))]
+            command = "L"  # further pairs after a moveto are linetos
+            position += 2
+        elif command == "L":
+            points.append((float(tokens[position]), float(tokens[position + 1])))
+            position += 2
+        elif command == "C":
+            controls = np.array([float(value) for value in tokens[position : position + 6]]).reshape(3, 2)
+            start, (first, second, end) = np.array(points[-1]), controls
+            curve = (
+                (1 - steps) ** 3 * start
+                + 3 * (1 - steps) ** 2 * steps * first
+                + 3 * (1 - steps) * steps**2 * second
+                + steps**3 * end
+            )
+            points.extend(map(tuple, curve.tolist()))
+            position += 6
+        else:
+            raise ValueError(f"Unsupported path command {command!r}")
+    if points:
+        subpaths.append((points, False))
+    return subpaths
+
+
+def simplify(points, tolerance):
+    """
+    Douglas-Peucker: drop every point closer than ``tolerance`` to the line
+    between the points kept around it. The endpoints are always kept.
+    """
+    points = np.asarray(points, dtype=float)
+    keep = np.zeros(len(points), dtype=bool)
+    keep[[0, -1]] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        inner = points[start + 1 : end]
+        origin, direction = points[start], points[end] - points[start]
+        length = np.hypot(*direction)
+        if length:
+            distances = np.abs(direction[0] * (inner[:, 1] - origin[1]) - direction[1] * (inner[:, 0] - origin[0]))
+            distances /= length
+        else:
+            # A closed ring starts and ends on the same point
+            distances = np.hypot(*(inner - origin).T)
+        farthest = int(distances.argmax())
+        if distances[farthest] > tolerance:
+            index = start + 1 + farthest
+            keep[index] = True
+            stack += [(start, index), (index, end)]
+    return points[keep]
+
+
+def quantize(points, grid):
+    """Snap points to multiples of ``grid`` (in grid units), dropping repeated points."""
+    units = np.round(np.asarray(points) / grid).astype(np.int64)
+    repeated = np.zeros(len(units), dtype=bool)
+    repeated[1:] = (units[1:] == units[:-1]).all(axis=1)
+    return units[~repeated]
+
+
+def simplify_subpath(points, closed, tolerance, grid):
+    """Simplified, quantized subpath in grid units; closed rings keep at least a triangle."""
+    if closed and points[0] != points[-1]:
+        points = [*points, points[0]]
+    while True:
+        units = quantize(simplify(points, tolerance), grid)
+        if not closed or len(units) >= 4 or tolerance < grid / 4:
+            return units
+        # Small islands would collapse at this tolerance
+        tolerance /= 2
+
+
+def _number(value, decimals):
+    text = f"{value:.{decimals}f}"
+    if "." in text:
+        text = text.rstrip("0").rstrip(".")
+    if text in ("-0", ""):
+        return "0"
+    return text.replace("0.", ".", 1) if text.startswith(("0.", "-0.")) else text
+
+
+def _numbers(values, decimals):
+    text = ""
+    for value in values:
+        number = _number(value, decimals)
+        # A minus sign already separates two numbers
+        text += number if not text or number.startswith("-") else " " + number
+    return text
+
+
+def encode_subpaths(subpaths, grid):
+    """
+    Compact SVG path data for quantized subpaths: an absolute moveto, then
+    relative linetos with as few characters as possible (``M12.5 40l.5-1 2 0z``).
+    """
+    decimals = max(0, -int(np.floor(np.log10(grid))))
+    parts = []
+    for units, closed in subpaths:
+        if closed and len(units) > 1 and (units[0] == units[-1]).all():
+            units = units[:-1]  # "z" draws the closing segment
+        parts.append("M" + _numbers(units[0] * grid, decimals))
+        if len(units) > 1:
+            parts.append("l" + _numbers((np.diff(units, axis=0) * grid).ravel(), decimals))
+        if closed:
+            parts.append("z")
+    return "".join(parts)
+
+
+def simplify_path(d, tolerance, grid):
+    subpaths = [
+        (simplify_subpath(points, closed, tolerance, grid), closed) for points, closed in parse_path(d)
+    ]
+    return encode_subpaths(subpaths, grid)
+
+
+def source_digest():
+    return hashlib.sha256(SOURCE_FILE.read_bytes()).hexdigest()
+
+
+@cache
+def load_source():
+    """The full-detail geometry: ``{"viewBox": ..., "layers": [{"name", "shapes": [{"key", "d"}]}]}``."""
+    return json.loads(SOURCE_FILE.read_text(encoding="utf-8"))
+
+
+def build_levels():
+    """Simplify the source geometry at every level of LEVELS."""
+    source = load_source()
+    levels = {}
+    for name, (tolerance, grid) in LEVELS.items():
+        layers = [
+            {
+                "name": layer["name"],
+                "shapes": [
+                    {"key": shape["key"], "d": simplify_path(shape["d"], tolerance, grid)} for shape in layer["shapes"]
+                ],
+            }
+            for layer in source["layers"]
+        ]
+        levels[name] = {"tolerance": tolerance, "grid": grid, "layers": layers}
+    return {"source": source_digest(), "levels": levels}
+
+
+@cache
+def load_levels():
+    """The levels stored by build_map_lods; rebuilt in memory if the file is missing or out of date."""
+    try:
+        stored = json.loads(LEVELS_FILE.read_text(encoding="utf-8"))
+    except FileNotFoundError:
+        stored = None
+    expected = {name: [tolerance, grid] for name, (tolerance, grid) in LEVELS.items()}
+    if stored is not None and stored.get("source") == source_digest():
+        levels = stored.get("levels", {})
+        if {name: [level["tolerance"], level["grid"]] for name, level in levels.items()} == expected:
+            return stored
+    logger.warning("%s is missing or out of date; run manage.py build_map_lods", LEVELS_FILE.name)
+    return build_levels()
+
+
+def map_layers(lod):
+    """Layers of the map at level of detail ``lod`` (one of LODS)."""
+    if lod == FULL:
+        return load_source()["layers"]
+    return load_levels()["levels"][lod]["layers"]
+
+
+def view_box():
+    return load_source()["viewBox"]
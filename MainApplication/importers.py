@@ -0,0 +1,485 @@
+import csv
+import datetime
+import hashlib
+import json
+import re
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from .caching import bump_scores_version
+from .names import SLUG_BY_NAME_KEY, normalize_name, split_city_path
+from .models import (
+    City,
+    CityFieldScore,
+    CityFieldScoreHistory,
+    FieldType,
+    check_history_date,
+    fill_child_paths,
+    fill_root_paths,
+    rebuild_city_summaries,
+)
+
+
+def coerce_score(value):
+    """Return ``value`` as an int in 1..100, or None when it is missing, fractional or out of range."""
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    if not number.is_integer() or not 1 <= number <= 100:
+        return None
+    return int(number)
+
+
+def parse_effective_at(value):
+    """Parse ``YYYY-MM-DD`` (start of that day) or an ISO datetime into an aware datetime."""
+    moment = parse_datetime(value)
+    if moment is None:
+        day = parse_date(value)
+        if day is None:
+            raise ValueError(f"Invalid date: {value}")
+        moment = datetime.datetime.combine(day, datetime.time.min)
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+def format_import_stats(stats):
+    """One-line summary of a ScoreWriter run for command output."""
+    return (
+        f"{stats['cities_created']} cities and {stats['fields_created']} field types created, "
+        f"{stats['scores_created']} scores created, {stats['scores_updated']} updated, "
+        f"{stats['scores_unchanged']} unchanged, {stats['scores_skipped']} changed but kept "
+        f"(use --update), {stats['scores_superseded']} older than the current scores (history only), "
+        f"{stats['skipped']} invalid cells skipped"
+    )
+
+
+class CityResolver:
+    """
+    In-memory lookup of city ids by parent and normalize_name(), loaded with one query.
+
+    A plain name resolves among the top-level cities only, and a path
+    ``"province/county/town"`` (see split_city_path()) one step at a time
+    under the unit before it, so a county named like its province ("قم/قم")
+    is its own unit. Every spelling of a known city ("چهارمحال و بختیاری",
+    "چهارمحال بختیاری", Arabic ي/ك, ZWNJ) resolves with dict hits; names
+    that do not resolve are created in bulk with their name_key, parent and
+    (top-level) map slug already set, the oldest of duplicate spellings
+    winning as in get_export_cities().
+    """
+
+    def __init__(self, city_type=City.CityType.city):
+        self.city_type = city_type
+        self.ids = {}
+        self.slugs = set()
+        # Newest first, so the oldest of any duplicate spellings ends up in the dict
+        for city_id, parent_id, name_key, slug in City.objects.order_by("-id").values_list(
+            "id", "parent_id", "name_key", "slug"
+        ):
+            self.ids[(parent_id, name_key)] = city_id
+            if slug:
+                self.slugs.add(slug)
+
+    def get(self, name):
+        return self._resolve(key for _, key in split_city_path(name))
+
+    def _resolve(self, keys):
+        city_id = None
+        for key in keys:
+            city_id = self.ids.get((city_id, key))
+            if city_id is None:
+                return None
+        return city_id
+
+    def create_missing(self, names, batch_size=1000):
+        """Create every unit on the names' paths that does not resolve yet; returns how many were created."""
+        paths = [split_city_path(name) for name in names]
+        created = 0
+        for depth in range(max(map(len, paths), default=0)):
+            missing = {}
+            for steps in paths:
+                if len(steps) > depth:
+                    parent_id = self._resolve(key for _, key in steps[:depth])
+                    name, key = steps[depth]
+                    if (parent_id, key) not in self.ids:
+                        missing.setdefault((parent_id, key), name)
+            if missing:
+                self._create(missing, depth, batch_size)
+                created += len(missing)
+        return created
+
+    def _create(self, missing, depth, batch_size):
+        # Provinces (of self.city_type), then counties, then towns
+        city_type = self.city_type if depth == 0 else City.CityType.county if depth == 1 else City.CityType.town
+        cities = []
+        for (parent_id, key), name in missing.items():
+            slug = SLUG_BY_NAME_KEY.get(key) if parent_id is None else None
+            if slug in self.slugs:
+                slug = None
+            elif slug:
+                self.slugs.add(slug)
+            cities.append(City(name=name, name_key=key, parent_id=parent_id, slug=slug, city_type=city_type))
+        City.objects.bulk_create(cities, batch_size=batch_size)
+        # Bulk inserts skip MainApplication.signals, which would give each new unit its path
+        if depth == 0:
+            fill_root_paths()
+        else:
+            fill_child_paths()
+        # Re-read ids instead of relying on bulk_create returning primary keys
+        parents = {parent_id for parent_id, _ in missing}
+        created = City.objects.filter(name_key__in={key for _, key in missing}).filter(
+            Q(parent__isnull=True) if depth == 0 else Q(parent_id__in=parents)
+        )
+        for city_id, parent_id, name_key in created.order_by("-id").values_list("id", "parent_id", "name_key"):
+            if (parent_id, name_key) in missing:
+                self.ids[(parent_id, name_key)] = city_id
+
+
+class ScoreWriter:
+    """
+    Batched writer for (city name, field name, score) cells.
+
+    Cities and field types are preloaded into dicts keyed by normalize_name()
+    (see CityResolver) and missing ones are created with ``bulk_create``, so
+    importing N cells costs a handful of queries per batch instead of three
+    ``get_or_create`` calls per cell, and spelling variants never create
+    duplicates.
+    Scores are upserted against the (city, field) unique constraint; existing
+    values are left alone unless ``update`` is set. Bulk writes skip
+    model signals, so every written value is appended to CityFieldScoreHistory
+    at ``effective_at`` here, and ``close()`` rebuilds the summaries of every
+    touched city and bumps the scores version once at the end. Callers own the
+    transaction.
+
+    A cell dated before the newest history of its (city, field), such as a
+    month that arrives late, only goes into the history: the current score
+    stays the newer one. ``effective_at`` may not fall before a ScoreSnapshot
+    (ValueError, see check_history_date()).
+    """
+
+    def __init__(self, update=False, batch_size=1000, city_type=City.CityType.city, effective_at=None):
+        self.update = update
+        self.effective_at = effective_at or timezone.now()
+        check_history_date(self.effective_at)
+        self.batch_size = batch_size
+        self.cities = CityResolver(city_type)
+        self.field_ids = {normalize_name(name): field_id for field_id, name in FieldType.objects.values_list("id", "name")}
+        self.stats = Counter()
+        self.touched_city_ids = set()
+        self._pending = {}
+
+    def add(self, city_name, field_name, value):
+        score = coerce_score(value)
+        if score is None:
+            self.stats["skipped"] += 1
+            return
+        # A later cell for the same pair wins, like sequential updates would
+        self._pending[(city_name, field_name)] = score
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def add_many(self, cells):
+        for city_name, field_name, value in cells:
+            self.add(city_name, field_name, value)
+
+    def flush(self):
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+
+        self.stats["cities_created"] += self.cities.create_missing({city for city, _ in pending}, self.batch_size)
+        self._create_missing_fields({field for _, field in pending})
+
+        rows = {
+            (self.cities.get(city), self.field_ids[normalize_name(field)]): score
+            for (city, field), score in pending.items()
+        }
+        city_ids = {city_id for city_id, _ in rows}
+        field_ids = {field_id for _, field_id in rows}
+        # Only needed to skip unchanged rows and report counts; the writes below
+        # rely on the (city, field) unique constraint, not on this snapshot
+        existing = {
+            (city_id, field_id): score
+            for city_id, field_id, score in CityFieldScore.objects.filter(
+                city_id__in=city_ids, field_id__in=field_ids
+            ).values_list("city_id", "field_id", "score")
+        }
+        # Pairs whose current value (or deletion) is dated after this import's values
+        superseded = set(
+            CityFieldScoreHistory.objects.filter(
+                city_id__in=city_ids, field_id__in=field_ids, effective_at__gt=self.effective_at
+            )
+            .values_list("city_id", "field_id")
+            .distinct()
+        )
+
+        to_create, to_update, history_only = [], [], []
+        for (city_id, field_id), score in rows.items():
+            current = existing.get((city_id, field_id))
+            if (city_id, field_id) in superseded:
+                history_only.append(CityFieldScore(city_id=city_id, field_id=field_id, score=score))
+                self.stats["scores_superseded"] += 1
+                continue
+            if current is None:
+                to_create.append(CityFieldScore(city_id=city_id, field_id=field_id, score=score))
+            elif current == score:
+                self.stats["scores_unchanged"] += 1
+                continue
+            elif self.update:
+                to_update.append(CityFieldScore(city_id=city_id, field_id=field_id, score=score))
+            else:
+                self.stats["scores_skipped"] += 1
+                continue
+            self.touched_city_ids.add(city_id)
+
+        if self.update:
+            CityFieldScore.objects.bulk_create(
+                to_create + to_update,
+                batch_size=self.batch_size,
+                update_conflicts=True,
+                unique_fields=["city", "field"],
+                update_fields=["score"],
+            )
+        elif to_create:
+            CityFieldScore.objects.bulk_create(to_create, batch_size=self.batch_size, ignore_conflicts=True)
+            # A concurrent writer may have inserted some pairs first; those were ignored and get no history
+            live = set(
+                CityFieldScore.objects.filter(
+                    city_id__in={score.city_id for score in to_create},
+                    field_id__in={score.field_id for score in to_create},
+                ).values_list("city_id", "field_id", "score")
+            )
+            inserted = [score for score in to_create if (score.city_id, score.field_id, score.score) in live]
+            self.stats["scores_skipped"] += len(to_create) - len(inserted)
+            to_create = inserted
+        CityFieldScoreHistory.objects.bulk_create(
+            [
+                CityFieldScoreHistory(
+                    city_id=score.city_id, field_id=score.field_id, score=score.score, effective_at=self.effective_at
+                )
+                for score in to_create + to_update + history_only
+            ],
+            batch_size=self.batch_size,
+        )
+        self.stats["scores_created"] += len(to_create)
+        self.stats["scores_updated"] += len(to_update)
+
+    def close(self):
+        self.flush()
+        if self.touched_city_ids or self.stats["cities_created"] or self.stats["fields_created"]:
+            rebuild_city_summaries(self.touched_city_ids)
+            bump_scores_version()
+        return self.stats
+
+    def _create_missing_fields(self, names):
+        missing = {}
+        for name in names:
+            key = normalize_name(name)
+            if key not in self.field_ids:
+                missing.setdefault(key, name)
+        if not missing:
+            return
+        FieldType.objects.bulk_create([FieldType(name=name) for name in missing.values()], batch_size=self.batch_size)
+        # Re-read ids instead of relying on bulk_create returning primary keys
+        created = dict(FieldType.objects.filter(name__in=missing.values()).values_list("name", "id"))
+        self.field_ids.update((key, created[name]) for key, name in missing.items())
+        self.stats["fields_created"] += len(missing)
+
+
+def _iter_csv_rows(path):
+    # utf-8-sig strips the BOM that sample_maker writes for Excel compatibility
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        yield from csv.reader(f)
+
+
+def _iter_xlsx_rows(path):
+    from openpyxl import load_workbook
+
+    # read_only streams rows from the sheet XML instead of building the whole workbook
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        yield from workbook.active.iter_rows(values_only=True)
+    finally:
+        workbook.close()
+
+
+ROW_READERS = {
+    ".csv": _iter_csv_rows,
+    ".xlsx": _iter_xlsx_rows,
+    ".xlsm": _iter_xlsx_rows,
+}
+
+
+def iter_score_cells(path):
+    """
+    Yield (city name, field name, value) from a CSV/XLSX score sheet.
+
+    The sheet has provinces as columns and metrics as rows (the layout written
+    by sample_maker). Rows are read one at a time and turned into cells, so the
+    file is never loaded or transposed in memory.
+    """
+    reader = ROW_READERS.get(Path(path).suffix.lower())
+    if reader is None:
+        raise ValueError(f"Unsupported file type: {path}")
+
+    rows = reader(path)
+    header = next(rows, None)
+    if header is None:
+        return
+    cities = [str(name).strip() if name is not None else "" for name in header[1:]]
+    for row in rows:
+        if not row or row[0] is None or not str(row[0]).strip():
+            continue
+        field_name = str(row[0]).strip()
+        for city_name, value in zip(cities, row[1:]):
+            if city_name:
+                yield city_name, field_name, value
+
+
+def _iter_matrix_cells(cities, fields, scores):
+    # Columnar files use 0 for "no score", so only non-zero cells are yielded
+    for city_name, row in zip(cities, scores):
+        for index, score in enumerate(row):
+            if score:
+                yield city_name, fields[index], int(score)
+
+
+def iter_converted_cells(path):
+    """
+    Yield (city name, field name, value) from a json_converter output file:
+    nested ``{city: {field: score}}`` JSON, columnar JSON or ``.npz``.
+    """
+    if Path(path).suffix.lower() == ".npz":
+        import numpy as np
+
+        with np.load(path) as data:
+            yield from _iter_matrix_cells(data["cities"].tolist(), data["fields"].tolist(), data["scores"])
+        return
+
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    if isinstance(data.get("cities"), list) and isinstance(data.get("scores"), list):
+        yield from _iter_matrix_cells(data["cities"], data["fields"], data["scores"])
+        return
+    for city_name, fields in data.items():
+        for field_name, score in fields.items():
+            yield city_name, field_name, score
+
+
+# Batch ingest (the ingest_scores command): files are hashed and parsed in worker
+# processes, and the parsed cells are written by the one process that holds the
+# database connection, a file per transaction, in path order.
+
+INGEST_SUFFIXES = (*ROW_READERS, ".json", ".npz")
+_PATH_DATE = re.compile(r"(?<!\d)(\d{4})-(\d{2})(?:-(\d{2}))?(?!\d)")
+
+
+def find_score_files(paths):
+    """Expand files and directories (searched recursively) into a sorted list of score files."""
+    found = set()
+    for path in map(Path, paths):
+        if path.is_dir():
+            found.update(
+                child for child in path.rglob("*")
+                if child.is_file() and child.suffix.lower() in INGEST_SUFFIXES and not child.name.startswith((".", "~$"))
+            )
+        else:
+            found.add(path)
+    return sorted(found)
+
+
+def effective_at_from_path(path):
+    """
+    The last ``YYYY-MM`` or ``YYYY-MM-DD`` in a path (``2024-03/tehran.xlsx``,
+    ``scores-2024-03-15.csv``) as the start of that month or day, or None.
+    """
+    matches = _PATH_DATE.findall(str(path))
+    if not matches:
+        return None
+    year, month, day = matches[-1]
+    try:
+        moment = datetime.datetime(int(year), int(month), int(day or 1))
+    except ValueError:
+        return None
+    return timezone.make_aware(moment)
+
+
+def manifest_path(path):
+    """The IngestedFile.path of a file: absolute, so the same file matches from any working directory."""
+    return str(Path(path).resolve())[-500:]
+
+
+def file_sha256(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def parse_score_file(path, known_hashes=frozenset()):
+    """
+    Hash and parse one file: ``(sha256, size, cells)`` with ``cells`` as a list
+    of (city name, field name, value), or None when the hash is in
+    ``known_hashes`` (those already ingested from this path), so unchanged
+    files are never parsed. Module-level so it
+    can run in a worker process.
+    """
+    path = Path(path)
+    sha256 = file_sha256(path)
+    if sha256 in known_hashes:
+        return sha256, path.stat().st_size, None
+    if path.suffix.lower() in ROW_READERS:
+        cells = list(iter_score_cells(path))
+    else:
+        cells = list(iter_converted_cells(path))
+    return sha256, path.stat().st_size, cells
+
+
+def iter_parsed_files(paths, manifest=None, jobs=1):
+    """
+    Yield ``(path, result, error)`` for every path in order, where ``result`` is
+    parse_score_file()'s. ``manifest`` maps manifest_path() to the hashes
+    already ingested from that path. With ``jobs > 1`` up to ``2 * jobs`` files are parsed
+    ahead in worker processes, so parsing overlaps with the caller's writes
+    while memory stays bounded.
+    """
+    manifest = manifest or {}
+
+    def known_hashes(path):
+        return frozenset(manifest.get(manifest_path(path), ()))
+
+    if jobs <= 1:
+        for path in paths:
+            try:
+                yield path, parse_score_file(path, known_hashes(path)), None
+            except Exception as exc:
+                yield path, None, exc
+        return
+
+    pending = deque()
+    paths = iter(paths)
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        try:
+            while True:
+                for path in paths:
+                    pending.append((path, executor.submit(parse_score_file, path, known_hashes(path))))
+                    if len(pending) >= 2 * jobs:
+                        break
+                if not pending:
+                    return
+                path, future = pending.popleft()
+                try:
+                    yield path, future.result(), None
+                except Exception as exc:
+                    yield path, None, exc
+        finally:
+            # Stopped early (an error or Ctrl-C in the caller): do not parse the files queued ahead
+            for _, future in pending:
+                future.cancel()
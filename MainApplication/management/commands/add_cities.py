@@ -1,5 +1,6 @@
 from django.core.management.base import BaseCommand
 from MainApplication.models import City
+from MainApplication.names import normalize_name
 
 class Command(BaseCommand):
     help = "Populate the database with initial cities and islands"
@@ -57,13 +58,14 @@ class Command(BaseCommand):
         ]
 
         # اضافه کردن استان‌ها و جزایر به دیتابیس
+        # Matched on name_key among top-level cities, so an existing "چهارمحال و بختیاری" is not added
+        # again and a county of the same name neither counts nor gets in the way
         for item in provinces + islands:
-            City.objects.get_or_create(
-                name=item["name"],
-                defaults={
-                    "population": item["population"],
-                    "is_capital": item["is_capital"]
-                }
-            )
+            if not City.objects.filter(name_key=normalize_name(item["name"]), parent__isnull=True).exists():
+                City.objects.create(
+                    name=item["name"],
+                    population=item["population"],
+                    is_capital=item["is_capital"]
+                )
 
         self.stdout.write(self.style.SUCCESS("All provinces and islands have been added to the database!"))
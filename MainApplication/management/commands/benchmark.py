@@ -0,0 +1,170 @@
+import datetime
+import json
+import platform
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+from MainApplication.benchmarks import compare_results, parse_dataset, run_benchmarks, run_concurrency_benchmarks
+
+# Benchmarks never share the configured cache (it may be a shared Redis/Memcached)
+BENCHMARK_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'benchmark',
+    }
+}
+
+
+class Command(BaseCommand):
+    help = "Measure views, admin changelists and import commands on synthetic datasets in a throwaway test database"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dataset',
+            action='append',
+            dest='datasets',
+            help='CITIESxFIELDS to seed, repeatable (default: 45x30; e.g. 500x300, 5000x300)',
+        )
+        parser.add_argument(
+            '--scenario',
+            action='append',
+            dest='scenarios',
+            help='Only run these scenarios (main, city_detail, admin:score_changelist, sql_converter, ...)',
+        )
+        parser.add_argument('--repeat', type=int, default=5, help='Timed runs per scenario')
+        parser.add_argument('--warmup', type=int, default=1, help='Untimed runs before timing')
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=0,
+            help='Instead of the single-request scenarios, compare WSGI and ASGI throughput '
+                 'with this many requests in flight (scenarios: main, city_detail, chat)',
+        )
+        parser.add_argument('--requests', type=int, default=200, help='Requests per scenario with --concurrency')
+        parser.add_argument(
+            '--upstream-latency',
+            type=float,
+            default=50,
+            help='Milliseconds the stand-in chat upstream takes to answer with --concurrency',
+        )
+        parser.add_argument('--seed', type=int, default=0, help='Random seed for the synthetic scores')
+        parser.add_argument('--output', type=str, help='Write the results JSON to this file (default: stdout)')
+        parser.add_argument(
+            '--compare',
+            nargs='+',
+            metavar='RESULTS',
+            help='Baseline results JSON; with a second file, compare the two files without running',
+        )
+        parser.add_argument(
+            '--threshold',
+            type=float,
+            default=0.2,
+            help='Relative growth that counts as a regression (0.2 = 20%%)',
+        )
+        parser.add_argument(
+            '--noinput', '--no-input',
+            action='store_false',
+            dest='interactive',
+            help='Do not prompt before destroying a leftover test database',
+        )
+
+    def handle(self, *args, **options):
+        compare = options['compare'] or []
+        if len(compare) > 2:
+            raise CommandError("--compare takes a baseline and at most one results file")
+        baseline = self.load_results(compare[0]) if compare else None
+
+        if len(compare) == 2:
+            results = self.load_results(compare[1])
+        else:
+            try:
+                datasets = [parse_dataset(value) for value in options['datasets'] or ['45x30']]
+            except ValueError as exc:
+                raise CommandError(str(exc))
+            if options['repeat'] < 1:
+                raise CommandError("--repeat must be at least 1")
+            if options['concurrency'] < 0 or options['requests'] < 1:
+                raise CommandError("--concurrency must not be negative and --requests must be at least 1")
+            results = self.run(datasets, options)
+            output = json.dumps(results, ensure_ascii=False, indent=2)
+            if options['output']:
+                with open(options['output'], 'w', encoding='utf-8') as f:
+                    f.write(output + "\n")
+                self.stdout.write(self.style.SUCCESS(f"Results written to {options['output']}"))
+            elif baseline is None:
+                self.stdout.write(output)
+
+        if baseline is not None:
+            self.report(compare_results(baseline, results, options['threshold']), options['threshold'])
+
+    def run(self, datasets, options):
+        setup_test_environment()
+        # Seeds and measures in a fresh test database; the real one is never touched
+        old_name = connection.creation.create_test_db(
+            verbosity=0, autoclobber=not options['interactive'], serialize=False
+        )
+        try:
+            # Only the default alias gets a test database, so replica routing (which would read
+            # the configured replica instead) is switched off for the run
+            with override_settings(CACHES=BENCHMARK_CACHES, DATABASE_REPLICA=None):
+                if options['concurrency']:
+                    results = run_concurrency_benchmarks(
+                        datasets,
+                        concurrency=options['concurrency'],
+                        requests=options['requests'],
+                        upstream_latency=options['upstream_latency'] / 1000,
+                        scenarios=options['scenarios'],
+                        seed=options['seed'],
+                        log=self.stderr.write,
+                    )
+                else:
+                    results = run_benchmarks(
+                        datasets,
+                        scenarios=options['scenarios'],
+                        repeat=options['repeat'],
+                        warmup=options['warmup'],
+                        seed=options['seed'],
+                        log=self.stderr.write,
+                    )
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+        return {
+            "meta": {
+                "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+                "python": platform.python_version(),
+                "django": django.get_version(),
+                "database": connection.vendor,
+                "repeat": options['repeat'],
+                "concurrency": options['concurrency'],
+                "seed": options['seed'],
+            },
+            "results": results,
+        }
+
+    def load_results(self, path):
+        try:
+            with open(path, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError) as exc:
+            raise CommandError(f"Cannot read benchmark results {path}: {exc}")
+
+    def report(self, rows, threshold):
+        if not rows:
+            self.stdout.write(self.style.WARNING("No common dataset/scenario pairs to compare"))
+            return
+        regressions = 0
+        for dataset, scenario, metric, old, new, change, regressed in rows:
+            line = f"{dataset} {scenario} {metric}: {old} -> {new} ({change:+.1%})"
+            if regressed:
+                regressions += 1
+                self.stdout.write(self.style.ERROR(f"REGRESSION {line}"))
+            elif change < -threshold:
+                self.stdout.write(self.style.SUCCESS(f"improved   {line}"))
+            else:
+                self.stdout.write(f"           {line}")
+        if regressions:
+            raise CommandError(f"{regressions} metric(s) regressed by more than {threshold:.0%}")
+        self.stdout.write(self.style.SUCCESS("No regressions"))
@@ -0,0 +1,38 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from MainApplication import geometry
+
+
+class Command(BaseCommand):
+    help = "Simplify the map outlines (map_data/iran.json) into the levels of detail served with the map"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check',
+            action='store_true',
+            help='Only verify that map_data/iran.lods.json matches the source geometry, do not write it',
+        )
+
+    def handle(self, *args, **options):
+        levels = geometry.build_levels()
+        content = json.dumps(levels, ensure_ascii=False, indent=1) + "\n"
+
+        if options['check']:
+            try:
+                stored = geometry.LEVELS_FILE.read_text(encoding="utf-8")
+            except FileNotFoundError:
+                stored = None
+            if stored != content:
+                raise CommandError(f"{geometry.LEVELS_FILE.name} is out of date; run manage.py build_map_lods")
+            self.stdout.write(self.style.SUCCESS(f"{geometry.LEVELS_FILE.name} is up to date"))
+            return
+
+        geometry.LEVELS_FILE.write_text(content, encoding="utf-8")
+        geometry.load_levels.cache_clear()
+        full_size = sum(len(shape["d"]) for layer in geometry.map_layers(geometry.FULL) for shape in layer["shapes"])
+        self.stdout.write(f"{geometry.FULL}: {full_size} bytes of path data")
+        for name, level in levels["levels"].items():
+            size = sum(len(shape["d"]) for layer in level["layers"] for shape in layer["shapes"])
+            self.stdout.write(f"{name}: {size} bytes of path data (tolerance {level['tolerance']}, grid {level['grid']})")
+        self.stdout.write(self.style.SUCCESS(f"Wrote {geometry.LEVELS_FILE}"))
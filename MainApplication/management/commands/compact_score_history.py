@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+from MainApplication.importers import parse_effective_at
+from MainApplication.models import CityFieldScoreHistory, take_score_snapshot
+
+
+class Command(BaseCommand):
+    help = "Store a ScoreSnapshot so as-of lookups only replay history recorded after it"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--at',
+            type=str,
+            help='Date (YYYY-MM-DD) or ISO datetime to snapshot (default: now)',
+        )
+        parser.add_argument(
+            '--prune',
+            action='store_true',
+            help='Delete history rows covered by the snapshot (older dates then resolve to the snapshot)',
+        )
+
+    def handle(self, *args, **options):
+        when = None
+        if options['at']:
+            try:
+                when = parse_effective_at(options['at'])
+            except ValueError as exc:
+                raise CommandError(str(exc))
+
+        snapshot, count = take_score_snapshot(when)
+        self.stdout.write(self.style.SUCCESS(f"Snapshot {snapshot} stores {count} scores"))
+
+        if options['prune']:
+            deleted, _ = CityFieldScoreHistory.objects.filter(effective_at__lte=snapshot.taken_at).delete()
+            self.stdout.write(self.style.SUCCESS(f"Pruned {deleted} history rows"))
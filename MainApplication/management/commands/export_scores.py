@@ -0,0 +1,74 @@
+import time
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+from MainApplication.exporters import EXPORT_CHUNK_SIZE, iter_csv, iter_export_rows, parse_city_type, write_xlsx
+from MainApplication.routers import reading_from_replica
+from MainApplication.views import parse_as_of
+
+
+class Command(BaseCommand):
+    help = "Export the cities x fields score matrix as CSV or XLSX (the import_scores layout)"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'output',
+            help='Output file ending in .csv or .xlsx, or - to write CSV to stdout',
+        )
+        parser.add_argument(
+            '--as-of',
+            type=str,
+            help='Export the scores as they were at this date (YYYY-MM-DD, end of day) or ISO datetime',
+        )
+        parser.add_argument(
+            '--city-type',
+            type=str,
+            help='Only export cities of this type: city, island, county or town',
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=EXPORT_CHUNK_SIZE,
+            help='Number of score rows fetched from the database cursor at a time',
+        )
+
+    def handle(self, *args, **options):
+        output = options['output']
+        suffix = '.csv' if output == '-' else Path(output).suffix.lower()
+        if suffix not in ('.csv', '.xlsx'):
+            raise CommandError(f"Unsupported file type: {output}")
+        try:
+            as_of = parse_as_of(options['as_of']) if options['as_of'] else None
+            city_type = parse_city_type(options['city_type']) if options['city_type'] else None
+        except ValueError as exc:
+            raise CommandError(str(exc))
+
+        started = time.perf_counter()
+        fields = 0
+
+        def counted(rows):
+            nonlocal fields
+            for row in rows:
+                yield row
+                fields += 1
+
+        # A long read-only scan: leave the primary alone when there is a replica
+        with reading_from_replica():
+            try:
+                rows = iter_export_rows(as_of, city_type, options['chunk_size'])
+            except ValueError as exc:
+                raise CommandError(str(exc))
+            if suffix == '.xlsx':
+                write_xlsx(counted(rows), output)
+            elif output == '-':
+                for chunk in iter_csv(counted(rows)):
+                    self.stdout.write(chunk, ending='')
+            else:
+                with open(output, 'w', newline='', encoding='utf-8') as f:
+                    f.writelines(iter_csv(counted(rows)))
+
+        if output != '-':
+            elapsed = time.perf_counter() - started
+            self.stdout.write(self.style.SUCCESS(
+                f"Exported {max(fields - 1, 0)} fields to {output} in {elapsed:.2f}s"
+            ))
@@ -0,0 +1,73 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from MainApplication.importers import (
+    ROW_READERS,
+    ScoreWriter,
+    format_import_stats,
+    iter_score_cells,
+    parse_effective_at,
+)
+from MainApplication.models import check_history_date
+
+
+class Command(BaseCommand):
+    help = "Stream city scores from CSV/XLSX files straight into the database"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'files',
+            nargs='+',
+            help='CSV or XLSX files with provinces as columns and metrics as rows',
+        )
+        parser.add_argument(
+            '--update',
+            action='store_true',
+            help='Overwrite existing scores whose value changed (default: keep them)',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Number of score cells written per bulk query',
+        )
+        parser.add_argument(
+            '--effective-at',
+            type=str,
+            help='Date (YYYY-MM-DD) or ISO datetime the imported values are valid from (default: now)',
+        )
+
+    def handle(self, *args, **options):
+        for file_path in options['files']:
+            if not file_path.lower().endswith(tuple(ROW_READERS)):
+                raise CommandError(f"Unsupported file type: {file_path}")
+        effective_at = None
+        if options['effective_at']:
+            try:
+                effective_at = parse_effective_at(options['effective_at'])
+                check_history_date(effective_at)
+            except ValueError as exc:
+                raise CommandError(str(exc))
+
+        for file_path in options['files']:
+            started = time.perf_counter()
+            cells = 0
+            # One transaction per file: a broken file does not leave a partial import behind
+            with transaction.atomic():
+                writer = ScoreWriter(
+                    update=options['update'],
+                    batch_size=options['batch_size'],
+                    effective_at=effective_at,
+                )
+                for city_name, field_name, value in iter_score_cells(file_path):
+                    writer.add(city_name, field_name, value)
+                    cells += 1
+                stats = writer.close()
+            elapsed = time.perf_counter() - started
+            rate = cells / elapsed if elapsed else 0
+
+            self.stdout.write(self.style.SUCCESS(
+                f"Imported {file_path}: {cells} cells in {elapsed:.2f}s ({rate:,.0f} rows/sec); "
+                f"{format_import_stats(stats)}"
+            ))
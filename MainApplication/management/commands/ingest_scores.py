@@ -0,0 +1,158 @@
+import os
+import time
+from collections import Counter, defaultdict
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from MainApplication.importers import (
+    ScoreWriter,
+    effective_at_from_path,
+    find_score_files,
+    format_import_stats,
+    iter_parsed_files,
+    manifest_path,
+    parse_effective_at,
+)
+from MainApplication.models import IngestedFile, check_history_date
+
+
+class Command(BaseCommand):
+    help = (
+        "Ingest directories of score files (CSV/XLSX sheets, json_converter output) in parallel; "
+        "files already ingested are skipped, so an interrupted run resumes where it stopped"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'paths',
+            nargs='+',
+            help='Files and directories (searched recursively) to ingest',
+        )
+        parser.add_argument(
+            '--jobs',
+            type=int,
+            default=min(os.cpu_count() or 1, 8),
+            help='Worker processes that hash and parse files (default: CPU count, at most 8)',
+        )
+        parser.add_argument(
+            '--update',
+            action='store_true',
+            help='Overwrite existing scores whose value changed (default: keep them)',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Number of score cells written per bulk query',
+        )
+        dates = parser.add_mutually_exclusive_group()
+        dates.add_argument(
+            '--effective-at',
+            type=str,
+            help='Date (YYYY-MM-DD) or ISO datetime all imported values are valid from (default: now)',
+        )
+        dates.add_argument(
+            '--date-from-path',
+            action='store_true',
+            help='Take each file\'s date from a YYYY-MM or YYYY-MM-DD in its path (e.g. 2024-03/tehran.xlsx)',
+        )
+        parser.add_argument(
+            '--keep-going',
+            action='store_true',
+            help='Continue past unreadable files (default: stop, so files are always applied in path order)',
+        )
+        parser.add_argument(
+            '--force',
+            action='store_true',
+            help='Ingest files again even if their content was ingested before',
+        )
+
+    def handle(self, *args, **options):
+        effective_at = None
+        if options['effective_at']:
+            try:
+                effective_at = parse_effective_at(options['effective_at'])
+                check_history_date(effective_at)
+            except ValueError as exc:
+                raise CommandError(str(exc))
+
+        files = find_score_files(options['paths'])
+        missing = [path for path in files if not path.is_file()]
+        if missing:
+            raise CommandError(f"File not found: {missing[0]}")
+        if options['date_from_path']:
+            undated = [path for path in files if effective_at_from_path(path) is None]
+            if undated:
+                raise CommandError(f"No YYYY-MM date in the path of {undated[0]}")
+            try:
+                if files:
+                    check_history_date(min(effective_at_from_path(path) for path in files))
+            except ValueError as exc:
+                raise CommandError(str(exc))
+
+        # The manifest: the content hashes ingested so far from each path. Keyed by path as well
+        # as content, so a month whose file matches an earlier month's is still ingested
+        known = defaultdict(set)
+        if not options['force']:
+            for path, sha256 in IngestedFile.objects.values_list('path', 'sha256'):
+                known[path].add(sha256)
+        totals, counts = Counter(), Counter()
+        failures = []
+        reached = 0
+        started = time.perf_counter()
+
+        for number, (path, result, error) in enumerate(
+            iter_parsed_files(files, {path: frozenset(hashes) for path, hashes in known.items()}, options['jobs']),
+            start=1,
+        ):
+            reached = number
+            prefix = f"[{number}/{len(files)}] {path}"
+            if error is not None:
+                failures.append(path)
+                self.stdout.write(self.style.ERROR(f"{prefix}: {error}"))
+                if options['keep_going']:
+                    continue
+                # Later files may hold newer values for the same scores; they wait for this one
+                break
+            sha256, size, cells = result
+            key = manifest_path(path)
+            # Checked here too: a path given twice in one run is only parsed ahead, not known yet
+            if cells is None or sha256 in known[key]:
+                counts['unchanged'] += 1
+                continue
+
+            file_started = time.perf_counter()
+            file_effective_at = effective_at_from_path(path) if options['date_from_path'] else effective_at
+            # One transaction per file, manifest row included: a file is either fully ingested and
+            # recorded, or neither, and a re-run continues with the first file not recorded
+            with transaction.atomic():
+                writer = ScoreWriter(
+                    update=options['update'],
+                    batch_size=options['batch_size'],
+                    effective_at=file_effective_at,
+                )
+                writer.add_many(cells)
+                stats = writer.close()
+                IngestedFile.objects.update_or_create(
+                    path=key,
+                    sha256=sha256,
+                    defaults={
+                        'size': size,
+                        'cells': len(cells),
+                        'effective_at': writer.effective_at,
+                    },
+                )
+            known[key].add(sha256)
+            totals.update(stats)
+            counts['ingested'] += 1
+            self.stdout.write(f"{prefix}: {len(cells)} cells in {time.perf_counter() - file_started:.2f}s")
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Ingested {counts['ingested']} files, skipped {counts['unchanged']} already ingested, "
+            f"{len(failures)} failed, {len(files) - reached} not reached, in {elapsed:.2f}s: {format_import_stats(totals)}"
+        ))
+        if failures:
+            raise CommandError(
+                f"{len(failures)} files could not be read; fix them and re-run to continue after the files ingested"
+            )
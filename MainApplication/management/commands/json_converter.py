@@ -1,40 +1,128 @@
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 import pandas as pd
 import json
 from django.core.management.base import BaseCommand
 
+FORMATS = ("json", "columnar-json", "npz")
+OUTPUT_SUFFIXES = {"json": ".json", "columnar-json": ".columnar.json", "npz": ".npz"}
+
+
+def read_score_frame(input_file):
+    """Read a sheet with metrics as rows and provinces as columns."""
+    if input_file.suffix.lower() == ".csv":
+        return pd.read_csv(input_file, index_col=0)
+    return pd.read_excel(input_file, index_col=0)
+
+
+def convert_file(input_file, output_file, output_format):
+    """
+    Convert one CSV/XLSX file and return ``(output path, invalid cells skipped)``.
+
+    ``json`` keeps the original ``{city: {field: score}}`` layout, and the
+    importers validate its cells. The columnar formats store a city list, a
+    field list and a dense uint8 matrix ``scores[city][field]`` (0 = missing), so
+    readers never build per-cell dicts; cells that importers.coerce_score would
+    reject (fractional, out of range or not a number) are left missing there
+    and counted. Module-level so it can run in a worker process.
+    """
+    df = read_score_frame(input_file)
+
+    if output_format == "json":
+        json_data = df.T.to_dict(orient="index")
+        with open(output_file, "w", encoding="utf-8") as f:
+            json.dump(json_data, f, ensure_ascii=False, indent=4)
+        return output_file, 0
+
+    import numpy as np
+
+    cities = [str(name) for name in df.columns]
+    fields = [str(name) for name in df.index]
+    values = df.apply(pd.to_numeric, errors="coerce").to_numpy(dtype="float64").T
+    valid = (values >= 1) & (values <= 100) & (values == np.floor(values))
+    skipped = int((df.notna().to_numpy().T & ~valid).sum())
+    scores = np.where(valid, values, 0).astype(np.uint8)
+
+    if output_format == "npz":
+        # Uncompressed so members load with a single read
+        np.savez(output_file, cities=np.array(cities), fields=np.array(fields), scores=scores)
+    else:
+        with open(output_file, "w", encoding="utf-8") as f:
+            json.dump(
+                {"cities": cities, "fields": fields, "scores": scores.tolist()},
+                f,
+                ensure_ascii=False,
+                separators=(",", ":"),
+            )
+    return output_file, skipped
+
+
+def output_path_for(input_file, output_format, output_dir=None):
+    # sample.xlsx -> sample_from_excel.json, sample.csv -> sample_from_csv.json
+    source = "csv" if input_file.suffix.lower() == ".csv" else "excel"
+    directory = Path(output_dir) if output_dir else input_file.parent
+    return directory / f"{input_file.stem}_from_{source}{OUTPUT_SUFFIXES[output_format]}"
+
+
 class Command(BaseCommand):
     help = 'Convert Excel and CSV files to JSON'
 
-    def handle(self, *args, **kwargs):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'inputs',
+            nargs='*',
+            help='Excel/CSV files to convert (default: sample.xlsx and sample.csv in the project root)',
+        )
+        parser.add_argument(
+            '--format',
+            choices=FORMATS,
+            default='json',
+            help='json (city -> field -> score), columnar-json or npz (city list, field list, uint8 matrix)',
+        )
+        parser.add_argument(
+            '--output-dir',
+            type=str,
+            help='Directory for the converted files (default: next to each input)',
+        )
+        parser.add_argument(
+            '--jobs',
+            type=int,
+            default=1,
+            help='Convert this many files in parallel worker processes',
+        )
+
+    def handle(self, *args, **options):
         # Project root (where manage.py is)
         BASE_DIR = Path(__file__).resolve().parent.parent.parent.parent  # go up 4 levels
 
-        excel_file = BASE_DIR / "sample.xlsx"
-        csv_file = BASE_DIR / "sample.csv"
-        json_file_from_excel = BASE_DIR / "sample_from_excel.json"
-        json_file_from_csv = BASE_DIR / "sample_from_csv.json"
+        if options['inputs']:
+            input_files = [Path(name) for name in options['inputs']]
+        else:
+            input_files = [BASE_DIR / "sample.xlsx", BASE_DIR / "sample.csv"]
 
         # Check if files exist first
-        if not excel_file.exists():
-            self.stdout.write(self.style.ERROR(f"Excel file not found: {excel_file}"))
-            return
-        if not csv_file.exists():
-            self.stdout.write(self.style.ERROR(f"CSV file not found: {csv_file}"))
-            return
-
-        # Convert Excel
-        df_excel = pd.read_excel(excel_file, index_col=0)
-        df_excel_transposed = df_excel.T
-        json_data_excel = df_excel_transposed.to_dict(orient="index")
-        with open(json_file_from_excel, "w", encoding="utf-8") as f:
-            json.dump(json_data_excel, f, ensure_ascii=False, indent=4)
-        self.stdout.write(self.style.SUCCESS(f"Excel converted to JSON: {json_file_from_excel}"))
-
-        # Convert CSV
-        df_csv = pd.read_csv(csv_file, index_col=0)
-        df_csv_transposed = df_csv.T
-        json_data_csv = df_csv_transposed.to_dict(orient="index")
-        with open(json_file_from_csv, "w", encoding="utf-8") as f:
-            json.dump(json_data_csv, f, ensure_ascii=False, indent=4)
-        self.stdout.write(self.style.SUCCESS(f"CSV converted to JSON: {json_file_from_csv}"))
+        for input_file in input_files:
+            if not input_file.exists():
+                self.stdout.write(self.style.ERROR(f"File not found: {input_file}"))
+                return
+
+        output_format = options['format']
+        jobs = [
+            (input_file, output_path_for(input_file, output_format, options['output_dir']), output_format)
+            for input_file in input_files
+        ]
+
+        if options['jobs'] > 1 and len(jobs) > 1:
+            with ProcessPoolExecutor(max_workers=options['jobs']) as executor:
+                results = executor.map(convert_file, *zip(*jobs))
+                for (input_file, _, _), (output_file, skipped) in zip(jobs, results):
+                    self.report(input_file, output_file, skipped)
+        else:
+            for job in jobs:
+                self.report(job[0], *convert_file(*job))
+
+    def report(self, input_file, output_file, skipped):
+        message = f"{input_file.name} converted: {output_file}"
+        if skipped:
+            message += f" ({skipped} invalid cells skipped)"
+        self.stdout.write(self.style.SUCCESS(message))
@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Avg
+from MainApplication.caching import bump_scores_version
+from MainApplication.models import City, CityFieldScore, CityScoreSummary, get_city_average_score, rebuild_city_summaries
+
+
+class Command(BaseCommand):
+    help = "Recompute CityScoreSummary rows from CityFieldScore in bulk"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check',
+            action='store_true',
+            help='Only compare stored summaries (and roll-ups) against the scores, do not rebuild',
+        )
+
+    def handle(self, *args, **options):
+        if options['check']:
+            self.check_summaries()
+            return
+
+        count = rebuild_city_summaries()
+        bump_scores_version()
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {count} city summaries"))
+
+    def check_summaries(self):
+        summaries = {summary.city_id: summary for summary in CityScoreSummary.objects.all()}
+        mismatches = 0
+        for city in City.objects.order_by('id'):
+            expected = round(get_city_average_score(city.id), 2)
+            summary = summaries.get(city.id)
+            stored = round(summary.avg_score, 2) if summary else 0
+            rollup = CityFieldScore.objects.filter(city__path__startswith=city.path).aggregate(Avg('score'))
+            expected_rollup = round(rollup['score__avg'] or 0, 2)
+            stored_rollup = round(summary.rollup_avg, 2) if summary else 0
+            if summary is None and expected == expected_rollup == 0:
+                continue
+            if summary is None or stored != expected or stored_rollup != expected_rollup:
+                mismatches += 1
+                self.stdout.write(self.style.WARNING(
+                    f"{city.name}: summary={stored} actual={expected}, "
+                    f"roll-up summary={stored_rollup} actual={expected_rollup}"
+                ))
+
+        if mismatches:
+            raise CommandError(f"{mismatches} city summaries are out of date, run rebuild_summaries")
+        self.stdout.write(self.style.SUCCESS("All city summaries are consistent"))
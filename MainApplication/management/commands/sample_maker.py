@@ -1,43 +1,124 @@
-from django.core.management.base import BaseCommand
+import time
 from pathlib import Path
-import pandas as pd
-import random
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+from MainApplication.samples import (
+    SAMPLE_FORMATS,
+    SAMPLE_SUFFIXES,
+    SampleGenerator,
+    load_sample,
+    sample_city_names,
+    sample_field_names,
+    sample_months,
+    write_sample,
+)
+
 
 class Command(BaseCommand):
-    help = 'Generate sample Excel and CSV files with random data'
+    help = 'Generate sample Excel and CSV files with random data, at any size, or load them into the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--cities', type=int, default=31, help='Number of cities (columns); the 31 provinces come first')
+        parser.add_argument('--fields', type=int, default=30, help='Number of fields (rows); the 30 sample metrics come first')
+        parser.add_argument(
+            '--periods',
+            type=int,
+            default=1,
+            help='Number of months; with more than one, each month is written to a YYYY-MM directory',
+        )
+        parser.add_argument(
+            '--end',
+            type=str,
+            help='Last month as YYYY-MM (default: this month)',
+        )
+        parser.add_argument(
+            '--seed',
+            type=int,
+            help='Seed for a reproducible dataset (default: a random one, printed so it can be reused)',
+        )
+        parser.add_argument(
+            '--missing',
+            type=float,
+            default=0.0,
+            help='Share of cells left empty, 0 to 1 (default: 0)',
+        )
+        parser.add_argument(
+            '--format',
+            action='append',
+            dest='formats',
+            choices=SAMPLE_FORMATS,
+            help='Output format, repeatable (default: xlsx and csv); json is json_converter\'s columnar layout',
+        )
+        parser.add_argument(
+            '--output-dir',
+            type=str,
+            help='Directory for the files (default: the project root)',
+        )
+        parser.add_argument('--name', type=str, default='sample', help='File name without suffix (default: sample)')
+        parser.add_argument(
+            '--to-db',
+            action='store_true',
+            help='Load the sample into the database instead of writing files: every month into the '
+                 'score history, the last one as the current scores',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=5000,
+            help='Number of rows per bulk insert with --to-db',
+        )
 
     def handle(self, *args, **kwargs):
         BASE_DIR = Path(__file__).resolve().parent.parent.parent.parent  # project root
 
-        excel_file = BASE_DIR / "sample.xlsx"
-        csv_file = BASE_DIR / "sample.csv"
-
-        # Define provinces and metrics
-        provinces = [
-            "آذربایجان شرقی", "آذربایجان غربی", "اردبیل", "اصفهان", "البرز", "ایلام",
-            "بوشهر", "تهران", "چهارمحال و بختیاری", "خراسان جنوبی", "خراسان رضوی",
-            "خراسان شمالی", "خوزستان", "زنجان", "سمنان", "سیستان و بلوچستان", "فارس",
-            "قزوین", "قم", "کردستان", "کرمان", "کرمانشاه", "کهگیلویه و بویراحمد",
-            "گلستان", "گیلان", "لرستان", "مازندران", "مرکزی", "هرمزگان", "همدان", "یزد"
-        ]
-
-        metrics = [
-            "میزان شادی", "میزان ترافیک", "میزان سلامتی", "میزان رضایتمندی", "میزان آلودگی",
-            "میزان اقتصادی", "میزان مطالعه عمومی", "میزان تفریحات", "میزان تحصیلات",
-            "میزان درآمد", "میزان مصرف انرژی", "میزان خستگی", "میزان امنیت", "میزان مصرف آب",
-            "میزان ورزش", "میزان خواب", "میزان استرس", "میزان مشارکت اجتماعی",
-            "میزان نوآوری", "میزان تولید زباله", "میزان رضایت مشتری", "میزان پیشرفت شغلی",
-            "میزان خلاقیت", "میزان دسترسی به خدمات بهداشتی", "میزان ترافیک اینترنت",
-            "میزان فعالیت فرهنگی", "میزان تعاملات خانوادگی", "میزان کیفیت هوا",
-            "میزان هزینه‌های زندگی", "میزان یادگیری مهارت‌های جدید"
-        ]
-
-        # Generate random data
-        data = {province: [random.randint(1, 100) for _ in metrics] for province in provinces}
-        df = pd.DataFrame(data, index=metrics)
-
-        # Save files
-        df.to_excel(excel_file, engine='openpyxl')
-        df.to_csv(csv_file, encoding='utf-8-sig')
-
-        self.stdout.write(self.style.SUCCESS(f"Excel and CSV files created in {BASE_DIR}"))
+        end = None
+        if kwargs['end']:
+            end = parse_date(f"{kwargs['end']}-01")
+            if end is None:
+                raise CommandError(f"Invalid month: {kwargs['end']}")
+        seed = kwargs['seed']
+        if seed is None:
+            seed = int(np.random.SeedSequence().entropy % 2**32)
+        try:
+            generator = SampleGenerator(
+                kwargs['cities'], kwargs['fields'], kwargs['periods'], seed=seed, missing=kwargs['missing']
+            )
+        except ValueError as exc:
+            raise CommandError(str(exc))
+
+        city_names = sample_city_names(generator.cities)
+        field_names = sample_field_names(generator.fields)
+        months = sample_months(generator.periods, end)
+        cells = generator.cities * generator.fields * generator.periods
+        started = time.perf_counter()
+
+        if kwargs['to_db']:
+            try:
+                cities_created, fields_created, rows = load_sample(
+                    generator, city_names, field_names, months, kwargs['batch_size'], log=self.stdout.write
+                )
+            except ValueError as exc:
+                raise CommandError(str(exc))
+            self.stdout.write(self.style.SUCCESS(
+                f"Loaded {rows} scores over {len(months)} months ({cities_created} cities and "
+                f"{fields_created} field types created) in {time.perf_counter() - started:.2f}s, seed {seed}"
+            ))
+            return
+
+        output_dir = Path(kwargs['output_dir']) if kwargs['output_dir'] else BASE_DIR
+        formats = kwargs['formats'] or ['xlsx', 'csv']
+        for month, scores in zip(months, generator):
+            # One directory per month, the layout ingest_scores --date-from-path reads
+            directory = output_dir / f"{month:%Y-%m}" if generator.periods > 1 else output_dir
+            directory.mkdir(parents=True, exist_ok=True)
+            for output_format in formats:
+                path = directory / f"{kwargs['name']}{SAMPLE_SUFFIXES[output_format]}"
+                write_sample(path, output_format, city_names, field_names, scores)
+                self.stdout.write(f"{path}")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"{cells} cells ({generator.cities} cities x {generator.fields} fields x {generator.periods} months) "
+            f"written to {output_dir} in {time.perf_counter() - started:.2f}s, seed {seed}"
+        ))
@@ -1,15 +1,34 @@
-import json
-from django.core.management.base import BaseCommand
-from MainApplication.models import City, FieldType, CityFieldScore
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from MainApplication.importers import ScoreWriter, format_import_stats, iter_converted_cells, parse_effective_at
+from MainApplication.models import check_history_date
 
 class Command(BaseCommand):
-    help = "Load city scores from JSON into the database"
+    help = "Load city scores from a json_converter output (JSON, columnar JSON or .npz) into the database"
 
     def add_arguments(self, parser):
         parser.add_argument(
             '--file',
             type=str,
-            help='Path to the JSON file to load',
+            help='Path to the JSON/.npz file to load',
+        )
+        parser.add_argument(
+            '--update',
+            action='store_true',
+            help='Overwrite existing scores whose value changed (default: keep them)',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Number of score cells written per bulk query',
+        )
+        parser.add_argument(
+            '--effective-at',
+            type=str,
+            help='Date (YYYY-MM-DD) or ISO datetime the imported values are valid from (default: now)',
         )
 
     def handle(self, *args, **options):
@@ -17,34 +36,26 @@ class Command(BaseCommand):
         if not file_path:
             self.stdout.write(self.style.ERROR("Please provide --file path"))
             return
+        effective_at = None
+        if options['effective_at']:
+            try:
+                effective_at = parse_effective_at(options['effective_at'])
+                check_history_date(effective_at)
+            except ValueError as exc:
+                raise CommandError(str(exc))
 
-        with open(file_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-
-        for city_name, fields in data.items():
-            # Create city if it doesn't exist
-            city, created_city = City.objects.get_or_create(
-                name=city_name,
-                defaults={'city_type': 'شهر \\ استان'}
+        started = time.perf_counter()
+        # One transaction: a failed import leaves the database untouched
+        with transaction.atomic():
+            writer = ScoreWriter(
+                update=options['update'],
+                batch_size=options['batch_size'],
+                effective_at=effective_at,
             )
-            if created_city:
-                self.stdout.write(self.style.SUCCESS(f"Created city: {city_name}"))
-            else:
-                self.stdout.write(f"City exists: {city_name}")
-
-            for field_name, score in fields.items():
-                # Create FieldType if it doesn't exist
-                field, created_field = FieldType.objects.get_or_create(name=field_name)
-                if created_field:
-                    self.stdout.write(self.style.SUCCESS(f"Created field type: {field_name}"))
+            writer.add_many(iter_converted_cells(file_path))
+            stats = writer.close()
+        elapsed = time.perf_counter() - started
 
-                # Create CityFieldScore if it doesn't exist
-                score_obj, created_score = CityFieldScore.objects.get_or_create(
-                    city=city,
-                    field=field,
-                    defaults={'score': score}
-                )
-                if created_score:
-                    self.stdout.write(self.style.SUCCESS(f"Added score for {city_name} - {field_name}: {score}"))
-                else:
-                    self.stdout.write(f"Score already exists for {city_name} - {field_name}")
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {file_path} in {elapsed:.2f}s: {format_import_stats(stats)}"
+        ))
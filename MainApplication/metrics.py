@@ -0,0 +1,175 @@
+import contextvars
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+
+from django.template.backends.django import DjangoTemplates, Template
+
+# Per-request counters filled by PerformanceMiddleware (MainApplication/middleware.py) and
+# per-view histograms served in Prometheus text format at /metrics. Everything is per
+# process: with several workers, Prometheus scrapes (and sums) each one.
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+_current = contextvars.ContextVar("request_metrics", default=None)
+
+
+class RequestMetrics:
+    """What one request spent its time on; read by the middleware when it finishes."""
+
+    __slots__ = ("db_queries", "db_time", "cache_hits", "cache_misses", "template_time", "slow_query", "request_line")
+
+    def __init__(self):
+        self.slow_query = float("inf")
+        self.request_line = ""
+        self.db_queries = 0
+        self.db_time = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.template_time = 0.0
+
+
+def start_request_metrics():
+    metrics = RequestMetrics()
+    return metrics, _current.set(metrics)
+
+
+def stop_request_metrics(token):
+    _current.reset(token)
+
+
+def current_request_metrics():
+    return _current.get()
+
+
+def record_cache_lookup(hit):
+    """Count a cache hit or miss for the current request (no-op outside instrumented requests)."""
+    metrics = _current.get()
+    if metrics is not None:
+        if hit:
+            metrics.cache_hits += 1
+        else:
+            metrics.cache_misses += 1
+
+
+class TimedTemplate(Template):
+    def render(self, context=None, request=None):
+        metrics = _current.get()
+        if metrics is None:
+            return super().render(context, request)
+        started = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            metrics.template_time += time.perf_counter() - started
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    """DjangoTemplates backend that adds top-level render time to the current request's metrics."""
+
+    def from_string(self, template_code):
+        return TimedTemplate(super().from_string(template_code).template, self)
+
+    def get_template(self, template_name):
+        return TimedTemplate(super().get_template(template_name).template, self)
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "total", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last slot: above every bucket (+Inf)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+
+class MetricsRegistry:
+    """Thread-safe per-view aggregates of finished requests."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.durations = defaultdict(lambda: Histogram(DURATION_BUCKETS))
+            self.queries = defaultdict(lambda: Histogram(QUERY_BUCKETS))
+            self.db_seconds = defaultdict(float)
+            self.template_seconds = defaultdict(float)
+            self.cache_lookups = defaultdict(int)
+            self.responses = defaultdict(int)
+            self.slow_requests = defaultdict(int)
+
+    def observe(self, view, status, duration, metrics, slow=False):
+        with self._lock:
+            self.durations[view].observe(duration)
+            self.queries[view].observe(metrics.db_queries)
+            self.db_seconds[view] += metrics.db_time
+            self.template_seconds[view] += metrics.template_time
+            self.cache_lookups[(view, "hit")] += metrics.cache_hits
+            self.cache_lookups[(view, "miss")] += metrics.cache_misses
+            self.responses[(view, f"{status // 100}xx")] += 1
+            if slow:
+                self.slow_requests[view] += 1
+
+    def render(self):
+        """Return every metric in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            _histogram_lines(lines, "iranmap_request_duration_seconds", "Request wall time", self.durations)
+            _histogram_lines(lines, "iranmap_request_db_queries", "SQL queries per request", self.queries)
+            _counter_lines(lines, "iranmap_request_db_seconds_total", "Time spent in SQL", self.db_seconds)
+            _counter_lines(
+                lines, "iranmap_request_template_seconds_total", "Time spent rendering templates", self.template_seconds
+            )
+            _counter_lines(
+                lines, "iranmap_cache_lookups_total", "Response/context cache lookups", self.cache_lookups,
+                ("view", "result"),
+            )
+            _counter_lines(lines, "iranmap_responses_total", "Responses by status class", self.responses, ("view", "status"))
+            _counter_lines(lines, "iranmap_slow_requests_total", "Requests above the slow threshold", self.slow_requests)
+        return "\n".join(lines) + "\n"
+
+
+def _labels(names, values):
+    if not isinstance(values, tuple):
+        values = (values,)
+    pairs = (f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return ",".join(pairs)
+
+
+def _escape(value):
+    return str(value).replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+
+
+def _format_number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _histogram_lines(lines, name, help_text, histograms):
+    lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+    for view, histogram in sorted(histograms.items()):
+        labels = _labels(("view",), view)
+        cumulative = 0
+        for bound, count in zip((*histogram.buckets, "+Inf"), histogram.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f"{name}_sum{{{labels}}} {_format_number(histogram.total)}")
+        lines.append(f"{name}_count{{{labels}}} {histogram.count}")
+
+
+def _counter_lines(lines, name, help_text, values, label_names=("view",)):
+    lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+    for key, value in sorted(values.items()):
+        lines.append(f"{name}{{{_labels(label_names, key)}}} {_format_number(value)}")
+
+
+registry = MetricsRegistry()
@@ -0,0 +1,235 @@
+import logging
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from whitenoise.middleware import WhiteNoiseMiddleware as BaseWhiteNoiseMiddleware
+
+from .metrics import current_request_metrics, registry, start_request_metrics, stop_request_metrics
+from .routers import (
+    STICKY_COOKIE,
+    ReplicaState,
+    current_replica_state,
+    get_replica_alias,
+    primary_pinned,
+    reset_replica_state,
+    sticky_seconds,
+    use_replica_state,
+)
+
+logger = logging.getLogger("MainApplication.performance")
+
+# All middlewares here work in sync and async mode. Under ASGI a single sync-only
+# middleware makes Django run the rest of the chain in its one thread-sensitive
+# worker thread, which serializes every request of the process.
+
+
+class WhiteNoiseMiddleware(BaseWhiteNoiseMiddleware):
+    """WhiteNoise static file serving that stays on the event loop under ASGI."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response=None, settings=settings):
+        super().__init__(get_response, settings)
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        return super().__call__(request)
+
+    async def __acall__(self, request):
+        # Lookups are dict hits (or, with autorefresh in development, a stat of the file)
+        static_file = self.find_file(request.path_info) if self.autorefresh else self.files.get(request.path_info)
+        if static_file is not None:
+            return self.serve(static_file, request)
+        return await self.get_response(request)
+
+
+def view_label(request):
+    """URL name used as the metrics label; admin pages share one label to keep the series bounded."""
+    match = getattr(request, "resolver_match", None)
+    if match is None:
+        return "unmatched"
+    if match.namespace == "admin" or match.namespace.startswith("admin:"):
+        return "admin"
+    return match.view_name or match._func_path
+
+
+def record_query(execute, sql, params, many, context):
+    """Database execute wrapper that charges queries to the request being served, if any."""
+    metrics = current_request_metrics()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        elapsed = time.perf_counter() - started
+        metrics.db_queries += 1
+        metrics.db_time += elapsed
+        if elapsed >= metrics.slow_query:
+            logger.warning("Slow query (%.1f ms) on %s: %s", elapsed * 1000, metrics.request_line, sql)
+
+
+# Installed on every connection by MainApplicationConfig.ready(). Queries are attributed
+# through a context variable, so concurrent async requests are counted separately.
+def install_query_recorder(connection, **kwargs):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+class PerformanceMiddleware:
+    """
+    Record wall time, SQL queries and time, cache hits/misses and template
+    render time per request (enabled by ``PERFORMANCE_METRICS``).
+
+    Adds a ``Server-Timing`` header, logs requests slower than
+    ``PERFORMANCE_SLOW_REQUEST_MS`` and queries slower than
+    ``PERFORMANCE_SLOW_QUERY_MS`` with their SQL, and aggregates per-view
+    histograms for the /metrics endpoint. Streamed responses are timed up to
+    their first byte.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not getattr(settings, "PERFORMANCE_METRICS", False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.slow_request = getattr(settings, "PERFORMANCE_SLOW_REQUEST_MS", 500) / 1000
+        self.slow_query = getattr(settings, "PERFORMANCE_SLOW_QUERY_MS", 100) / 1000
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        metrics, token = self.start(request)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            stop_request_metrics(token)
+        return self.finish(request, response, metrics, time.perf_counter() - started)
+
+    async def __acall__(self, request):
+        metrics, token = self.start(request)
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            stop_request_metrics(token)
+        return self.finish(request, response, metrics, time.perf_counter() - started)
+
+    def start(self, request):
+        metrics, token = start_request_metrics()
+        metrics.slow_query = self.slow_query
+        metrics.request_line = f"{request.method} {request.path}"
+        return metrics, token
+
+    def finish(self, request, response, metrics, duration):
+        slow = duration >= self.slow_request
+        view = view_label(request)
+        registry.observe(view, response.status_code, duration, metrics, slow=slow)
+        if slow:
+            logger.warning(
+                "Slow request (%.1f ms) %s %s [%s]: %d queries in %.1f ms, templates %.1f ms",
+                duration * 1000, request.method, request.get_full_path(), view,
+                metrics.db_queries, metrics.db_time * 1000, metrics.template_time * 1000,
+            )
+
+        response["Server-Timing"] = ", ".join([
+            f'db;dur={metrics.db_time * 1000:.1f};desc="{metrics.db_queries} queries"',
+            f'tpl;dur={metrics.template_time * 1000:.1f}',
+            f'cache;desc="{metrics.cache_hits} hit, {metrics.cache_misses} miss"',
+            f"total;dur={duration * 1000:.1f}",
+        ])
+        return response
+
+
+_END = object()
+
+
+def _iter_with_replica_state(state, content):
+    # Streamed bodies (exports) run their queries after the view returned
+    iterator = iter(content)
+    while True:
+        token = use_replica_state(state)
+        try:
+            chunk = next(iterator, _END)
+        finally:
+            reset_replica_state(token)
+        if chunk is _END:
+            return
+        yield chunk
+
+
+class ReplicaMiddleware:
+    """
+    Send the reads of safe, non-admin requests to the read replica
+    (``DATABASE_REPLICA``, see MainApplication/routers.py).
+
+    Clients that wrote recently carry a cookie that keeps them on the primary
+    for ``DATABASE_REPLICA_STICKY_SECONDS``, and so does everyone right after a
+    scores change. Not installed when no replica is configured.
+    """
+
+    sync_capable = True
+    async_capable = True
+    safe_methods = ("GET", "HEAD", "OPTIONS")
+
+    def __init__(self, get_response):
+        self.alias = get_replica_alias()
+        if self.alias is None:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        state = ReplicaState(None)
+        token = use_replica_state(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            reset_replica_state(token)
+        return self.finish(response, state)
+
+    async def __acall__(self, request):
+        state = ReplicaState(None)
+        token = use_replica_state(state)
+        try:
+            response = await self.get_response(request)
+        finally:
+            reset_replica_state(token)
+        return self.finish(response, state)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        # Decided once the URL is resolved, so admin pages can be told apart
+        if (
+            request.method in self.safe_methods
+            and view_label(request) != "admin"
+            and STICKY_COOKIE not in request.COOKIES
+            and not primary_pinned()
+        ):
+            state = current_replica_state()
+            if state is not None:
+                state.alias = self.alias
+        return None
+
+    def finish(self, response, state):
+        if state.wrote:
+            response.set_cookie(STICKY_COOKIE, "1", max_age=sticky_seconds(), httponly=True, samesite="Lax")
+        if state.alias and response.streaming and not response.is_async:
+            response.streaming_content = _iter_with_replica_state(state, response.streaming_content)
+        return response
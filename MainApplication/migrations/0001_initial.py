@@ -0,0 +1,51 @@
+# Generated by Django 5.2.9 on 2026-10-18 13:02
+
+import django.core.validators
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='City',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, verbose_name='نام استان/جزیره')),
+                ('population', models.PositiveIntegerField(blank=True, null=True, verbose_name='جمعیت')),
+                ('city_type', models.CharField(blank=True, choices=[('شهر \\ استان', 'شهر \\ استان'), ('جزیره', 'جزیره')], max_length=20, null=True, verbose_name='نوع : شهر/جزیره')),
+                ('is_capital', models.BooleanField(default=False, verbose_name='پایتخت')),
+            ],
+            options={
+                'verbose_name_plural': 'استان / جزیره',
+            },
+        ),
+        migrations.CreateModel(
+            name='FieldType',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True, verbose_name='نام فیلد')),
+            ],
+            options={
+                'verbose_name_plural': 'امتیاز',
+            },
+        ),
+        migrations.CreateModel(
+            name='CityFieldScore',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('score', models.PositiveIntegerField(validators=[django.core.validators.MinValueValidator(1), django.core.validators.MaxValueValidator(100)], verbose_name='امتیاز')),
+                ('city', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='scores', to='MainApplication.city')),
+                ('field', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='MainApplication.fieldtype')),
+            ],
+            options={
+                'verbose_name_plural': 'امتیاز دهی (تغیر داده نشود)',
+            },
+        ),
+    ]
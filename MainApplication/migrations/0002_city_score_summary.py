@@ -0,0 +1,59 @@
+# Generated by Django 5.2.9 on 2026-10-18 13:04
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+# Frozen copy of MainApplication.models.get_color_for_score as of this migration
+COLOR_BANDS = ((90, '#008000'), (70, '#66bb6a'), (50, '#ffeb3b'), (20, '#ff9800'))
+
+
+def color_for_score(avg_score):
+    for bound, color in COLOR_BANDS:
+        if avg_score >= bound:
+            return color
+    return '#f44336'
+
+
+def populate_summaries(apps, schema_editor):
+    City = apps.get_model('MainApplication', 'City')
+    CityScoreSummary = apps.get_model('MainApplication', 'CityScoreSummary')
+    totals = City.objects.annotate(score_sum=Sum('scores__score'), score_count=Count('scores'))
+    summaries = []
+    for city in totals:
+        avg_score = (city.score_sum or 0) / city.score_count if city.score_count else 0
+        summaries.append(CityScoreSummary(
+            city_id=city.id,
+            score_sum=city.score_sum or 0,
+            score_count=city.score_count,
+            avg_score=avg_score,
+            color=color_for_score(round(avg_score, 2)),
+        ))
+    CityScoreSummary.objects.bulk_create(summaries, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('MainApplication', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CityScoreSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('score_sum', models.PositiveBigIntegerField(default=0, verbose_name='مجموع امتیازها')),
+                ('score_count', models.PositiveIntegerField(default=0, verbose_name='تعداد امتیازها')),
+                ('avg_score', models.FloatField(default=0, verbose_name='میانگین امتیاز')),
+                ('color', models.CharField(default='#f44336', max_length=7, verbose_name='رنگ')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='زمان بروزرسانی')),
+                ('city', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='summary', to='MainApplication.city', verbose_name='استان/جزیره')),
+            ],
+            options={
+                'verbose_name_plural': 'خلاصه امتیاز شهر ها',
+            },
+        ),
+        migrations.RunPython(populate_summaries, migrations.RunPython.noop),
+    ]
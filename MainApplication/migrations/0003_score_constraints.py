@@ -0,0 +1,66 @@
+# Generated by Django 5.2.9 on 2026-10-18 13:16
+
+from django.db import migrations, models
+from django.db.models import Count, Max, Sum
+
+
+# Frozen copy of MainApplication.models.get_color_for_score as of this migration
+COLOR_BANDS = ((90, '#008000'), (70, '#66bb6a'), (50, '#ffeb3b'), (20, '#ff9800'))
+
+
+def color_for_score(avg_score):
+    for bound, color in COLOR_BANDS:
+        if avg_score >= bound:
+            return color
+    return '#f44336'
+
+
+def remove_duplicate_scores(apps, schema_editor):
+    """Keep the newest row of every (city, field) pair before the unique constraint is added."""
+    CityFieldScore = apps.get_model('MainApplication', 'CityFieldScore')
+    CityScoreSummary = apps.get_model('MainApplication', 'CityScoreSummary')
+    duplicates = (
+        CityFieldScore.objects.values('city_id', 'field_id')
+        .annotate(rows=Count('id'), keep_id=Max('id'))
+        .filter(rows__gt=1)
+    )
+    affected_city_ids = set()
+    for duplicate in duplicates.iterator():
+        CityFieldScore.objects.filter(
+            city_id=duplicate['city_id'], field_id=duplicate['field_id']
+        ).exclude(id=duplicate['keep_id']).delete()
+        affected_city_ids.add(duplicate['city_id'])
+
+    # Removed rows were counted in the summaries, so recompute those cities
+    totals = (
+        CityFieldScore.objects.filter(city_id__in=affected_city_ids)
+        .values('city_id')
+        .annotate(score_sum=Sum('score'), score_count=Count('id'))
+    )
+    for total in totals:
+        avg_score = total['score_sum'] / total['score_count']
+        CityScoreSummary.objects.filter(city_id=total['city_id']).update(
+            score_sum=total['score_sum'],
+            score_count=total['score_count'],
+            avg_score=avg_score,
+            color=color_for_score(round(avg_score, 2)),
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('MainApplication', '0002_city_score_summary'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_scores, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='cityfieldscore',
+            index=models.Index(fields=['field', 'score'], name='cityfieldscore_field_score'),
+        ),
+        migrations.AddConstraint(
+            model_name='cityfieldscore',
+            constraint=models.UniqueConstraint(fields=('city', 'field'), name='unique_city_field_score'),
+        ),
+    ]
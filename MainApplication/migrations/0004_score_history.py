@@ -0,0 +1,69 @@
+# Generated by Django 5.2.9 on 2026-10-18 13:18
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def seed_history(apps, schema_editor):
+    """Start the history with the current value of every score."""
+    CityFieldScore = apps.get_model('MainApplication', 'CityFieldScore')
+    CityFieldScoreHistory = apps.get_model('MainApplication', 'CityFieldScoreHistory')
+    now = timezone.now()
+    CityFieldScoreHistory.objects.bulk_create(
+        (
+            CityFieldScoreHistory(city_id=city_id, field_id=field_id, score=score, effective_at=now)
+            for city_id, field_id, score in CityFieldScore.objects.values_list('city_id', 'field_id', 'score').iterator()
+        ),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('MainApplication', '0003_score_constraints'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScoreSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('taken_at', models.DateTimeField(unique=True, verbose_name='زمان')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='زمان ساخت')),
+            ],
+            options={
+                'verbose_name_plural': 'نسخه های فشرده امتیاز ها',
+            },
+        ),
+        migrations.CreateModel(
+            name='CityFieldScoreHistory',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('score', models.PositiveIntegerField(blank=True, null=True, verbose_name='امتیاز')),
+                ('effective_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='تاریخ اعتبار')),
+                ('city', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='score_history', to='MainApplication.city', verbose_name='استان/جزیره')),
+                ('field', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='MainApplication.fieldtype', verbose_name='فیلد')),
+            ],
+            options={
+                'verbose_name_plural': 'تاریخچه امتیاز ها',
+                'indexes': [models.Index(fields=['city', 'field', 'effective_at'], name='scorehistory_city_field_at'), models.Index(fields=['effective_at'], name='scorehistory_effective_at')],
+            },
+        ),
+        migrations.CreateModel(
+            name='ScoreSnapshotValue',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('score', models.PositiveIntegerField()),
+                ('city', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='MainApplication.city')),
+                ('field', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='MainApplication.fieldtype')),
+                ('snapshot', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='values', to='MainApplication.scoresnapshot')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('snapshot', 'city', 'field'), name='unique_snapshot_city_field')],
+            },
+        ),
+        migrations.RunPython(seed_history, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,112 @@
+# Generated by Django 5.2.9 on 2026-10-18 13:25
+
+import re
+import unicodedata
+
+from django.db import migrations, models
+
+
+# Frozen copies of MainApplication.names as of this migration
+_CHARACTERS = str.maketrans({
+    'ي': 'ی',
+    'ى': 'ی',
+    'ك': 'ک',
+    'ة': 'ه',
+    '\u200c': ' ',
+    '\u200d': '',
+    '\u200e': '',
+    '\u200f': '',
+    '\u0640': '',
+})
+_DIACRITICS = re.compile('[\u064b-\u065f\u0670]')
+CITY_NAME_TO_SLUG = {
+    'آذربایجان شرقی': 'azerbaijan-east',
+    'آذربایجان غربی': 'azerbaijan-west',
+    'اردبیل': 'ardabil',
+    'اصفهان': 'isfahan',
+    'البرز': 'alborz',
+    'ایلام': 'ilam',
+    'بوشهر': 'bushehr',
+    'تهران': 'tehran',
+    'چهارمحال بختیاری': 'chahar-mahaal-bakhtiari',
+    'خراسان جنوبی': 'khorasan-south',
+    'خراسان رضوی': 'khorasan-razavi',
+    'خراسان شمالی': 'khorasan-north',
+    'خوزستان': 'khuzestan',
+    'زنجان': 'zanjan',
+    'سمنان': 'semnan',
+    'سیستان و بلوچستان': 'sistan-baluchestan',
+    'فارس': 'fars',
+    'قزوین': 'qazvin',
+    'قم': 'qom',
+    'کردستان': 'kurdistan',
+    'کرمان': 'kerman',
+    'کرمانشاه': 'kermanshah',
+    'کهگیلویه و بویر احمد': 'kohgiluyeh-boyer-ahmad',
+    'گلستان': 'golestan',
+    'گیلان': 'gilan',
+    'لرستان': 'lorestan',
+    'مازندران': 'mazandaran',
+    'مرکزی': 'markazi',
+    'هرمزگان': 'hormozgan',
+    'همدان': 'hamadan',
+    'یزد': 'yazd',
+    'ابو موسی': 'abu-musa',
+    'قشم': 'qeshm',
+    'فرور بزرگ': 'faror-big',
+    'فرور کوچک': 'faror-small',
+    'هندروابی': 'hendorabi',
+    'هنگام': 'hengam',
+    'هرمز': 'hormoz',
+    'خارک': 'khark',
+    'کیش': 'kish',
+    'لارک': 'lark',
+    'لاوان': 'lavan',
+    'سیری': 'siri',
+    'تنب بزرگ': 'tunb-big',
+    'تنب کوچک': 'tunb-small',
+}
+
+
+def normalize_name(name):
+    text = unicodedata.normalize('NFKC', str(name or '')).translate(_CHARACTERS)
+    text = _DIACRITICS.sub('', text).casefold()
+    return ''.join(word for word in text.split() if word != 'و')
+
+
+SLUG_BY_NAME_KEY = {normalize_name(name): slug for name, slug in CITY_NAME_TO_SLUG.items()}
+
+
+def populate_city_keys(apps, schema_editor):
+    """Fill name_key and the map slug of existing cities; the oldest spelling of a city gets the slug."""
+    City = apps.get_model('MainApplication', 'City')
+    cities = list(City.objects.order_by('id'))
+    used_slugs = set()
+    for city in cities:
+        city.name_key = normalize_name(city.name)
+        slug = SLUG_BY_NAME_KEY.get(city.name_key)
+        if slug and slug not in used_slugs:
+            city.slug = slug
+            used_slugs.add(slug)
+    City.objects.bulk_update(cities, ['name_key', 'slug'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('MainApplication', '0004_score_history'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='city',
+            name='name_key',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=100),
+        ),
+        migrations.AddField(
+            model_name='city',
+            name='slug',
+            field=models.SlugField(blank=True, max_length=100, null=True, unique=True, verbose_name='نامک'),
+        ),
+        migrations.RunPython(populate_city_keys, migrations.RunPython.noop),
+    ]
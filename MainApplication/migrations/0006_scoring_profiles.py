@@ -0,0 +1,40 @@
+# Generated by Django 5.2.9 on 2026-10-18 13:49
+
+import django.core.validators
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('MainApplication', '0005_city_slug_name_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScoringProfile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True, verbose_name='نام')),
+                ('slug', models.SlugField(max_length=100, unique=True, verbose_name='نامک')),
+            ],
+            options={
+                'verbose_name_plural': 'پروفایل های امتیازدهی',
+            },
+        ),
+        migrations.CreateModel(
+            name='ScoringProfileWeight',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('weight', models.FloatField(default=1, validators=[django.core.validators.MinValueValidator(0)], verbose_name='وزن')),
+                ('lower_is_better', models.BooleanField(default=False, verbose_name='کمتر بهتر است')),
+                ('field', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='MainApplication.fieldtype', verbose_name='فیلد')),
+                ('profile', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='weights', to='MainApplication.scoringprofile', verbose_name='پروفایل')),
+            ],
+            options={
+                'verbose_name_plural': 'وزن فیلدها',
+                'constraints': [models.UniqueConstraint(fields=('profile', 'field'), name='unique_profile_field_weight')],
+            },
+        ),
+    ]
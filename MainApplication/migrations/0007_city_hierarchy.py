@@ -0,0 +1,70 @@
+# Generated by Django 5.2.9 on 2026-10-18 14:11
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import F, Value
+from django.db.models.functions import Cast, Concat, LPad
+
+
+def populate_paths_and_rollups(apps, schema_editor):
+    """Every existing city is a top-level unit, so its path is its own id and its roll-up its own totals."""
+    City = apps.get_model('MainApplication', 'City')
+    CityScoreSummary = apps.get_model('MainApplication', 'CityScoreSummary')
+    City.objects.update(path=Concat(LPad(Cast('id', models.CharField()), 10, Value('0')), Value('/')), depth=0)
+    CityScoreSummary.objects.update(
+        rollup_sum=F('score_sum'),
+        rollup_count=F('score_count'),
+        rollup_avg=F('avg_score'),
+        rollup_color=F('color'),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('MainApplication', '0006_scoring_profiles'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='city',
+            name='depth',
+            field=models.PositiveSmallIntegerField(default=0, editable=False, verbose_name='سطح'),
+        ),
+        migrations.AddField(
+            model_name='city',
+            name='parent',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='children', to='MainApplication.city', verbose_name='زیرمجموعه ی'),
+        ),
+        migrations.AddField(
+            model_name='city',
+            name='path',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='cityscoresummary',
+            name='rollup_avg',
+            field=models.FloatField(default=0, verbose_name='میانگین با زیرمجموعه ها'),
+        ),
+        migrations.AddField(
+            model_name='cityscoresummary',
+            name='rollup_color',
+            field=models.CharField(default='#f44336', max_length=7, verbose_name='رنگ با زیرمجموعه ها'),
+        ),
+        migrations.AddField(
+            model_name='cityscoresummary',
+            name='rollup_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='تعداد امتیازها با زیرمجموعه ها'),
+        ),
+        migrations.AddField(
+            model_name='cityscoresummary',
+            name='rollup_sum',
+            field=models.PositiveBigIntegerField(default=0, verbose_name='مجموع امتیازها با زیرمجموعه ها'),
+        ),
+        migrations.AlterField(
+            model_name='city',
+            name='city_type',
+            field=models.CharField(blank=True, choices=[('شهر \\ استان', 'شهر \\ استان'), ('جزیره', 'جزیره'), ('شهرستان', 'شهرستان'), ('شهر', 'شهر')], max_length=20, null=True, verbose_name='نوع : شهر/جزیره'),
+        ),
+        migrations.RunPython(populate_paths_and_rollups, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.9 on 2026-10-18 14:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('MainApplication', '0007_city_hierarchy'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IngestedFile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sha256', models.CharField(max_length=64, unique=True, verbose_name='هش محتوا')),
+                ('path', models.CharField(max_length=500, verbose_name='مسیر')),
+                ('size', models.PositiveBigIntegerField(verbose_name='حجم')),
+                ('cells', models.PositiveIntegerField(default=0, verbose_name='تعداد امتیاز ها')),
+                ('effective_at', models.DateTimeField(verbose_name='تاریخ اعتبار')),
+                ('ingested_at', models.DateTimeField(auto_now_add=True, verbose_name='زمان ورود')),
+            ],
+            options={
+                'verbose_name_plural': 'فایل های وارد شده',
+            },
+        ),
+    ]
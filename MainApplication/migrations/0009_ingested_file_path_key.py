@@ -0,0 +1,22 @@
+# Generated by Django 5.2.9 on 2026-10-18 14:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('MainApplication', '0008_ingested_files'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='ingestedfile',
+            name='sha256',
+            field=models.CharField(max_length=64, verbose_name='هش محتوا'),
+        ),
+        migrations.AddConstraint(
+            model_name='ingestedfile',
+            constraint=models.UniqueConstraint(fields=('path', 'sha256'), name='unique_ingested_path_sha256'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.9 on 2026-10-18 15:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('MainApplication', '0009_ingested_file_path_key'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='cityfieldscore',
+            name='cityfieldscore_field_score',
+        ),
+        migrations.AddIndex(
+            model_name='cityfieldscore',
+            index=models.Index(fields=['field', 'score', 'city'], name='cityfieldscore_rank'),
+        ),
+    ]
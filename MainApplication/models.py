@@ -1,19 +1,40 @@
-from django.db import models
+from django.db import models, transaction
+from django.utils import timezone
+from django.core.exceptions import ValidationError
 from django.core.validators import MinValueValidator, MaxValueValidator
-from django.db.models import Avg
+from django.db.models import Avg, Count, F, OuterRef, Q, Subquery, Sum, Value, Window
+from django.db.models.functions import Cast, Concat, LPad, RowNumber, Substr
 
 class City(models.Model):
     class CityType(models.TextChoices):
         city = ('شهر \\ استان', 'شهر \\ استان')
         island = ('جزیره', 'جزیره')         
+        county = ('شهرستان', 'شهرستان')
+        town = ('شهر', 'شهر')
     
     name = models.CharField(max_length=100, verbose_name="نام استان/جزیره")
+    # Map slug (SVG id) and normalize_name(name); both filled by MainApplication.signals
+    slug = models.SlugField(max_length=100, unique=True, null=True, blank=True, verbose_name="نامک")
+    name_key = models.CharField(max_length=100, db_index=True, editable=False, default="")
     population = models.PositiveIntegerField(verbose_name="جمعیت", null=True, blank=True)
     city_type = models.CharField(max_length=20, choices=CityType.choices, verbose_name="نوع : شهر/جزیره", null=True, blank=True)
     is_capital = models.BooleanField(default=False, verbose_name="پایتخت")
+    # Province -> county -> city. ``path`` holds the ids from the root down (see path_segment),
+    # so a whole subtree is one prefix match on its index; place_city() keeps path and depth current
+    parent = models.ForeignKey(
+        "self", on_delete=models.CASCADE, null=True, blank=True, related_name="children", verbose_name="زیرمجموعه ی"
+    )
+    path = models.CharField(max_length=255, db_index=True, editable=False, default="")
+    depth = models.PositiveSmallIntegerField(default=0, editable=False, verbose_name="سطح")
 
     def __str__(self):
         return self.name
+
+    def clean(self):
+        if self.pk is not None and self.parent_id is not None:
+            parent_path = City.objects.filter(pk=self.parent_id).values_list("path", flat=True).first() or ""
+            if self.pk in path_ids(parent_path):
+                raise ValidationError({"parent": "A city cannot be placed under itself or one of its sub-units."})
     
     class Meta:
         verbose_name_plural = "استان / جزیره"    
@@ -39,14 +60,249 @@ class CityFieldScore(models.Model):
         verbose_name="امتیاز"
     )
 
+    def __str__(self):
+        return f"{self.city.name} - {self.field.name}: {self.score}"
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Persisted (city, field, score), so MainApplication.signals can apply updates as a delta
+        instance._original_score = (
+            instance.__dict__.get("city_id"),
+            instance.__dict__.get("field_id"),
+            instance.__dict__.get("score"),
+        )
+        return instance
+
     class Meta:
-        unique_together = ("city", "field")  # prevent duplicate entries
+        verbose_name_plural = "امتیاز دهی (تغیر داده نشود)"
+        constraints = [
+            models.UniqueConstraint(fields=["city", "field"], name="unique_city_field_score"),  # prevent duplicate entries
+        ]
+        indexes = [
+            # Serves "scores of field X ordered by score" for rankings, ties broken by city
+            models.Index(fields=["field", "score", "city"], name="cityfieldscore_rank"),
+        ]
+
+
+# Precomputed totals per city, kept in sync with CityFieldScore by MainApplication.signals
+class CityScoreSummary(models.Model):
+    city = models.OneToOneField(City, on_delete=models.CASCADE, related_name="summary", verbose_name="استان/جزیره")
+    score_sum = models.PositiveBigIntegerField(default=0, verbose_name="مجموع امتیازها")
+    score_count = models.PositiveIntegerField(default=0, verbose_name="تعداد امتیازها")
+    avg_score = models.FloatField(default=0, verbose_name="میانگین امتیاز")
+    color = models.CharField(max_length=7, default="#f44336", verbose_name="رنگ")
+    # The same over the city and all of its sub-units; equal to the above for cities without any.
+    # The map colors provinces by these.
+    rollup_sum = models.PositiveBigIntegerField(default=0, verbose_name="مجموع امتیازها با زیرمجموعه ها")
+    rollup_count = models.PositiveIntegerField(default=0, verbose_name="تعداد امتیازها با زیرمجموعه ها")
+    rollup_avg = models.FloatField(default=0, verbose_name="میانگین با زیرمجموعه ها")
+    rollup_color = models.CharField(max_length=7, default="#f44336", verbose_name="رنگ با زیرمجموعه ها")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="زمان بروزرسانی")
 
     def __str__(self):
-        return f"{self.city.name} - {self.field.name}: {self.score}"
-    
+        return f"{self.city_id}: {self.avg_score}"
+
+    def refresh_average(self):
+        self.avg_score = self.score_sum / self.score_count if self.score_count else 0
+        self.color = get_color_for_score(round(self.avg_score, 2))
+        self.rollup_avg = self.rollup_sum / self.rollup_count if self.rollup_count else 0
+        self.rollup_color = get_color_for_score(round(self.rollup_avg, 2))
+
+    class Meta:
+        verbose_name_plural = "خلاصه امتیاز شهر ها"
+
+
+# Append-only log of every value a (city, field) score has had; CityFieldScore keeps only the latest
+class CityFieldScoreHistory(models.Model):
+    city = models.ForeignKey(City, on_delete=models.CASCADE, related_name="score_history", verbose_name="استان/جزیره")
+    field = models.ForeignKey(FieldType, on_delete=models.CASCADE, related_name="+", verbose_name="فیلد")
+    score = models.PositiveIntegerField(null=True, blank=True, verbose_name="امتیاز")  # null: score was removed
+    effective_at = models.DateTimeField(default=timezone.now, verbose_name="تاریخ اعتبار")
+
+    def __str__(self):
+        return f"{self.city_id} - {self.field_id}: {self.score} @ {self.effective_at:%Y-%m-%d}"
+
+    class Meta:
+        verbose_name_plural = "تاریخچه امتیاز ها"
+        indexes = [
+            # Latest value per (city, field) up to a date
+            models.Index(fields=["city", "field", "effective_at"], name="scorehistory_city_field_at"),
+            # Changes recorded after a snapshot
+            models.Index(fields=["effective_at"], name="scorehistory_effective_at"),
+        ]
+
+
+# Compacted state of every score at ``taken_at``, so "as of" lookups only replay later history
+class ScoreSnapshot(models.Model):
+    taken_at = models.DateTimeField(unique=True, verbose_name="زمان")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="زمان ساخت")
+
+    def __str__(self):
+        return f"{self.taken_at:%Y-%m-%d %H:%M}"
+
+    class Meta:
+        verbose_name_plural = "نسخه های فشرده امتیاز ها"
+
+
+class ScoreSnapshotValue(models.Model):
+    snapshot = models.ForeignKey(ScoreSnapshot, on_delete=models.CASCADE, related_name="values")
+    city = models.ForeignKey(City, on_delete=models.CASCADE, related_name="+")
+    field = models.ForeignKey(FieldType, on_delete=models.CASCADE, related_name="+")
+    score = models.PositiveIntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["snapshot", "city", "field"], name="unique_snapshot_city_field"),
+        ]
+
+
+# Named weighting of the fields for the map (MainApplication/scoring.py); fields without a
+# weight row count once, higher is better
+class ScoringProfile(models.Model):
+    name = models.CharField(max_length=100, unique=True, verbose_name="نام")
+    slug = models.SlugField(max_length=100, unique=True, verbose_name="نامک")
+
+    def __str__(self):
+        return self.name
+
+    class Meta:
+        verbose_name_plural = "پروفایل های امتیازدهی"
+
+
+class ScoringProfileWeight(models.Model):
+    profile = models.ForeignKey(ScoringProfile, on_delete=models.CASCADE, related_name="weights", verbose_name="پروفایل")
+    field = models.ForeignKey(FieldType, on_delete=models.CASCADE, related_name="+", verbose_name="فیلد")
+    weight = models.FloatField(default=1, validators=[MinValueValidator(0)], verbose_name="وزن")
+    lower_is_better = models.BooleanField(default=False, verbose_name="کمتر بهتر است")  # e.g. pollution, stress
+
+    def __str__(self):
+        return f"{self.profile_id} - {self.field_id}: {self.weight}"
+
+    class Meta:
+        verbose_name_plural = "وزن فیلدها"
+        constraints = [
+            models.UniqueConstraint(fields=["profile", "field"], name="unique_profile_field_weight"),
+        ]
+
+
+# A score file loaded by ingest_scores. The content hash marks it as done: re-runs skip
+# files whose content was already ingested, and an interrupted run resumes after the
+# last file committed, since each file and its row are written in one transaction.
+class IngestedFile(models.Model):
+    sha256 = models.CharField(max_length=64, verbose_name="هش محتوا")
+    path = models.CharField(max_length=500, verbose_name="مسیر")
+    size = models.PositiveBigIntegerField(verbose_name="حجم")
+    cells = models.PositiveIntegerField(default=0, verbose_name="تعداد امتیاز ها")
+    effective_at = models.DateTimeField(verbose_name="تاریخ اعتبار")
+    ingested_at = models.DateTimeField(auto_now_add=True, verbose_name="زمان ورود")
+
+    def __str__(self):
+        return self.path
+
     class Meta:
-        verbose_name_plural = "امتیاز دهی (تغیر داده نشود)"        
+        verbose_name_plural = "فایل های وارد شده"
+        constraints = [
+            # Keyed by path too: a month that goes back to an earlier month's content is a new file
+            models.UniqueConstraint(fields=["path", "sha256"], name="unique_ingested_path_sha256"),
+        ]
+
+
+PATH_WIDTH = 10  # digits per id in City.path
+SUBTREE_PREFIX_LIMIT = 100  # roots matched by path prefix in rebuild_city_summaries
+
+
+def path_segment(city_id):
+    """One City.path step: the zero-padded id and a slash, so paths sort depth-first."""
+    return f"{city_id:0{PATH_WIDTH}d}/"
+
+
+def path_ids(path):
+    """City ids on a materialized path, root first."""
+    return [int(part) for part in path.split("/") if part]
+
+
+def fill_root_paths():
+    """Give parentless cities created without signals (bulk_create) their path; returns how many."""
+    return City.objects.filter(path="", parent__isnull=True).update(
+        path=Concat(LPad(Cast("id", models.CharField()), PATH_WIDTH, Value("0")), Value("/")),
+        depth=0,
+    )
+
+
+def fill_child_paths():
+    """
+    Give sub-units created without signals (bulk_create) under already placed
+    parents their path and depth; returns how many. Fills one level per call.
+    """
+    parent = City.objects.filter(pk=OuterRef("parent_id"))
+    return City.objects.filter(path="", parent__isnull=False).exclude(parent__path="").update(
+        path=Concat(
+            Subquery(parent.values("path")),
+            LPad(Cast("id", models.CharField()), PATH_WIDTH, Value("0")),
+            Value("/"),
+            output_field=models.CharField(),
+        ),
+        depth=Subquery(parent.values("depth")) + 1,
+    )
+
+
+def get_subtree(city, max_depth=None):
+    """
+    ``city`` and every unit below it (down to ``max_depth`` levels), depth-first,
+    with summaries. One query: a prefix match on the City.path index.
+    """
+    units = City.objects.filter(path__startswith=city.path)
+    if max_depth is not None:
+        units = units.filter(depth__lte=city.depth + max_depth)
+    return units.select_related("summary").order_by("path")
+
+
+def place_city(city, old_path=""):
+    """
+    Set ``city.path`` and ``depth`` under its parent. A city that moved takes its
+    whole subtree along in one UPDATE, and the roll-ups of its old and new
+    ancestors are rebuilt.
+    """
+    parent_path = ""
+    if city.parent_id is not None:
+        parent_path = City.objects.filter(pk=city.parent_id).values_list("path", flat=True).first() or ""
+    path = parent_path + path_segment(city.pk)
+    depth = len(path_ids(path)) - 1
+    if path == old_path:
+        return
+    with transaction.atomic():
+        if old_path:
+            City.objects.filter(path__startswith=old_path).update(
+                path=Concat(Value(path), Substr("path", len(old_path) + 1)),
+                depth=F("depth") + (depth - (len(path_ids(old_path)) - 1)),
+            )
+            # The subtree's totals leave the old ancestors and join the new ones
+            rebuild_city_summaries([city.pk, *path_ids(old_path)[:-1]])
+        else:
+            City.objects.filter(pk=city.pk).update(path=path, depth=depth)
+    city.path, city.depth = path, depth
+
+
+def get_color_for_score(avg_score: float) -> str:
+    """
+    Return a hex color based on the average score.
+
+    90 - 100 => green
+    70 - 89.99 => light green
+    50 - 69.99 => yellow
+    20 - 49.99 => orange
+    0  - 19.99 => red
+    """
+    if avg_score >= 90:
+        return "#008000"  # green
+    if avg_score >= 70:
+        return "#66bb6a"  # light green
+    if avg_score >= 50:
+        return "#ffeb3b"  # yellow
+    if avg_score >= 20:
+        return "#ff9800"  # orange
+    return "#f44336"      # red
 
 
 # Optional: Method to get average score for a city
@@ -54,3 +310,216 @@ def get_city_average_score(city_id):
     from django.db.models import Avg
     avg_score = CityFieldScore.objects.filter(city_id=city_id).aggregate(Avg('score'))
     return avg_score['score__avg'] if avg_score['score__avg'] else 0
+
+
+# Fields ranked per query by get_field_rankings(); one IN (...) subquery each, so this
+# keeps the statement well within SQLite's expression depth limit
+RANKING_FIELDS_PER_QUERY = 200
+
+
+def get_field_rankings(limit=10, bottom=False, field_ids=None):
+    """
+    Top (or bottom) ``limit`` cities of every field (or of ``field_ids``), as
+    dicts ordered by field name and position.
+
+    Every field gets its own ``ORDER BY score, city LIMIT limit`` subquery, which
+    walks the (field, score, city) index from one end and stops after ``limit``
+    rows, so the cost grows with the fields and ``limit``, not with the scores.
+    Ties go to the lower city id at the bottom and the higher one at the top:
+    top is the exact reverse of bottom, so both orders read the same index.
+    ROW_NUMBER() then numbers only the rows the subqueries picked.
+    """
+    fields = FieldType.objects.order_by("name")
+    if field_ids is not None:
+        fields = fields.filter(id__in=field_ids)
+    field_ids = list(fields.values_list("id", flat=True))
+    if bottom:
+        order = [F("score").asc(), F("city_id").asc()]
+    else:
+        order = [F("score").desc(), F("city_id").desc()]
+    position = Window(RowNumber(), partition_by=F("field_id"), order_by=order)
+
+    rows = []
+    for start in range(0, len(field_ids), RANKING_FIELDS_PER_QUERY):
+        picked = Q()
+        for field_id in field_ids[start:start + RANKING_FIELDS_PER_QUERY]:
+            ranked = CityFieldScore.objects.filter(field_id=field_id).order_by(*order).values("id")[:limit]
+            picked |= Q(id__in=ranked)
+        rows.extend(
+            CityFieldScore.objects.filter(picked)
+            .annotate(position=position)
+            .values("field_id", "field__name", "city_id", "city__name", "city__slug", "score", "position")
+            .order_by("field__name", "position")
+        )
+    return rows
+
+
+def get_score_sources_as_of(when, city_id=None):
+    """
+    Return the querysets that make up the scores at ``when``: the values of the
+    newest ScoreSnapshot taken at or before it (None without a snapshot) and the
+    latest history row per (city, field) recorded after that snapshot, a None
+    score meaning deleted. Both yield ``(city_id, field_id, score)``.
+
+    The latest rows are picked with ROW_NUMBER() over the (city, field,
+    effective_at) index, so old dates never replay the whole history.
+    """
+    snapshot = ScoreSnapshot.objects.filter(taken_at__lte=when).order_by("-taken_at").first()
+    values = None
+    changes = CityFieldScoreHistory.objects.filter(effective_at__lte=when)
+    if snapshot is not None:
+        values = snapshot.values.all()
+        if city_id is not None:
+            values = values.filter(city_id=city_id)
+        values = values.values_list("city_id", "field_id", "score")
+        changes = changes.filter(effective_at__gt=snapshot.taken_at)
+    if city_id is not None:
+        changes = changes.filter(city_id=city_id)
+
+    latest_changes = (
+        changes.annotate(position=Window(
+            RowNumber(),
+            partition_by=[F("city_id"), F("field_id")],
+            order_by=[F("effective_at").desc(), F("id").desc()],
+        ))
+        .filter(position=1)
+        .values_list("city_id", "field_id", "score")
+    )
+    return values, latest_changes
+
+
+def check_history_date(effective_at):
+    """
+    Raise ValueError when history dated ``effective_at`` would be hidden by a
+    ScoreSnapshot taken at or after it: get_score_sources_as_of() only reads
+    the history recorded after the snapshot it starts from.
+    """
+    taken_at = (
+        ScoreSnapshot.objects.filter(taken_at__gte=effective_at)
+        .order_by("-taken_at")
+        .values_list("taken_at", flat=True)
+        .first()
+    )
+    if taken_at is not None:
+        raise ValueError(
+            f"Scores dated {effective_at:%Y-%m-%d %H:%M} fall before the score snapshot taken at "
+            f"{taken_at:%Y-%m-%d %H:%M}; history that old is compacted and cannot be backfilled"
+        )
+
+
+def get_scores_as_of(when, city_id=None):
+    """Return ``{(city_id, field_id): score}`` as it was at ``when`` (see get_score_sources_as_of)."""
+    values, latest_changes = get_score_sources_as_of(when, city_id=city_id)
+    scores = {}
+    if values is not None:
+        scores = {
+            (value_city_id, field_id): score for value_city_id, field_id, score in values.iterator()
+        }
+    for change_city_id, field_id, score in latest_changes.iterator():
+        if score is None:
+            scores.pop((change_city_id, field_id), None)
+        else:
+            scores[(change_city_id, field_id)] = score
+    return scores
+
+
+def take_score_snapshot(when=None):
+    """Store the full score state at ``when`` (default: now) as a ScoreSnapshot."""
+    when = when or timezone.now()
+    scores = get_scores_as_of(when)
+    with transaction.atomic():
+        ScoreSnapshot.objects.filter(taken_at=when).delete()
+        snapshot = ScoreSnapshot.objects.create(taken_at=when)
+        ScoreSnapshotValue.objects.bulk_create(
+            (
+                ScoreSnapshotValue(snapshot=snapshot, city_id=city_id, field_id=field_id, score=score)
+                for (city_id, field_id), score in scores.items()
+            ),
+            batch_size=1000,
+        )
+    return snapshot, len(scores)
+
+
+def apply_score_delta(city_id, sum_delta, count_delta):
+    """Shift a city's summary, and the roll-ups of its ancestors, by one score being added, changed or removed."""
+    with transaction.atomic():
+        path = City.objects.filter(pk=city_id).values_list("path", flat=True).first()
+        city_ids = path_ids(path or "") or [city_id]
+        summaries = list(CityScoreSummary.objects.select_for_update().filter(city_id__in=city_ids))
+        if len(summaries) < len(city_ids):
+            # Nothing to adjust yet for some of them (or the city is being deleted); only build on additions
+            if count_delta > 0:
+                rebuild_city_summaries([city_id])
+                return
+        for summary in summaries:
+            if summary.city_id == city_id:
+                summary.score_sum += sum_delta
+                summary.score_count += count_delta
+            summary.rollup_sum += sum_delta
+            summary.rollup_count += count_delta
+            summary.refresh_average()
+            summary.save()
+
+
+def rebuild_city_summaries(city_ids=None):
+    """
+    Recompute summaries from CityFieldScore: the cities' paths, one grouped query and one bulk upsert.
+
+    Each city's totals are added to the roll-up of every city on its path, so
+    rebuilding some cities rebuilds their ancestors too, from the scores of the
+    subtrees they head.
+    """
+    cities = City.objects.all()
+    if city_ids is not None:
+        cities = cities.filter(id__in=city_ids)
+    paths = dict(cities.values_list('id', 'path'))
+    summary_ids = set(paths)
+    scores = CityFieldScore.objects.all()
+    if city_ids is not None:
+        roots = set()
+        for path in paths.values():
+            ancestors = path_ids(path)
+            summary_ids.update(ancestors)
+            roots.update(ancestors[:1])
+        subtrees = Q(city_id__in=paths)
+        if len(roots) <= SUBTREE_PREFIX_LIMIT:
+            for root in roots:
+                subtrees |= Q(city__path__startswith=path_segment(root))
+        else:
+            # One OR per prefix would outgrow SQLite's expression depth limit (1000): match root segments
+            scores = scores.annotate(root_segment=Substr('city__path', 1, PATH_WIDTH + 1))
+            subtrees |= Q(root_segment__in=[path_segment(root) for root in roots])
+        scores = scores.filter(subtrees)
+    totals = scores.values_list('city_id', 'city__path').annotate(score_sum=Sum('score'), score_count=Count('id'))
+
+    own, rollups = {}, {}
+    for city_id, path, score_sum, score_count in totals:
+        own[city_id] = (score_sum, score_count)
+        for ancestor in path_ids(path) or [city_id]:
+            rollup_sum, rollup_count = rollups.get(ancestor, (0, 0))
+            rollups[ancestor] = (rollup_sum + score_sum, rollup_count + score_count)
+
+    summaries = []
+    for city_id in sorted(summary_ids):
+        score_sum, score_count = own.get(city_id, (0, 0))
+        rollup_sum, rollup_count = rollups.get(city_id, (0, 0))
+        summary = CityScoreSummary(
+            city_id=city_id,
+            score_sum=score_sum,
+            score_count=score_count,
+            rollup_sum=rollup_sum,
+            rollup_count=rollup_count,
+        )
+        summary.refresh_average()
+        summaries.append(summary)
+    CityScoreSummary.objects.bulk_create(
+        summaries,
+        batch_size=1000,
+        update_conflicts=True,
+        unique_fields=['city'],
+        update_fields=[
+            'score_sum', 'score_count', 'avg_score', 'color',
+            'rollup_sum', 'rollup_count', 'rollup_avg', 'rollup_color', 'updated_at',
+        ],
+    )
+    return len(summaries)
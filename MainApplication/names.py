@@ -0,0 +1,104 @@
+import re
+import unicodedata
+
+# City names arrive from admin edits, fixtures, spreadsheets and converters
+# spelled slightly differently (Arabic ي/ك, ZWNJ, "چهارمحال و بختیاری" vs
+# "چهارمحال بختیاری"). normalize_name() reduces every spelling to one key,
+# stored as City.name_key, so lookups are a dict or index hit.
+
+# Slugs used by the SVG map (iranmap.js) for each province and island
+CITY_NAME_TO_SLUG = {
+    "آذربایجان شرقی": "azerbaijan-east",
+    "آذربایجان غربی": "azerbaijan-west",
+    "اردبیل": "ardabil",
+    "اصفهان": "isfahan",
+    "البرز": "alborz",
+    "ایلام": "ilam",
+    "بوشهر": "bushehr",
+    "تهران": "tehran",
+    "چهارمحال بختیاری": "chahar-mahaal-bakhtiari",
+    "خراسان جنوبی": "khorasan-south",
+    "خراسان رضوی": "khorasan-razavi",
+    "خراسان شمالی": "khorasan-north",
+    "خوزستان": "khuzestan",
+    "زنجان": "zanjan",
+    "سمنان": "semnan",
+    "سیستان و بلوچستان": "sistan-baluchestan",
+    "فارس": "fars",
+    "قزوین": "qazvin",
+    "قم": "qom",
+    "کردستان": "kurdistan",
+    "کرمان": "kerman",
+    "کرمانشاه": "kermanshah",
+    "کهگیلویه و بویر احمد": "kohgiluyeh-boyer-ahmad",
+    "گلستان": "golestan",
+    "گیلان": "gilan",
+    "لرستان": "lorestan",
+    "مازندران": "mazandaran",
+    "مرکزی": "markazi",
+    "هرمزگان": "hormozgan",
+    "همدان": "hamadan",
+    "یزد": "yazd",
+    # جزایر – only include if you also have them as City objects
+    "ابو موسی": "abu-musa",
+    "قشم": "qeshm",
+    "فرور بزرگ": "faror-big",
+    "فرور کوچک": "faror-small",
+    "هندروابی": "hendorabi",
+    "هنگام": "hengam",
+    "هرمز": "hormoz",
+    "خارک": "khark",
+    "کیش": "kish",
+    "لارک": "lark",
+    "لاوان": "lavan",
+    "سیری": "siri",
+    "تنب بزرگ": "tunb-big",
+    "تنب کوچک": "tunb-small",
+}
+
+SLUG_TO_CITY_NAME = {slug: name for name, slug in CITY_NAME_TO_SLUG.items()}
+
+
+_CHARACTERS = str.maketrans({
+    "ي": "ی",  # Arabic yeh
+    "ى": "ی",  # Alef maksura
+    "ك": "ک",  # Arabic kaf
+    "ة": "ه",
+    "\u200c": " ",  # ZWNJ
+    "\u200d": "",
+    "\u200e": "",
+    "\u200f": "",
+    "\u0640": "",  # Tatweel
+})
+_DIACRITICS = re.compile("[\u064b-\u065f\u0670]")
+
+
+def normalize_name(name):
+    """
+    Return the lookup key for a city (or field) name.
+
+    Unifies Arabic/Persian letter variants, drops diacritics, ZWNJ and the
+    standalone conjunction "و", and removes whitespace, so "کهگیلويه و بویر‌احمد"
+    and "کهگیلویه و بویر احمد" share a key.
+    """
+    text = unicodedata.normalize("NFKC", str(name or "")).translate(_CHARACTERS)
+    text = _DIACRITICS.sub("", text).casefold()
+    return "".join(word for word in text.split() if word != "و")
+
+
+SLUG_BY_NAME_KEY = {normalize_name(name): slug for name, slug in CITY_NAME_TO_SLUG.items()}
+
+# Sub-units are named by their path in score files: "قم/قم" is the county of Qom
+# in the province of Qom, a plain "قم" the province
+CITY_PATH_SEPARATOR = "/"
+
+
+def split_city_path(name):
+    """The steps of a city path ``"province/county/town"`` as ``[(name, key), ...]``, root first."""
+    steps = [(part.strip(), normalize_name(part)) for part in str(name or "").split(CITY_PATH_SEPARATOR)]
+    return [(step, key) for step, key in steps if key]
+
+
+def slug_for_name(name):
+    """Return the map slug for a city name in any known spelling, or None."""
+    return SLUG_BY_NAME_KEY.get(normalize_name(name))
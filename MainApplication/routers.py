@@ -0,0 +1,110 @@
+import contextvars
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+
+# Read-replica routing. Reads of this app's models go to settings.DATABASE_REPLICA
+# while a ReplicaState is active: during safe (GET/HEAD) non-admin requests, set up
+# by ReplicaMiddleware, and inside reading_from_replica(). Everything else, every
+# write and all other apps (sessions, users) use the primary. Nothing is active
+# outside those scopes, so management commands and signals read the primary.
+#
+# Read your writes: a request that wrote this app's models sets a short-lived cookie
+# that keeps that client on the primary (sessions, last_login and the cache table do
+# not count: their reads never leave the primary), and bump_scores_version() pins everyone to the primary for
+# the same time, so a lagging replica never gets a page or ScoreMatrix cached under
+# the new scores version.
+
+REPLICA_APPS = {"MainApplication"}
+PRIMARY_PIN_KEY = "MainApplication:primary_pin"
+STICKY_COOKIE = "db_primary"
+
+_current = contextvars.ContextVar("replica_state", default=None)
+
+
+def get_replica_alias():
+    """The replica's DATABASES alias, or None when no replica is configured."""
+    alias = getattr(settings, "DATABASE_REPLICA", None)
+    return alias if alias and alias in settings.DATABASES else None
+
+
+def sticky_seconds():
+    return getattr(settings, "DATABASE_REPLICA_STICKY_SECONDS", 5)
+
+
+class ReplicaState:
+    """Where the reads of one request (or block) go, and whether it has written."""
+
+    __slots__ = ("alias", "wrote")
+
+    def __init__(self, alias):
+        self.alias = alias
+        self.wrote = False
+
+
+def current_replica_state():
+    return _current.get()
+
+
+def use_replica_state(state):
+    return _current.set(state)
+
+
+def reset_replica_state(token):
+    _current.reset(token)
+
+
+@contextmanager
+def reading_from_replica():
+    """Send this app's reads inside the block to the replica (unless the primary is pinned)."""
+    alias = get_replica_alias()
+    state = ReplicaState(None if alias is None or primary_pinned() else alias)
+    token = use_replica_state(state)
+    try:
+        yield state
+    finally:
+        reset_replica_state(token)
+
+
+def pin_primary():
+    """Keep every reader on the primary for the replication lag after a data change."""
+    if get_replica_alias() is not None:
+        cache.set(PRIMARY_PIN_KEY, True, timeout=sticky_seconds())
+
+
+def primary_pinned():
+    return bool(cache.get(PRIMARY_PIN_KEY))
+
+
+class ReplicaRouter:
+    """
+    Database router for DATABASE_ROUTERS: this app's reads go to the replica
+    while a ReplicaState allows it, writes always go to the primary, and only
+    the primary is migrated (the replica is a copy of it).
+    """
+
+    def db_for_read(self, model, **hints):
+        state = _current.get()
+        if state is None or state.alias is None or state.wrote:
+            return DEFAULT_DB_ALIAS
+        if model._meta.app_label not in REPLICA_APPS:
+            return DEFAULT_DB_ALIAS
+        return state.alias
+
+    def db_for_write(self, model, **hints):
+        state = _current.get()
+        if state is not None and model._meta.app_label in REPLICA_APPS:
+            # Later reads of this request must see the write
+            state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Both databases hold the same rows
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db != DEFAULT_DB_ALIAS and db == get_replica_alias():
+            return False
+        return None
@@ -0,0 +1,286 @@
+import datetime
+import json
+
+import numpy as np
+from django.db import transaction
+from django.utils import timezone
+
+from .caching import bump_scores_version
+from .exporters import iter_csv, write_xlsx
+from .importers import CityResolver
+from .models import CityFieldScore, CityFieldScoreHistory, FieldType, check_history_date, rebuild_city_summaries
+from .names import normalize_name
+
+# Synthetic score datasets behind the ``sample_maker`` command. Scores are drawn
+# with NumPy from a small factor model, so fields correlate the way real
+# indicators do (income with education, pollution with traffic, ...), and each
+# month follows the previous one instead of being independent noise:
+#
+#   score = mean + spread * (loadings . city_factors[month] + unique noise)
+#
+# City factors are AR(1) over the months, and most of a cell's own noise is
+# fixed per (city, field), so a month is close to the one before it.
+# Every random draw comes from a generator seeded with (seed, stream, month,
+# block of cities), so a seed gives the same dataset whatever is generated or
+# written around it, and a month is built a block of cities at a time without
+# holding more than one matrix of uint8 scores (0 = missing) in memory.
+
+SAMPLE_FORMATS = ("csv", "xlsx", "json", "npz")
+SAMPLE_SUFFIXES = {"csv": ".csv", "xlsx": ".xlsx", "json": ".json", "npz": ".npz"}
+SAMPLE_FACTORS = 3
+SAMPLE_BLOCK_CITIES = 1024
+MONTHLY_PERSISTENCE = 0.9  # AR(1) coefficient of the city factors
+PERSISTENT_NOISE_SHARE = 0.7  # share of a cell's own noise that stays the same every month
+
+# The original 31 x 30 sample: real provinces and metrics first, numbered synthetic ones after
+SAMPLE_PROVINCES = (
+    "آذربایجان شرقی", "آذربایجان غربی", "اردبیل", "اصفهان", "البرز", "ایلام",
+    "بوشهر", "تهران", "چهارمحال و بختیاری", "خراسان جنوبی", "خراسان رضوی",
+    "خراسان شمالی", "خوزستان", "زنجان", "سمنان", "سیستان و بلوچستان", "فارس",
+    "قزوین", "قم", "کردستان", "کرمان", "کرمانشاه", "کهگیلویه و بویراحمد",
+    "گلستان", "گیلان", "لرستان", "مازندران", "مرکزی", "هرمزگان", "همدان", "یزد",
+)
+SAMPLE_METRICS = (
+    "میزان شادی", "میزان ترافیک", "میزان سلامتی", "میزان رضایتمندی", "میزان آلودگی",
+    "میزان اقتصادی", "میزان مطالعه عمومی", "میزان تفریحات", "میزان تحصیلات",
+    "میزان درآمد", "میزان مصرف انرژی", "میزان خستگی", "میزان امنیت", "میزان مصرف آب",
+    "میزان ورزش", "میزان خواب", "میزان استرس", "میزان مشارکت اجتماعی",
+    "میزان نوآوری", "میزان تولید زباله", "میزان رضایت مشتری", "میزان پیشرفت شغلی",
+    "میزان خلاقیت", "میزان دسترسی به خدمات بهداشتی", "میزان ترافیک اینترنت",
+    "میزان فعالیت فرهنگی", "میزان تعاملات خانوادگی", "میزان کیفیت هوا",
+    "میزان هزینه‌های زندگی", "میزان یادگیری مهارت‌های جدید",
+)
+
+# Random streams; part of the seed so adding a stream never shifts the others
+_FIELDS, _CITY_FACTORS, _PERSISTENT_NOISE, _MONTH_NOISE = range(4)
+
+
+def sample_city_names(count):
+    names = list(SAMPLE_PROVINCES[:count])
+    return names + [f"شهر نمونه {index:06d}" for index in range(len(names), count)]
+
+
+def sample_field_names(count):
+    names = list(SAMPLE_METRICS[:count])
+    return names + [f"شاخص نمونه {index:04d}" for index in range(len(names), count)]
+
+
+def sample_months(periods, end=None):
+    """The first days of ``periods`` consecutive months ending with ``end`` (default: this month)."""
+    end = end or timezone.localdate()
+    index = end.year * 12 + end.month - 1
+    return [
+        datetime.date(month // 12, month % 12 + 1, 1)
+        for month in range(index - periods + 1, index + 1)
+    ]
+
+
+def _rng(seed, *stream):
+    return np.random.default_rng([seed, *stream])
+
+
+def _ar1(rng, shape, month):
+    # A stationary unit-variance AR(1) process at ``month``; replayed from month 0, it is small
+    values = rng.standard_normal(shape)
+    innovation = np.sqrt(1 - MONTHLY_PERSISTENCE**2)
+    for _ in range(month):
+        values = MONTHLY_PERSISTENCE * values + innovation * rng.standard_normal(shape)
+    return values
+
+
+class SampleGenerator:
+    """
+    Deterministic ``cities`` x ``fields`` scores for ``periods`` months.
+
+    ``month(index)`` returns that month's scores as a ``cities x fields`` uint8
+    array with 0 for missing cells (the json_converter columnar layout);
+    ``missing`` is the share of cells left empty.
+    """
+
+    def __init__(self, cities, fields, periods=1, seed=0, missing=0.0):
+        if cities < 1 or fields < 1 or periods < 1:
+            raise ValueError("A sample needs at least one city, one field and one period")
+        if not 0 <= missing < 1:
+            raise ValueError(f"missing must be in [0, 1), got {missing}")
+        self.cities, self.fields, self.periods = cities, fields, periods
+        self.seed, self.missing = seed, missing
+
+        rng = _rng(seed, _FIELDS)
+        # Each field loads on the shared factors with a strength (communality) of 0.3 to 0.9;
+        # the rest of its variance is its own, so every field's latent value has unit variance
+        loadings = rng.standard_normal((fields, SAMPLE_FACTORS))
+        loadings /= np.linalg.norm(loadings, axis=1, keepdims=True)
+        strength = rng.uniform(0.3, 0.9, fields)
+        self.loadings = loadings * np.sqrt(strength)[:, None]
+        self.unique = np.sqrt(1 - strength)
+        self.means = rng.uniform(35, 70, fields)
+        self.spreads = rng.uniform(8, 20, fields)
+
+    def _block(self, start, month):
+        block = start // SAMPLE_BLOCK_CITIES
+        size = min(SAMPLE_BLOCK_CITIES, self.cities - start)
+        factors = _ar1(_rng(self.seed, _CITY_FACTORS, block), (size, SAMPLE_FACTORS), month)
+        persistent = _rng(self.seed, _PERSISTENT_NOISE, block).standard_normal((size, self.fields))
+        rng = _rng(self.seed, _MONTH_NOISE, month, block)
+        noise = (
+            np.sqrt(PERSISTENT_NOISE_SHARE) * persistent
+            + np.sqrt(1 - PERSISTENT_NOISE_SHARE) * rng.standard_normal((size, self.fields))
+        )
+        latent = factors @ self.loadings.T + noise * self.unique
+        scores = np.clip(np.rint(self.means + self.spreads * latent), 1, 100).astype(np.uint8)
+        if self.missing:
+            scores[rng.random((size, self.fields)) < self.missing] = 0
+        return scores
+
+    def month(self, index):
+        if not 0 <= index < self.periods:
+            raise IndexError(f"Month {index} out of range for {self.periods} periods")
+        scores = np.empty((self.cities, self.fields), dtype=np.uint8)
+        for start in range(0, self.cities, SAMPLE_BLOCK_CITIES):
+            scores[start:start + SAMPLE_BLOCK_CITIES] = self._block(start, index)
+        return scores
+
+    def __iter__(self):
+        for index in range(self.periods):
+            yield self.month(index)
+
+
+def iter_sample_rows(city_names, field_names, scores):
+    """The import_scores sheet layout of a score matrix: cities as columns, a row per field."""
+    yield ["", *city_names]
+    for field_name, column in zip(field_names, scores.T):
+        yield [field_name, *(score or None for score in column.tolist())]
+
+
+def write_sample(path, output_format, city_names, field_names, scores):
+    """Write one month of scores in ``output_format`` (see SAMPLE_FORMATS)."""
+    if output_format == "csv":
+        with open(path, "w", newline="", encoding="utf-8") as f:
+            f.writelines(iter_csv(iter_sample_rows(city_names, field_names, scores)))
+    elif output_format == "xlsx":
+        write_xlsx(iter_sample_rows(city_names, field_names, scores), path)
+    elif output_format == "json":
+        # json_converter's compact columnar layout; dumps() encodes in one C call, dump() a piece at a time
+        data = {"cities": list(city_names), "fields": list(field_names), "scores": scores.tolist()}
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(json.dumps(data, ensure_ascii=False, separators=(",", ":")))
+    elif output_format == "npz":
+        np.savez(path, cities=np.array(city_names), fields=np.array(field_names), scores=scores)
+    else:
+        raise ValueError(f"Unsupported sample format: {output_format}")
+    return path
+
+
+def _field_ids(names, batch_size):
+    ids = {normalize_name(name): field_id for field_id, name in FieldType.objects.values_list("id", "name")}
+    missing = {}
+    for name in names:
+        missing.setdefault(normalize_name(name), name)
+    missing = {key: name for key, name in missing.items() if key not in ids}
+    FieldType.objects.bulk_create([FieldType(name=name) for name in missing.values()], batch_size=batch_size)
+    created = dict(FieldType.objects.filter(name__in=missing.values()).values_list("name", "id"))
+    ids.update((key, created[name]) for key, name in missing.items())
+    return np.array([ids[normalize_name(name)] for name in names]), len(missing)
+
+
+def _iter_cell_batches(city_ids, field_ids, scores, batch_size):
+    # (city_id, field_id, score) of the non-missing cells, batch_size at a time
+    for start in range(0, len(scores), SAMPLE_BLOCK_CITIES):
+        block = scores[start:start + SAMPLE_BLOCK_CITIES]
+        rows, columns = np.nonzero(block)
+        for offset in range(0, len(rows), batch_size):
+            batch = slice(offset, offset + batch_size)
+            yield list(zip(
+                city_ids[start + rows[batch]].tolist(),
+                field_ids[columns[batch]].tolist(),
+                block[rows[batch], columns[batch]].tolist(),
+            ))
+
+
+def _set_current_scores(city_ids, field_ids, scores, effective_at, batch_size):
+    """
+    Make ``scores`` (the last month, dated ``effective_at``) the current value of
+    every pair in it, like ScoreWriter: pairs with newer history keep their
+    current score, and pairs the month leaves empty lose theirs, with a removal
+    recorded in the history.
+    """
+    # Pairs whose current value (or removal) is dated after the sample
+    superseded = set(
+        CityFieldScoreHistory.objects.filter(field_id__in=field_ids.tolist(), effective_at__gt=effective_at)
+        .values_list("city_id", "field_id")
+        .distinct()
+    )
+    for cells in _iter_cell_batches(city_ids, field_ids, scores, batch_size):
+        CityFieldScore.objects.bulk_create(
+            [
+                CityFieldScore(city_id=city_id, field_id=field_id, score=score)
+                for city_id, field_id, score in cells
+                if (city_id, field_id) not in superseded
+            ],
+            update_conflicts=True,
+            unique_fields=["city", "field"],
+            update_fields=["score"],
+        )
+
+    rows = {city_id: row for row, city_id in enumerate(city_ids.tolist())}
+    columns = {field_id: column for column, field_id in enumerate(field_ids.tolist())}
+    removed = [
+        (score_id, city_id, field_id)
+        for score_id, city_id, field_id in CityFieldScore.objects.filter(field_id__in=columns)
+        .values_list("id", "city_id", "field_id")
+        .iterator()
+        if city_id in rows and not scores[rows[city_id], columns[field_id]] and (city_id, field_id) not in superseded
+    ]
+    for start in range(0, len(removed), batch_size):
+        batch = removed[start:start + batch_size]
+        # Without the per-row delete signals, like the bulk writes: the removal is dated to the month below
+        scores_to_remove = CityFieldScore.objects.filter(id__in=[score_id for score_id, _, _ in batch])
+        scores_to_remove._raw_delete(scores_to_remove.db)
+        CityFieldScoreHistory.objects.bulk_create(
+            [
+                CityFieldScoreHistory(city_id=city_id, field_id=field_id, score=None, effective_at=effective_at)
+                for _, city_id, field_id in batch
+            ]
+        )
+    return len(removed)
+
+
+def load_sample(generator, city_names, field_names, months, batch_size=5000, log=None):
+    """
+    Load a sample straight into the database in one transaction: every month
+    into CityFieldScoreHistory at its first day, the last month into
+    CityFieldScore (see _set_current_scores()). Returns
+    ``(cities created, fields created, history rows)``. Raises ValueError when
+    the first month falls before a ScoreSnapshot (see check_history_date()).
+    """
+    moments = [timezone.make_aware(datetime.datetime.combine(month, datetime.time.min)) for month in months]
+    check_history_date(moments[0])
+    with transaction.atomic():
+        resolver = CityResolver()
+        cities_created = resolver.create_missing(set(city_names), batch_size)
+        city_ids = np.array([resolver.get(name) for name in city_names])
+        field_ids, fields_created = _field_ids(field_names, batch_size)
+
+        history_rows = 0
+        for month, effective_at, scores in zip(months, moments, generator):
+            written = 0
+            # bulk_create skips MainApplication.signals; history, summaries and the version are kept here
+            for cells in _iter_cell_batches(city_ids, field_ids, scores, batch_size):
+                CityFieldScoreHistory.objects.bulk_create(
+                    [
+                        CityFieldScoreHistory(city_id=city_id, field_id=field_id, score=score, effective_at=effective_at)
+                        for city_id, field_id, score in cells
+                    ]
+                )
+                written += len(cells)
+            history_rows += written
+            if log:
+                log(f"{month:%Y-%m}: {written} scores")
+
+        # The last month is the current value
+        removed = _set_current_scores(city_ids, field_ids, scores, effective_at, batch_size)
+        if log and removed:
+            log(f"{removed} current scores missing from {month:%Y-%m} removed")
+        rebuild_city_summaries(set(city_ids.tolist()))
+        bump_scores_version()
+    return cities_created, fields_created, history_rows
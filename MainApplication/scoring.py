@@ -0,0 +1,188 @@
+import threading
+
+import numpy as np
+
+from .caching import get_scores_version
+from .models import (
+    City,
+    CityFieldScore,
+    FieldType,
+    ScoringProfile,
+    ScoringProfileWeight,
+    get_color_for_score,
+    path_ids,
+)
+
+# Weighted map scores. Every map city's scores, rolled up over its sub-units, live in
+# one dense cities x fields matrix, built once per scores version (profile edits bump it too) and kept in
+# process memory, so re-weighting the map is a single matrix product instead of
+# SQL aggregation.
+
+# Lower bounds of the color bands in get_color_for_score, and each band's color
+COLOR_BOUNDS = (20, 50, 70, 90)
+COLORS = tuple(get_color_for_score(bound) for bound in (0, *COLOR_BOUNDS))
+MAX_SCORE = 100
+# Largest ad-hoc weight; far larger ones overflow the weighted sums to inf and the averages to NaN
+MAX_WEIGHT = 1000
+
+
+class ScoreMatrix:
+    """
+    Score totals of the map cities over their whole subtree (MainApplication.models.City.path):
+    per field the ``sums`` of the scores next to their ``counts``, stacked as one
+    ``cities x 2*fields`` matrix. For a city without sub-units that is simply its
+    score and a 0/1 mask.
+    """
+
+    def __init__(self, slugs, names, field_ids, field_names, sums, counts, profiles):
+        self.slugs = slugs
+        self.names = names
+        self.slug_index = {slug: index for index, slug in enumerate(slugs)}
+        self.field_ids = field_ids
+        self.field_names = field_names
+        self.field_index = {field_id: index for index, field_id in enumerate(field_ids)}
+        self.stacked = np.hstack([sums, counts])
+        # {slug: (name, {field_id: (weight, lower_is_better)})}
+        self.profiles = profiles
+        self._memo = {}
+
+    @property
+    def values(self):
+        """Mean score per city and field (0 where missing)."""
+        field_count = len(self.field_ids)
+
+        def compute():
+            sums, counts = self.stacked[:, :field_count], self.stacked[:, field_count:]
+            return np.divide(sums, counts, out=np.zeros_like(sums), where=counts > 0)
+
+        return self.memoized("values", compute)
+
+    @property
+    def present(self):
+        """0/1 mask of the city and field pairs that have a score."""
+        return self.memoized("present", lambda: (self.stacked[:, len(self.field_ids) :] > 0).astype(float))
+
+    def memoized(self, key, compute):
+        """Return ``compute()``, computed once per ``key`` for the life of this matrix (one scores version)."""
+        try:
+            return self._memo[key]
+        except KeyError:
+            # Two threads may both compute a missing key; the results are equal
+            return self._memo.setdefault(key, compute())
+
+    @classmethod
+    def build(cls):
+        cities = list(City.objects.filter(slug__isnull=False).order_by("id").values_list("id", "slug", "name"))
+        fields = list(FieldType.objects.order_by("id").values_list("id", "name"))
+        field_ids = [field_id for field_id, _ in fields]
+        city_ids = np.array([city_id for city_id, _, _ in cities], dtype=np.int64)
+        sums = np.zeros((len(cities), len(field_ids)))
+        counts = np.zeros_like(sums)
+
+        cells = np.array(
+            list(CityFieldScore.objects.values_list("city_id", "field_id", "score")), dtype=np.int64
+        ).reshape(-1, 3)
+        # Scores of sub-units count for the top-level city of their path
+        sub_units = np.array(
+            [(city_id, path_ids(path)[0]) for city_id, path in City.objects.filter(depth__gt=0).values_list("id", "path")],
+            dtype=np.int64,
+        ).reshape(-1, 2)
+        owners = cells[:, 0]
+        if len(sub_units):
+            sub_units = sub_units[np.argsort(sub_units[:, 0])]
+            position = np.searchsorted(sub_units[:, 0], owners).clip(max=len(sub_units) - 1)
+            owners = np.where(sub_units[position, 0] == owners, sub_units[position, 1], owners)
+
+        # Both id lists are sorted, so ids map to rows/columns with a binary search
+        rows = np.searchsorted(city_ids, owners).clip(max=max(len(city_ids) - 1, 0))
+        on_map = city_ids[rows] == owners if len(city_ids) else np.zeros(len(owners), dtype=bool)
+        columns = np.searchsorted(np.array(field_ids, dtype=np.int64), cells[:, 1])
+        np.add.at(sums, (rows[on_map], columns[on_map]), cells[on_map, 2])
+        np.add.at(counts, (rows[on_map], columns[on_map]), 1)
+
+        profiles = {slug: (name, {}) for slug, name in ScoringProfile.objects.values_list("slug", "name")}
+        weights = ScoringProfileWeight.objects.values_list("profile__slug", "field_id", "weight", "lower_is_better")
+        for slug, field_id, weight, lower_is_better in weights:
+            profiles[slug][1][field_id] = (weight, lower_is_better)
+
+        return cls(
+            [slug for _, slug, _ in cities],
+            [name for _, _, name in cities],
+            field_ids,
+            [name for _, name in fields],
+            sums,
+            counts,
+            profiles,
+        )
+
+    def averages(self, weights=None):
+        """
+        Weighted average per city over all scores of its subtree.
+
+        ``weights`` maps field id to ``(weight, lower_is_better)``; other fields
+        weigh 1, higher is better. A lower-is-better score ``s`` counts as
+        ``101 - s``. Weighted sums and the weight each city actually has come
+        out of one product of the stacked matrix with a ``2*fields x 2`` matrix.
+        """
+        field_count = len(self.field_ids)
+        weight = np.ones(field_count)
+        lower = np.zeros(field_count, dtype=bool)
+        for field_id, (field_weight, lower_is_better) in (weights or {}).items():
+            index = self.field_index.get(field_id)
+            if index is not None:
+                weight[index] = field_weight
+                lower[index] = lower_is_better
+
+        coefficients = np.zeros((2 * field_count, 2))
+        coefficients[:field_count, 0] = np.where(lower, -weight, weight)  # score term
+        coefficients[field_count:, 0] = np.where(lower, (MAX_SCORE + 1) * weight, 0)  # constant of 101 - s
+        coefficients[field_count:, 1] = weight  # total weight of the scores per city
+        totals = self.stacked @ coefficients
+        return np.divide(totals[:, 0], totals[:, 1], out=np.zeros(len(self.slugs)), where=totals[:, 1] > 0)
+
+    def colored_scores(self, weights=None):
+        """Return ``[(slug, name, rounded average, color), ...]`` colored like get_color_for_score."""
+        averages = np.round(self.averages(weights), 2)
+        bands = np.digitize(averages, COLOR_BOUNDS)
+        return [
+            (slug, name, float(average), COLORS[band])
+            for slug, name, average, band in zip(self.slugs, self.names, averages.tolist(), bands.tolist())
+        ]
+
+
+_lock = threading.Lock()
+_cached = (None, None)  # (scores version, ScoreMatrix)
+
+
+def get_score_matrix():
+    """Return this process's ScoreMatrix, rebuilt when the scores version changes."""
+    global _cached
+    version = get_scores_version()
+    cached_version, matrix = _cached
+    if cached_version != version:
+        with _lock:
+            cached_version, matrix = _cached
+            if cached_version != version:
+                matrix = ScoreMatrix.build()
+                _cached = (version, matrix)
+    return matrix
+
+
+def parse_weights(value):
+    """
+    Parse ad-hoc weights ``"12:2,15:0.5,18:-1"`` (field id: weight) into
+    ``{field_id: (weight, lower_is_better)}``; a negative weight means lower is better.
+    Weights beyond +-MAX_WEIGHT are rejected.
+    """
+    weights = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        field_id, sep, weight = item.partition(":")
+        try:
+            weight = float(weight) if sep else 1.0
+            field_id = int(field_id)
+        except ValueError:
+            raise ValueError(f"Invalid weight {item!r}; expected FIELD_ID:WEIGHT")
+        if not np.isfinite(weight) or abs(weight) > MAX_WEIGHT:
+            raise ValueError(f"Invalid weight {item!r}; weights range from -{MAX_WEIGHT} to {MAX_WEIGHT}")
+        weights[field_id] = (abs(weight), weight < 0)
+    return weights
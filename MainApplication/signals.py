@@ -0,0 +1,107 @@
+from django.db.models import QuerySet
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from .caching import bump_scores_version
+from .models import (
+    City,
+    CityFieldScore,
+    CityFieldScoreHistory,
+    FieldType,
+    ScoringProfile,
+    ScoringProfileWeight,
+    apply_score_delta,
+    path_ids,
+    place_city,
+    rebuild_city_summaries,
+)
+from .names import normalize_name, slug_for_name
+
+
+# Runs for fixture loads too (raw saves skip Model.save() but still send pre_save)
+@receiver(pre_save, sender=City)
+def fill_city_keys(sender, instance, **kwargs):
+    instance.name_key = normalize_name(instance.name)
+    # Only top-level units are regions of the map
+    if not instance.slug and instance.parent_id is None:
+        slug = slug_for_name(instance.name)
+        # Another spelling of the same city may already own the slug
+        if slug and not City.objects.filter(slug=slug).exclude(pk=instance.pk).exists():
+            instance.slug = slug
+
+
+@receiver(pre_save, sender=City)
+def keep_city_path(sender, instance, **kwargs):
+    # path and depth are only written by place_city(); a stale instance must not save them back
+    stored = None
+    if instance.pk is not None:
+        stored = City.objects.filter(pk=instance.pk).values_list("path", "depth").first()
+    instance.path, instance.depth = stored or ("", 0)
+    instance._stored_path = instance.path
+    if stored is not None and instance.parent_id is not None:
+        parent_path = City.objects.filter(pk=instance.parent_id).values_list("path", flat=True).first() or ""
+        if instance.pk in path_ids(parent_path):
+            raise ValueError("A city cannot be placed under itself or one of its sub-units")
+
+
+@receiver(post_save, sender=City)
+def city_saved(sender, instance, **kwargs):
+    place_city(instance, getattr(instance, "_stored_path", ""))
+
+
+@receiver(post_save, sender=CityFieldScore)
+def score_saved(sender, instance, created, raw, **kwargs):
+    # Set by CityFieldScore.from_db; missing for instances that were never loaded
+    original = getattr(instance, "_original_score", None)
+    if original is not None and None in original:
+        original = None
+    current = (instance.city_id, instance.field_id, instance.score)
+    instance._original_score = current
+
+    if created:
+        apply_score_delta(instance.city_id, instance.score, 1)
+    elif raw or original is None:
+        # Fixture loads and saves of hand-built instances: previous value is unknown
+        rebuild_city_summaries([instance.city_id])
+    elif original[0] != instance.city_id:
+        apply_score_delta(original[0], -original[2], -1)
+        apply_score_delta(instance.city_id, instance.score, 1)
+    elif original[2] != instance.score:
+        apply_score_delta(instance.city_id, instance.score - original[2], 0)
+
+    if raw or original == current:
+        return
+    history = []
+    if original is not None and original[:2] != current[:2]:
+        # Moved to another city/field: the old pair no longer has a score
+        history.append(CityFieldScoreHistory(city_id=original[0], field_id=original[1], score=None))
+    history.append(CityFieldScoreHistory(city_id=instance.city_id, field_id=instance.field_id, score=instance.score))
+    CityFieldScoreHistory.objects.bulk_create(history)
+
+
+@receiver(post_delete, sender=CityFieldScore)
+def score_deleted(sender, instance, origin=None, **kwargs):
+    original = getattr(instance, "_original_score", None)
+    if original is None or None in original:
+        original = (instance.city_id, instance.field_id, instance.score)
+    apply_score_delta(original[0], -original[2], -1)
+
+    # Cascades from a deleted city or field take their history with them
+    origin_model = origin.model if isinstance(origin, QuerySet) else type(origin)
+    if origin_model is CityFieldScore:
+        CityFieldScoreHistory.objects.create(city_id=original[0], field_id=original[1], score=None)
+
+
+# Any write that can change a rendered page invalidates the response cache
+@receiver(post_save, sender=City)
+@receiver(post_delete, sender=City)
+@receiver(post_save, sender=FieldType)
+@receiver(post_delete, sender=FieldType)
+@receiver(post_save, sender=CityFieldScore)
+@receiver(post_delete, sender=CityFieldScore)
+@receiver(post_save, sender=ScoringProfile)
+@receiver(post_delete, sender=ScoringProfile)
+@receiver(post_save, sender=ScoringProfileWeight)
+@receiver(post_delete, sender=ScoringProfileWeight)
+def invalidate_cached_pages(sender, **kwargs):
+    bump_scores_version()
@@ -15,14 +15,22 @@ const clearChatButton = document.querySelector("#clear-chat");
 // API setup
 const CHAT_API_BASE = (document.body.getAttribute("data-chat-api-base") || window.location.origin).replace(/\/$/, "");
 const API_URL = `${CHAT_API_BASE}/api/v1/query/text`;
+// Server-side gateway (api/v1/chat/): builds the city context, caches answers and streams them back
+const CHAT_PROXY_URL = document.body.getAttribute("data-chat-proxy-url") || "";
 const DEFAULT_TEMPERATURE = 0.7;
 const DEFAULT_MAX_TOKENS = 5000;
+// The gateway endpoints are CSRF-protected; the pages set the csrftoken cookie
+const getCsrfToken = () => {
+  const match = document.cookie.match(/(?:^|;\s*)csrftoken=([^;]+)/);
+  return match ? decodeURIComponent(match[1]) : "";
+};
 const SESSION_DURATION_MINUTES = 20;
 const SESSION_DURATION_MS = SESSION_DURATION_MINUTES * 60 * 1000;
 const userKey = document.body.getAttribute("data-chat-user") || "anonymous";
 const pageType = document.body.getAttribute("data-page-type") || "unknown";
 const pageCityName = document.body.getAttribute("data-city-name") || "";
 const pageCitySlug = document.body.getAttribute("data-city-slug") || "";
+const pageCityContextUrl = document.body.getAttribute("data-city-context-url") || "";
 const SESSION_STORAGE_KEY = `chatSession:${userKey}`;
 const HISTORY_STORAGE_PREFIX = `chatHistory:${userKey}:`;
 const CITY_CONTEXT_KEY = `cityContext:${userKey}`;
@@ -165,6 +173,24 @@ const updateCityContextFromPage = () => {
   persistCityContextMap(contextMap);
   session.activeCitySlug = pageCitySlug;
   persistSession(session);
+  loadServerCityContext();
+};
+
+// Replace the field list with the server's bounded summary (average, rank, strongest/weakest fields)
+const loadServerCityContext = async () => {
+  if (!pageCityContextUrl) return;
+  try {
+    const response = await fetch(pageCityContextUrl);
+    if (!response.ok) return;
+    const data = await response.json();
+    const contextMap = loadCityContextMap();
+    if (data && data.t && contextMap[pageCitySlug]) {
+      contextMap[pageCitySlug].text = data.t;
+      persistCityContextMap(contextMap);
+    }
+  } catch (error) {
+    console.log(error);
+  }
 };
 
 const getActiveCityContext = () => {
@@ -174,7 +200,7 @@ const getActiveCityContext = () => {
   return contextMap[activeSlug] || null;
 };
 
-const buildHistoryContextText = (currentQuery) => {
+const getRecentHistory = (currentQuery) => {
   let recent = chatHistory.slice(-6);
   if (currentQuery) {
     const lastItem = recent[recent.length - 1];
@@ -182,6 +208,11 @@ const buildHistoryContextText = (currentQuery) => {
       recent = recent.slice(0, -1);
     }
   }
+  return recent.map((item) => ({ role: item.role, type: item.type, text: item.text }));
+};
+
+const buildHistoryContextText = (currentQuery) => {
+  const recent = getRecentHistory(currentQuery);
   if (!recent.length) return "";
   return recent
     .map((item) => {
@@ -197,6 +228,7 @@ const buildHistoryContextText = (currentQuery) => {
 const buildCityContextText = () => {
   const cityContext = getActiveCityContext();
   if (!cityContext) return "";
+  if (cityContext.text) return cityContext.text;
   const fieldsText = cityContext.fields
     .map((field) => `${field.name}: ${field.score}`)
     .join("، ");
@@ -294,10 +326,72 @@ const extractResponseText = (data) => {
   return null;
 };
 
+// Stream the answer from the gateway into the message bubble as it arrives
+const generateProxiedBotResponse = async (messageElement) => {
+  const response = await fetch(CHAT_PROXY_URL, {
+    method: "POST",
+    headers: { "Content-Type": "application/json", "X-CSRFToken": getCsrfToken() },
+    credentials: "same-origin",
+    body: JSON.stringify({
+      query: userData.message,
+      city: getActiveCitySlug(),
+      history: getRecentHistory(userData.message),
+      temperature: DEFAULT_TEMPERATURE,
+      max_tokens: DEFAULT_MAX_TOKENS,
+    }),
+  });
+  if (!response.ok) {
+    const data = await response.json().catch(() => null);
+    throw new Error((data && data.message) || "خطا در ارتباط با سرویس دستیار.");
+  }
+
+  let text = "";
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  for (;;) {
+    let chunk;
+    try {
+      chunk = await reader.read();
+    } catch (error) {
+      // The gateway aborts the response when the assistant fails mid-answer
+      throw new Error(`${text}\n\nپاسخ دستیار ناتمام ماند.`.trim());
+    }
+    const { done, value } = chunk;
+    if (done) break;
+    text += decoder.decode(value, { stream: true });
+    messageElement.innerText = text.replace(/\*\*(.*?)\*\*/g, "$1");
+  }
+  text += decoder.decode();
+  return text;
+};
+
 // Generate bot response using API
 const generateBotResponse = async (incomingMessageDiv) => {
   const messageElement = incomingMessageDiv.querySelector(".message-text");
 
+  if (CHAT_PROXY_URL) {
+    try {
+      const answerText = ((await generateProxiedBotResponse(messageElement)) || "پاسخی دریافت نشد.")
+        .replace(/\*\*(.*?)\*\*/g, "$1")
+        .trim();
+      messageElement.innerText = answerText;
+      persistMessage("bot", answerText);
+    } catch (error) {
+      console.log(error);
+      messageElement.innerText = error.message;
+      messageElement.style.color = "#ff0000";
+      persistMessage("bot", error.message);
+    } finally {
+      incomingMessageDiv.classList.remove("thinking");
+      setTimeout(() => {
+        if (chatBody) {
+          chatBody.scrollTo({ top: chatBody.scrollHeight, behavior: "smooth" });
+        }
+      }, 100);
+    }
+    return;
+  }
+
   const augmentedQuery = buildAugmentedQuery(userData.message);
   const cityContext = getActiveCityContext();
   const requestOptions = {
@@ -313,7 +407,7 @@ const generateBotResponse = async (incomingMessageDiv) => {
               name: cityContext.name,
               slug: cityContext.slug,
               average_score: cityContext.averageScore,
-              fields: cityContext.fields,
+              fields: cityContext.text ? undefined : cityContext.fields,
             },
           }
         : undefined,
@@ -513,7 +607,7 @@ chatbotToggler.addEventListener("click", () => {
   });
 
 // Voice query functionality
-const VOICE_API_URL = `${CHAT_API_BASE}/api/v1/query/voice`;
+const VOICE_API_URL = document.body.getAttribute("data-chat-voice-url") || `${CHAT_API_BASE}/api/v1/query/voice`;
 const VOICE_LANGUAGE = "fa-IR";
 const MAX_AUDIO_CACHE_BYTES = 1500000;
 let mediaRecorder = null;
@@ -899,6 +993,9 @@ const sendVoiceQuery = async (audioBlob, filename) => {
   try {
     const response = await fetch(VOICE_API_URL, {
       method: "POST",
+      // Only the same-origin gateway gets the token; the header would make a cross-origin call preflight
+      headers: document.body.getAttribute("data-chat-voice-url") ? { "X-CSRFToken": getCsrfToken() } : {},
+      credentials: "same-origin",
       body: formData,
     });
 
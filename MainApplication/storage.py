@@ -0,0 +1,18 @@
+from whitenoise.storage import CompressedManifestStaticFilesStorage
+
+
+class StaticStorage(CompressedManifestStaticFilesStorage):
+    """
+    Hashed, precompressed static files that tolerate broken third-party CSS.
+
+    django-jalali's datepicker theme references images it does not ship, which
+    would otherwise abort collectstatic; such references are left unhashed.
+    """
+
+    def hashed_name(self, name, content=None, filename=None):
+        try:
+            return super().hashed_name(name, content, filename)
+        except ValueError:
+            if content is not None:
+                raise
+            return name
@@ -1,3 +1,1657 @@
-from django.test import TestCase
+import csv
+import datetime
+import json
+import tempfile
+import threading
+from io import BytesIO, StringIO
+from pathlib import Path
 
-# Create your tests here.
+import numpy as np
+from asgiref.sync import sync_to_async
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import IntegrityError, connection, connections, transaction
+from django.test import Client, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from . import analytics, chatbot, geometry
+from .benchmarks import app_urlconf, compare_results, parse_dataset, run_benchmarks, run_concurrency_benchmarks
+from .caching import bump_scores_version, get_scores_version
+from .importers import CityResolver, ScoreWriter
+from .metrics import registry
+from .models import (
+    City,
+    CityFieldScore,
+    CityFieldScoreHistory,
+    CityScoreSummary,
+    FieldType,
+    IngestedFile,
+    ScoreSnapshot,
+    ScoringProfile,
+    ScoringProfileWeight,
+    get_city_average_score,
+    get_field_rankings,
+    get_scores_as_of,
+    get_subtree,
+    path_segment,
+)
+from .names import normalize_name
+from .paginators import EstimatedCountPaginator
+from .routers import STICKY_COOKIE, ReplicaRouter, reading_from_replica
+from .samples import SampleGenerator, sample_city_names, sample_field_names
+from .scoring import get_score_matrix, parse_weights
+from .views import get_map_shell
+
+
+class CacheResetTestCase(TestCase):
+    # Rendered pages live in the cache, which is not rolled back between tests
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+    def committed(self):
+        # Tests run inside a transaction; this runs what waits for the commit (the scores version bump)
+        return self.captureOnCommitCallbacks(execute=True)
+
+
+def make_city(name, scores):
+    city = City.objects.create(name=name)
+    for field_name, score in scores.items():
+        field, _ = FieldType.objects.get_or_create(name=field_name)
+        CityFieldScore.objects.create(city=city, field=field, score=score)
+    return city
+
+
+class MainViewTests(CacheResetTestCase):
+    def test_average_and_color_per_city(self):
+        make_city("تهران", {"میزان شادی": 90, "میزان ترافیک": 100})
+        make_city("قم", {"میزان شادی": 10})
+        City.objects.create(name="یزد")
+
+        response = self.client.get(reverse("Authenticate:Main"))
+
+        self.assertEqual(response.status_code, 200)
+        city_data = response.context["map_data"]["cities"]
+        self.assertEqual(city_data["tehran"]["avg"], 95)
+        self.assertEqual(city_data["tehran"]["color"], "#008000")
+        self.assertEqual(city_data["qom"]["avg"], 10)
+        self.assertEqual(city_data["yazd"]["avg"], 0)
+        self.assertEqual(city_data["qom"]["color"], "#f44336")
+
+    def test_static_shell_is_rendered_once(self):
+        make_city("تهران", {"میزان شادی": 50})
+        get_map_shell.cache_clear()
+        first = self.client.get(reverse("Authenticate:Main"))
+        self.assertTemplateUsed(first, "MainApplication/iranmap_shell.html")
+
+        cache.clear()
+        second = self.client.get(reverse("Authenticate:Main"))
+        self.assertTemplateNotUsed(second, "MainApplication/iranmap_shell.html")
+        self.assertContains(second, '<path class="tehran"')
+        self.assertContains(second, '<script id="map-data" type="application/json">')
+
+    def test_query_count_is_constant(self):
+        make_city("تهران", {"میزان شادی": 50})
+        with self.assertNumQueries(1):
+            self.client.get(reverse("Authenticate:Main"))
+
+        with self.committed():
+            for index, name in enumerate(["قم", "یزد", "فارس", "گیلان", "کرمان"]):
+                make_city(name, {f"فیلد {n}": 10 + index + n for n in range(10)})
+        with self.assertNumQueries(1):
+            self.client.get(reverse("Authenticate:Main"))
+
+
+class CityScoreSummaryTests(CacheResetTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tehran = make_city("تهران", {"میزان شادی": 40, "میزان ترافیک": 60})
+        self.qom = City.objects.create(name="قم")
+
+    def assertSummary(self, city, score_sum, score_count):
+        summary = CityScoreSummary.objects.get(city=city)
+        self.assertEqual((summary.score_sum, summary.score_count), (score_sum, score_count))
+        self.assertAlmostEqual(summary.avg_score, get_city_average_score(city.id))
+
+    def test_create_update_and_delete_are_applied_incrementally(self):
+        self.assertSummary(self.tehran, 100, 2)
+
+        score = CityFieldScore.objects.get(city=self.tehran, field__name="میزان شادی")
+        score.score = 90
+        score.save()
+        self.assertSummary(self.tehran, 150, 2)
+        self.assertEqual(CityScoreSummary.objects.get(city=self.tehran).color, "#66bb6a")
+
+        score.delete()
+        self.assertSummary(self.tehran, 60, 1)
+
+    def test_moving_a_score_to_another_city(self):
+        score = CityFieldScore.objects.get(city=self.tehran, field__name="میزان ترافیک")
+        score.city = self.qom
+        score.save()
+
+        self.assertSummary(self.tehran, 40, 1)
+        self.assertSummary(self.qom, 60, 1)
+
+    def test_deleting_a_city_removes_its_summary(self):
+        self.tehran.delete()
+        self.assertFalse(CityScoreSummary.objects.exists())
+
+    def test_rebuild_and_check_commands(self):
+        CityScoreSummary.objects.filter(city=self.tehran).update(score_sum=1, avg_score=0.5)
+        with self.assertRaises(CommandError):
+            call_command("rebuild_summaries", check=True, stdout=StringIO())
+
+        call_command("rebuild_summaries", stdout=StringIO())
+        self.assertSummary(self.tehran, 100, 2)
+        self.assertSummary(self.qom, 0, 0)
+        call_command("rebuild_summaries", check=True, stdout=StringIO())
+
+
+class ResponseCacheTests(CacheResetTestCase):
+    def setUp(self):
+        super().setUp()
+        self.city = make_city("تهران", {"میزان شادی": 50})
+
+    def test_cache_hit_executes_no_queries(self):
+        first = self.client.get(reverse("Authenticate:Main"))
+        with self.assertNumQueries(0):
+            second = self.client.get(reverse("Authenticate:Main"))
+
+        self.assertEqual(first.content, second.content)
+        self.assertEqual(first["ETag"], second["ETag"])
+
+    def test_unread_query_params_share_the_cached_response(self):
+        url = reverse("Authenticate:Main")
+        first = self.client.get(url)
+        with self.assertNumQueries(0):
+            second = self.client.get(url, {"utm_source": "x", "_": "1700000000"})
+        self.assertEqual(first["ETag"], second["ETag"])
+        self.assertNotEqual(self.client.get(url, {"lod": "low"})["ETag"], first["ETag"])
+
+        rankings = reverse("Authenticate:api_rankings")
+        self.client.get(rankings, {"n": 3, "order": "bottom"})
+        with self.assertNumQueries(0):
+            self.client.get(rankings, {"order": "bottom", "n": 3, "junk": "1"})
+
+    def test_conditional_get_returns_304(self):
+        url = reverse("Authenticate:city_detail", args=["tehran"])
+        etag = self.client.get(url)["ETag"]
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b"")
+
+    def test_score_write_invalidates_cached_pages(self):
+        url = reverse("Authenticate:Main")
+        etag = self.client.get(url)["ETag"]
+
+        with self.committed():
+            CityFieldScore.objects.filter(city=self.city).get().delete()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertEqual(response.context["map_data"]["cities"]["tehran"]["avg"], 0)
+
+    def test_version_changes_when_the_write_commits(self):
+        url = reverse("Authenticate:Main")
+        version = get_scores_version()
+        with self.captureOnCommitCallbacks() as callbacks:
+            with transaction.atomic():
+                writer = ScoreWriter(update=True)
+                writer.add("تهران", "میزان شادی", 90)
+                writer.close()
+                # A reader during the transaction caches under the old version, which the commit retires
+                self.assertEqual(get_scores_version(), version)
+                self.client.get(url)
+        self.assertEqual(get_scores_version(), version)
+        for callback in callbacks:
+            callback()
+        self.assertNotEqual(get_scores_version(), version)
+        self.assertEqual(self.client.get(url).context["map_data"]["cities"]["tehran"]["avg"], 90)
+
+        # Rolled back, nothing is invalidated
+        version = get_scores_version()
+        with self.committed():
+            with transaction.atomic():
+                CityFieldScore.objects.update(score=10)
+                transaction.set_rollback(True)
+        self.assertEqual(get_scores_version(), version)
+
+
+class DataApiTests(CacheResetTestCase):
+    def setUp(self):
+        super().setUp()
+        make_city("تهران", {"میزان شادی": 80, "میزان ترافیک": 61})
+        FieldType.objects.create(name="میزان آلودگی")
+
+    def test_map_payload_is_compact(self):
+        response = self.client.get(reverse("Authenticate:api_map"))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn(b": ", response.content)
+        self.assertEqual(
+            response.json()["c"],
+            [{"s": "tehran", "n": "تهران", "a": 70.5, "c": "#66bb6a"}],
+        )
+        self.assertIn("max-age=60", response["Cache-Control"])
+        self.assertTrue(response["ETag"].startswith('"'))
+
+    def test_city_payload_and_revalidation(self):
+        url = reverse("Authenticate:api_city", args=["tehran"])
+        response = self.client.get(url)
+
+        data = response.json()
+        self.assertEqual(data["a"], 70.5)
+        self.assertEqual(data["f"], [["میزان آلودگی", 0], ["میزان ترافیک", 61], ["میزان شادی", 80]])
+        with self.assertNumQueries(0):
+            revalidated = self.client.get(url, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(revalidated.status_code, 304)
+
+    def test_unknown_city_is_404(self):
+        response = self.client.get(reverse("Authenticate:api_city", args=["atlantis"]))
+        self.assertEqual(response.status_code, 404)
+
+
+class SqlConverterTests(CacheResetTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def run_import(self, data, *args):
+        path = Path(self.tmp.name) / "scores.json"
+        path.write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+        out = StringIO()
+        call_command("sql_converter", "--file", str(path), *args, stdout=out)
+        return out.getvalue()
+
+    def test_bulk_import_creates_everything_in_constant_queries(self):
+        data = {
+            f"شهر {c}": {f"فیلد {f}": (c * 7 + f) % 100 + 1 for f in range(12)}
+            for c in range(40)
+        }
+        with CaptureQueriesContext(connection) as queries:
+            self.run_import(data, "--batch-size", "1000")
+        # 480 cells: snapshot check, preload, create cities (and their paths)/fields, one existing-score
+        # lookup, one newer-history lookup, inserts and what they inserted, history, summaries
+        self.assertLess(len(queries), 22)
+
+        self.assertEqual(City.objects.count(), 40)
+        self.assertEqual(FieldType.objects.count(), 12)
+        self.assertEqual(CityFieldScore.objects.count(), 480)
+        call_command("rebuild_summaries", check=True, stdout=StringIO())
+
+    def test_changed_scores_are_kept_unless_update_is_given(self):
+        make_city("تهران", {"میزان شادی": 10})
+        data = {"تهران": {"میزان شادی": 90, "میزان ترافیک": 0.5}}
+
+        output = self.run_import(data)
+        self.assertIn("1 changed but kept", output)
+        self.assertIn("1 invalid cells skipped", output)
+        self.assertEqual(CityFieldScore.objects.get().score, 10)
+
+        self.run_import(data, "--update")
+        self.assertEqual(CityFieldScore.objects.get().score, 90)
+        self.assertEqual(CityScoreSummary.objects.get().avg_score, 90)
+
+
+class ImportScoresTests(CacheResetTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.rows = [
+            ["", "تهران", "قم"],
+            ["میزان شادی", "32", "67"],
+            ["میزان ترافیک", "45", ""],
+        ]
+
+    def test_csv_is_streamed_into_the_database(self):
+        path = Path(self.tmp.name) / "scores.csv"
+        with open(path, "w", newline="", encoding="utf-8-sig") as f:
+            csv.writer(f).writerows(self.rows)
+
+        out = StringIO()
+        call_command("import_scores", str(path), stdout=out)
+
+        self.assertIn("rows/sec", out.getvalue())
+        self.assertEqual(
+            set(CityFieldScore.objects.values_list("city__name", "field__name", "score")),
+            {("تهران", "میزان شادی", 32), ("قم", "میزان شادی", 67), ("تهران", "میزان ترافیک", 45)},
+        )
+        self.assertEqual(CityScoreSummary.objects.get(city__name="تهران").avg_score, 38.5)
+
+    def test_xlsx_uses_the_same_layout(self):
+        from openpyxl import Workbook
+
+        path = Path(self.tmp.name) / "scores.xlsx"
+        workbook = Workbook()
+        for row in self.rows:
+            workbook.active.append([int(value) if value.isdigit() else value or None for value in row])
+        workbook.save(path)
+
+        call_command("import_scores", str(path), stdout=StringIO())
+
+        self.assertEqual(CityFieldScore.objects.count(), 3)
+        self.assertEqual(CityFieldScore.objects.get(city__name="قم").score, 67)
+
+    def test_unsupported_files_are_rejected(self):
+        with self.assertRaises(CommandError):
+            call_command("import_scores", "scores.json", stdout=StringIO())
+
+
+class JsonConverterTests(CacheResetTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.inputs = []
+        for name, score in (("first", "40"), ("second", "90")):
+            path = Path(self.tmp.name) / f"{name}.csv"
+            with open(path, "w", newline="", encoding="utf-8-sig") as f:
+                csv.writer(f).writerows([["", "تهران", "قم"], ["میزان شادی", score, ""]])
+            self.inputs.append(str(path))
+
+    def test_columnar_json_layout(self):
+        call_command("json_converter", self.inputs[0], "--format", "columnar-json", stdout=StringIO())
+
+        output = Path(self.tmp.name) / "first_from_csv.columnar.json"
+        self.assertEqual(
+            json.loads(output.read_text(encoding="utf-8")),
+            {"cities": ["تهران", "قم"], "fields": ["میزان شادی"], "scores": [[40], [0]]},
+        )
+
+    def test_parallel_npz_conversion_round_trips_through_sql_converter(self):
+        call_command("json_converter", *self.inputs, "--format", "npz", "--jobs", "2", stdout=StringIO())
+
+        for name in ("first", "second"):
+            path = Path(self.tmp.name) / f"{name}_from_csv.npz"
+            call_command("sql_converter", "--file", str(path), "--update", stdout=StringIO())
+
+        self.assertEqual(list(CityFieldScore.objects.values_list("city__name", "score")), [("تهران", 90)])
+
+    def test_columnar_output_skips_cells_the_importers_reject(self):
+        path = Path(self.tmp.name) / "third.csv"
+        with open(path, "w", newline="", encoding="utf-8-sig") as f:
+            csv.writer(f).writerows([["", "تهران", "قم", "یزد", "کرمان"], ["میزان شادی", "40.6", "120", "بالا", "55.0"]])
+        out = StringIO()
+        call_command("json_converter", str(path), "--format", "columnar-json", stdout=out)
+
+        self.assertIn("(3 invalid cells skipped)", out.getvalue())
+        output = Path(self.tmp.name) / "third_from_csv.columnar.json"
+        self.assertEqual(json.loads(output.read_text(encoding="utf-8"))["scores"], [[0], [0], [0], [55]])
+
+
+class FieldRankingTests(CacheResetTestCase):
+    def setUp(self):
+        super().setUp()
+        make_city("تهران", {"میزان شادی": 70, "میزان ترافیک": 10})
+        make_city("قم", {"میزان شادی": 90, "میزان ترافیک": 20})
+        make_city("یزد", {"میزان شادی": 50, "میزان ترافیک": 30})
+
+    def test_duplicate_scores_are_rejected(self):
+        city = City.objects.get(name="قم")
+        field = FieldType.objects.get(name="میزان شادی")
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            CityFieldScore.objects.create(city=city, field=field, score=5)
+
+    def test_top_and_bottom_per_field(self):
+        # The field list, then every field's top rows in one query
+        with self.assertNumQueries(2):
+            top = [(row["field__name"], row["city__name"], row["position"]) for row in get_field_rankings(2)]
+        self.assertEqual(top, [
+            ("میزان ترافیک", "یزد", 1), ("میزان ترافیک", "قم", 2),
+            ("میزان شادی", "قم", 1), ("میزان شادی", "تهران", 2),
+        ])
+
+        bottom = get_field_rankings(1, bottom=True)
+        self.assertEqual([row["score"] for row in bottom], [10, 50])
+
+    def test_limit_below_the_field_size(self):
+        field = FieldType.objects.get(name="میزان شادی")
+        for index in range(20):
+            make_city(f"شهر {index:02d}", {"میزان شادی": 60})
+
+        with CaptureQueriesContext(connection) as queries:
+            top = get_field_rankings(3, field_ids=[field.id])
+        # Each field's rows come from a LIMIT subquery on the (field, score, city) index
+        self.assertIn("LIMIT 3", queries[-1]["sql"])
+        # 90 and 70, then the tie at 60 goes to the newest city; bottom is the exact reverse order
+        newest = City.objects.order_by("-id").first()
+        self.assertEqual([(row["city_id"], row["position"]) for row in top][2], (newest.id, 3))
+        self.assertEqual([row["score"] for row in top], [90, 70, 60])
+        bottom = get_field_rankings(3, bottom=True, field_ids=[field.id])
+        self.assertEqual([row["score"] for row in bottom], [50, 60, 60])
+        self.assertEqual(get_field_rankings(3, field_ids=[field.id + 1000]), [])
+
+    def test_rankings_endpoint(self):
+        field = FieldType.objects.get(name="میزان شادی")
+        response = self.client.get(reverse("Authenticate:api_rankings"), {"n": 2, "field": field.id})
+
+        self.assertEqual(response.json()["f"], [{
+            "i": field.id,
+            "n": "میزان شادی",
+            "r": [[1, "qom", "قم", 90], [2, "tehran", "تهران", 70]],
+        }])
+
+
+class ScoreHistoryTests(CacheResetTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def import_on(self, day, rows):
+        path = Path(self.tmp.name) / f"{day}.csv"
+        with open(path, "w", newline="", encoding="utf-8") as f:
+            csv.writer(f).writerows(rows)
+        call_command("import_scores", str(path), "--update", "--effective-at", day, stdout=StringIO())
+
+    def scores_on(self, day):
+        when = timezone.make_aware(datetime.datetime.combine(datetime.date.fromisoformat(day), datetime.time.max))
+        return {
+            (City.objects.get(id=city_id).name, FieldType.objects.get(id=field_id).name): score
+            for (city_id, field_id), score in get_scores_as_of(when).items()
+        }
+
+    def test_edits_and_deletes_are_recorded(self):
+        city = make_city("تهران", {"میزان شادی": 40})
+        score = CityFieldScore.objects.get(city=city)
+        score.score = 60
+        score.save()
+        score.save()  # unchanged, not recorded again
+        score.delete()
+
+        history = CityFieldScoreHistory.objects.filter(city=city).order_by("id")
+        self.assertEqual(list(history.values_list("score", flat=True)), [40, 60, None])
+
+    def test_scores_as_of_with_and_without_snapshot(self):
+        self.import_on("2024-01-01", [["", "تهران", "قم"], ["میزان شادی", "30", "50"]])
+        self.import_on("2024-06-01", [["", "تهران"], ["میزان شادی", "80"]])
+
+        expected_march = {("تهران", "میزان شادی"): 30, ("قم", "میزان شادی"): 50}
+        expected_july = {("تهران", "میزان شادی"): 80, ("قم", "میزان شادی"): 50}
+        self.assertEqual(self.scores_on("2023-12-31"), {})
+        self.assertEqual(self.scores_on("2024-03-01"), expected_march)
+        self.assertEqual(self.scores_on("2024-07-01"), expected_july)
+
+        call_command("compact_score_history", "--at", "2024-03-01", "--prune", stdout=StringIO())
+
+        self.assertEqual(ScoreSnapshot.objects.count(), 1)
+        self.assertEqual(CityFieldScoreHistory.objects.count(), 1)
+        self.assertEqual(self.scores_on("2024-03-01"), expected_march)
+        self.assertEqual(self.scores_on("2024-07-01"), expected_july)
+
+    def test_a_late_older_month_only_reaches_history(self):
+        self.import_on("2024-06-01", [["", "تهران"], ["میزان شادی", "80"]])
+        self.import_on("2024-01-01", [["", "تهران"], ["میزان شادی", "30"]])
+
+        self.assertEqual(CityFieldScore.objects.get().score, 80)
+        self.assertEqual(self.scores_on("2024-03-01"), {("تهران", "میزان شادی"): 30})
+        self.assertEqual(self.scores_on("2024-07-01"), {("تهران", "میزان شادی"): 80})
+
+    def test_skipped_scores_are_not_recorded(self):
+        make_city("تهران", {"میزان شادی": 40})
+        path = Path(self.tmp.name) / "scores.csv"
+        path.write_text("\nمیزان شادی,90\n".join([",تهران", ""]), encoding="utf-8")
+        out = StringIO()
+        call_command("import_scores", str(path), stdout=out)
+
+        self.assertIn("1 changed but kept", out.getvalue())
+        self.assertEqual(CityFieldScore.objects.get().score, 40)
+        self.assertEqual(list(CityFieldScoreHistory.objects.values_list("score", flat=True)), [40])
+
+    def test_history_before_a_snapshot_is_rejected(self):
+        self.import_on("2024-01-01", [["", "تهران"], ["میزان شادی", "30"]])
+        call_command("compact_score_history", "--at", "2024-03-01", stdout=StringIO())
+
+        with self.assertRaisesMessage(CommandError, "snapshot"):
+            self.import_on("2024-02-01", [["", "تهران"], ["میزان شادی", "60"]])
+        self.assertEqual(self.scores_on("2024-03-01"), {("تهران", "میزان شادی"): 30})
+
+    def test_api_as_of(self):
+        self.import_on("2024-01-01", [["", "تهران"], ["میزان شادی", "30"], ["میزان ترافیک", "50"]])
+        self.import_on("2024-06-01", [["", "تهران"], ["میزان شادی", "90"]])
+
+        past = self.client.get(reverse("Authenticate:api_map"), {"as_of": "2024-03-01"}).json()
+        self.assertEqual(past["c"][0]["a"], 40)
+        self.assertTrue(past["t"].startswith("2024-03-01T23:59:59"))
+        self.assertEqual(self.client.get(reverse("Authenticate:api_map")).json()["c"][0]["a"], 70)
+
+        city = self.client.get(reverse("Authenticate:api_city", args=["tehran"]), {"as_of": "2024-03-01"}).json()
+        self.assertEqual(city["a"], 40)
+        self.assertEqual(sorted(city["f"]), [["میزان ترافیک", 50], ["میزان شادی", 30]])
+
+        response = self.client.get(reverse("Authenticate:api_map"), {"as_of": "yesterday"})
+        self.assertEqual(response.status_code, 400)
+
+
+# Stands in for the assistant: answers in two chunks and records every prompt
+class StubUpstream:
+    prompts = []
+    payloads = []
+    fail = False
+    fail_midway = False
+
+    def __init__(self, base_url, timeout):
+        pass
+
+    async def stream_text(self, payload):
+        if StubUpstream.fail:
+            raise chatbot.UpstreamError("Assistant is unreachable")
+        StubUpstream.prompts.append(payload["query"])
+        StubUpstream.payloads.append(payload)
+        yield "سلام"
+        if StubUpstream.fail_midway:
+            raise chatbot.UpstreamError("Assistant is unreachable")
+        yield " دنیا"
+
+
+@override_settings(CHATBOT_UPSTREAM="MainApplication.tests.StubUpstream")
+class ChatGatewayTests(CacheResetTestCase):
+    def setUp(self):
+        super().setUp()
+        chatbot.reset_upstream()
+        chatbot.answer_cache.clear()
+        StubUpstream.prompts = []
+        StubUpstream.payloads = []
+        StubUpstream.fail = False
+        StubUpstream.fail_midway = False
+        self.addCleanup(chatbot.reset_upstream)
+        make_city("تهران", {"میزان شادی": 40, "میزان ترافیک": 60})
+
+    async def ask(self, query, **extra):
+        response = await self.async_client.post(
+            reverse("Authenticate:api_chat_text"),
+            json.dumps({"query": query, **extra}),
+            content_type="application/json",
+        )
+        if response.streaming:
+            content = b"".join([chunk async for chunk in response.streaming_content])
+        else:
+            content = response.content
+        return response, content.decode("utf-8")
+
+    async def test_answer_is_streamed_with_server_side_city_context(self):
+        response, text = await self.ask("وضعیت شهر؟", city="tehran")
+
+        self.assertEqual(response["X-Chat-Cache"], "miss")
+        self.assertEqual(text, "سلام دنیا")
+        self.assertIn("شهر: تهران\nمیانگین امتیازها: 50", StubUpstream.prompts[0])
+        self.assertTrue(StubUpstream.prompts[0].endswith("پرسش کاربر: وضعیت شهر؟"))
+
+    async def test_repeated_question_is_served_from_cache(self):
+        await self.ask("وضعیت شهر؟", city="tehran")
+        response, text = await self.ask("  وضعیت   شهر؟ ", city="tehran")
+
+        self.assertEqual(response["X-Chat-Cache"], "hit")
+        self.assertEqual(text, "سلام دنیا")
+        self.assertEqual(len(StubUpstream.prompts), 1)
+
+        # Other temperature, other history or new scores are different questions
+        await self.ask("وضعیت شهر؟", city="tehran", temperature=0.2)
+        await self.ask("وضعیت شهر؟", city="tehran", history=[{"role": "user", "text": "سلام"}])
+        def change_scores():
+            with self.committed():
+                CityFieldScore.objects.filter(city__name="تهران").update(score=90)
+                bump_scores_version()
+
+        await sync_to_async(change_scores)()
+        await self.ask("وضعیت شهر؟", city="tehran")
+        self.assertEqual(len(StubUpstream.prompts), 4)
+
+    async def test_upstream_failure_returns_bad_gateway(self):
+        StubUpstream.fail = True
+        response, text = await self.ask("سلام")
+
+        self.assertEqual(response.status_code, 502)
+        self.assertEqual(json.loads(text)["message"], "Assistant is unreachable")
+
+    async def test_empty_query_is_rejected(self):
+        response, _ = await self.ask(" ")
+        self.assertEqual(response.status_code, 400)
+
+    @override_settings(CHATBOT_MAX_TOKENS=1000)
+    async def test_options_are_bounded(self):
+        for options in ({"temperature": float("nan")}, {"temperature": 2.5}, {"temperature": -1},
+                        {"max_tokens": 0}, {"max_tokens": 1.5}, {"max_tokens": True}, {"temperature": "hot"}):
+            response, _ = await self.ask("سلام", **options)
+            self.assertEqual(response.status_code, 400, options)
+        self.assertEqual(StubUpstream.payloads, [])
+
+        await self.ask("سلام", temperature=2, max_tokens=10**9)
+        await self.ask("خداحافظ")
+        self.assertEqual([payload["max_tokens"] for payload in StubUpstream.payloads], [1000, 1000])
+
+    async def test_failure_mid_answer_aborts_the_response(self):
+        StubUpstream.fail_midway = True
+        with self.assertLogs("MainApplication.api", "WARNING"), self.assertRaises(chatbot.UpstreamError):
+            await self.ask("سلام")
+        StubUpstream.fail_midway = False
+        response, text = await self.ask("سلام")
+        self.assertEqual((response["X-Chat-Cache"], text), ("miss", "سلام دنیا"))
+
+    def test_csrf_token_is_required(self):
+        client = Client(enforce_csrf_checks=True)
+        url = reverse("Authenticate:api_chat_text")
+        body = json.dumps({"query": "سلام"})
+        self.assertEqual(client.post(url, body, content_type="application/json").status_code, 403)
+
+        # The (cached) map page hands out the cookie the chat script sends back
+        client.get(reverse("Authenticate:Main"))
+        token = client.get(reverse("Authenticate:Main")).cookies["csrftoken"].value
+        response = client.post(url, body, content_type="application/json", HTTP_X_CSRFTOKEN=token)
+        self.assertEqual(response.status_code, 200)
+
+    def test_wsgi_requests_get_the_whole_answer(self):
+        url = reverse("Authenticate:api_chat_text")
+        response = self.client.post(url, json.dumps({"query": "سلام"}), content_type="application/json")
+        self.assertFalse(response.streaming)
+        self.assertEqual((response["X-Chat-Cache"], response.content.decode()), ("miss", "سلام دنیا"))
+
+        StubUpstream.fail_midway = True
+        response = self.client.post(url, json.dumps({"query": "خداحافظ"}), content_type="application/json")
+        self.assertEqual(response.status_code, 502)
+
+    def test_answer_cache_is_thread_safe(self):
+        cache = chatbot.AnswerCache(size=8, ttl=60)
+
+        def churn(offset):
+            for i in range(2000):
+                cache.set((offset, i % 16), i)
+                cache.get((offset, (i + 1) % 16))
+
+        threads = [threading.Thread(target=churn, args=(offset,)) for offset in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(cache._items), 8)
+
+    @override_settings(CHATBOT_MAX_AUDIO_BYTES=1024)
+    def test_voice_uploads_are_checked_before_relaying(self):
+        url = reverse("Authenticate:api_chat_voice")
+        big = SimpleUploadedFile("recording.webm", b"0" * 2048, content_type="audio/webm")
+        self.assertEqual(self.client.post(url, {"audio": big}).status_code, 413)
+        text = SimpleUploadedFile("recording.webm", b"0" * 16, content_type="text/plain")
+        self.assertEqual(self.client.post(url, {"audio": text}).status_code, 415)
+        self.assertEqual(self.client.post(url, {"language": "fa-IR"}).status_code, 400)
+
+        # Bodies past both limits are refused before the upload is parsed
+        with override_settings(DATA_UPLOAD_MAX_MEMORY_SIZE=512):
+            small = SimpleUploadedFile("recording.webm", b"0" * 16, content_type="audio/webm")
+            self.assertEqual(self.client.post(url, {"audio": small, "context": "x" * 2048}).status_code, 413)
+
+    async def test_request_scope_closes_its_client(self):
+        upstream = chatbot.HttpxUpstream("http://assistant.invalid", 5)
+        async with upstream.request_scope():
+            client = upstream.client()
+            self.assertIs(upstream.client(), client)
+        self.assertTrue(client.is_closed)
+        self.assertIsNot(upstream.client(), client)
+
+
+class CityContextTests(CacheResetTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tehran = make_city("تهران", {f"فیلد {i}": i * 10 for i in range(1, 9)})
+        make_city("قم", {"فیلد 1": 90})
+        make_city("یزد", {"فیلد 1": 10})
+
+    def test_context_is_bounded_and_ranked(self):
+        text = chatbot.get_city_context("tehran")
+
+        self.assertEqual(text.split("\n"), [
+            "شهر: تهران",
+            "میانگین امتیازها: 45 (رتبه 2 از 3)",
+            "بهترین شاخص ها: فیلد 8: 80، فیلد 7: 70، فیلد 6: 60",
+            "ضعیف ترین شاخص ها: فیلد 1: 10، فیلد 2: 20، فیلد 3: 30",
+            "تعداد شاخص ها: 8",
+        ])
+        self.assertEqual(chatbot.get_city_context("qom").split("\n")[-1], "امتیازها: فیلد 1: 90")
+        self.assertEqual(chatbot.get_city_context("unknown"), "")
+
+    def test_context_is_cached_until_scores_change(self):
+        chatbot.get_city_context("tehran")
+        with self.assertNumQueries(0):
+            chatbot.get_city_context("tehran")
+
+        with self.committed():
+            for score in CityFieldScore.objects.filter(city=self.tehran):
+                score.score = 100
+                score.save()
+        self.assertIn("میانگین امتیازها: 100 (رتبه 1 از 3)", chatbot.get_city_context("tehran"))
+
+    def test_context_endpoint(self):
+        response = self.client.get(reverse("Authenticate:api_city_context", args=["tehran"]))
+
+        self.assertEqual(response.json()["t"], chatbot.get_city_context("tehran"))
+        self.assertEqual(self.client.get(reverse("Authenticate:api_city_context", args=["isfahan"])).status_code, 404)
+
+
+class CityNameTests(CacheResetTestCase):
+    def test_spelling_variants_share_a_key(self):
+        self.assertEqual(normalize_name("چهارمحال و بختیاری"), normalize_name("چهارمحال بختیاری"))
+        self.assertEqual(normalize_name("کهگيلويه و بویر\u200cاحمد"), normalize_name(" کهگیلویه  و بویر احمد"))
+        self.assertEqual(normalize_name("كرمان"), normalize_name("کرمان"))
+        self.assertNotEqual(normalize_name("کرمان"), normalize_name("کرمانشاه"))
+
+    def test_saving_a_city_fills_slug_and_key(self):
+        city = City.objects.create(name="چهارمحال و بختیاری")
+        self.assertEqual(city.slug, "chahar-mahaal-bakhtiari")
+        self.assertEqual(city.name_key, normalize_name("چهارمحال بختیاری"))
+
+        # A second spelling keeps working but does not steal the slug
+        duplicate = City.objects.create(name="چهارمحال بختیاری")
+        self.assertIsNone(duplicate.slug)
+        self.assertEqual(City.objects.create(name="شهر تازه").slug, None)
+
+    def test_importers_resolve_variants_without_duplicates(self):
+        tehran = City.objects.create(name="تهران")
+        chaharmahal = City.objects.create(name="چهارمحال بختیاری")
+
+        with CaptureQueriesContext(connection) as queries:
+            resolver = CityResolver()
+            for name in ["تهران", " تهران ", "چهارمحال و بختیاری", "چهارمحال\u200cبختیاری"] * 100:
+                resolver.get(name)
+        self.assertEqual(len(queries), 1)
+
+        writer = ScoreWriter()
+        writer.add_many([
+            ("چهارمحال و بختیاری", "میزان شادی", 40),
+            ("تهران", "میزان شادی", 60),
+            ("سيستان و بلوچستان", "ميزان شادی", 80),
+        ])
+        stats = writer.close()
+
+        self.assertEqual((stats["cities_created"], stats["fields_created"]), (1, 1))
+        self.assertEqual(chaharmahal.scores.get().score, 40)
+        self.assertEqual(tehran.scores.get().score, 60)
+        self.assertEqual(City.objects.get(slug="sistan-baluchestan").scores.get().score, 80)
+        self.assertEqual(CityFieldScore.objects.count(), 3)
+
+    def test_sub_units_resolve_by_path_and_plain_names_by_top_level(self):
+        kerman = City.objects.create(name="کرمان")
+        # Older than the province of the same name
+        county = City.objects.create(name="یزد", parent=kerman, city_type=City.CityType.county)
+        yazd = City.objects.create(name="یزد")
+
+        writer = ScoreWriter()
+        writer.add_many([
+            ("یزد", "میزان شادی", 40),
+            ("کرمان / یزد", "میزان شادی", 60),
+            ("یزد/یزد", "میزان شادی", 70),
+            ("یزد/یزد/مهریز", "میزان شادی", 80),
+        ])
+        stats = writer.close()
+
+        self.assertEqual(stats["cities_created"], 2)
+        self.assertEqual(yazd.scores.get().score, 40)
+        self.assertEqual(county.scores.get().score, 60)
+        yazd_county = City.objects.get(parent=yazd)
+        town = City.objects.get(parent=yazd_county)
+        self.assertEqual((yazd_county.city_type, yazd_county.depth), (City.CityType.county, 1))
+        self.assertEqual(yazd_county.scores.get().score, 70)
+        self.assertEqual((town.name, town.city_type), ("مهریز", City.CityType.town))
+        self.assertEqual(town.path, yazd_county.path + path_segment(town.id))
+        self.assertIsNone(town.slug)
+        self.assertEqual(CityScoreSummary.objects.get(city=yazd).rollup_avg, (40 + 70 + 80) / 3)
+
+    def test_add_cities_adds_only_missing_provinces(self):
+        City.objects.create(name="چهارمحال و بختیاری")
+        City.objects.create(name="چهارمحال بختیاری")
+        kerman = City.objects.create(name="کرمان")
+        # A county named like a province does not stand in for it
+        City.objects.create(name="یزد", parent=kerman, city_type=City.CityType.county)
+
+        call_command("add_cities", stdout=StringIO())
+        call_command("add_cities", stdout=StringIO())
+
+        top_level = City.objects.filter(parent__isnull=True)
+        self.assertEqual(top_level.filter(name_key=normalize_name("چهارمحال بختیاری")).count(), 2)
+        self.assertEqual(top_level.filter(name_key=normalize_name("کرمان")).count(), 1)
+        self.assertEqual(top_level.filter(name_key=normalize_name("یزد")).count(), 1)
+
+
+class AdminChangelistTests(CacheResetTestCase):
+    def setUp(self):
+        super().setUp()
+        admin_user = get_user_model().objects.create_superuser("admin", "admin@example.com", "password")
+        self.client.force_login(admin_user)
+
+    def add_scores(self, count, start=0):
+        for index in range(start, start + count):
+            make_city(f"شهر {index}", {"میزان شادی": 50, f"فیلد {index}": 60})
+
+    def test_score_changelist_queries_do_not_grow_with_rows(self):
+        url = reverse("admin:MainApplication_cityfieldscore_changelist")
+        self.add_scores(3)
+        with CaptureQueriesContext(connection) as few:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        self.add_scores(30, start=3)
+        with CaptureQueriesContext(connection) as many:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertEqual(len(few), len(many))
+
+    def test_city_changelist_shows_summary_average_without_extra_queries(self):
+        url = reverse("admin:MainApplication_city_changelist")
+        self.add_scores(3)
+        with CaptureQueriesContext(connection) as few:
+            self.client.get(url)
+        self.add_scores(30, start=3)
+        with CaptureQueriesContext(connection) as many:
+            response = self.client.get(url + "?o=6")
+        self.assertEqual(len(few), len(many))
+        self.assertContains(response, "55")
+
+    def test_autocomplete_filter_narrows_changelist(self):
+        self.add_scores(3)
+        city = City.objects.get(name="شهر 1")
+        url = reverse("admin:MainApplication_cityfieldscore_changelist")
+        response = self.client.get(url, {"city__id__exact": city.pk})
+        self.assertEqual(response.context["cl"].result_count, 2)
+        self.assertContains(response, 'class="admin-autocomplete')
+        # Only the selected city is rendered into the filter, not every row of the table
+        self.assertNotContains(response, "شهر 2")
+
+    def test_paginator_counts_exactly_off_postgresql(self):
+        self.add_scores(3)
+        paginator = EstimatedCountPaginator(CityFieldScore.objects.order_by("pk"), 2)
+        self.assertIsNone(paginator.estimated_count())
+        self.assertEqual(paginator.count, 6)
+        self.assertEqual(paginator.num_pages, 3)
+
+
+class BenchmarkTests(CacheResetTestCase):
+    def test_run_benchmarks_measures_scenarios_and_cleans_up(self):
+        results = run_benchmarks([(3, 4)], scenarios=["main", "city_detail", "sql_converter"], repeat=2, warmup=0)
+
+        stats = results["3x4"]
+        self.assertEqual(set(stats), {"main", "city_detail", "sql_converter"})
+        for scenario in stats.values():
+            self.assertEqual(set(scenario), {"p50_ms", "p95_ms", "mean_ms", "queries", "peak_kb"})
+            self.assertLessEqual(scenario["p50_ms"], scenario["p95_ms"])
+        self.assertGreater(stats["sql_converter"]["queries"], 0)
+        # Imports are rolled back and the seeded dataset is removed afterwards
+        self.assertFalse(City.objects.exists())
+        self.assertFalse(CityFieldScore.objects.exists())
+
+    def test_concurrency_benchmark_compares_wsgi_and_asgi(self):
+        results = run_concurrency_benchmarks(
+            [(2, 2)], concurrency=4, requests=8, upstream_latency=0.001, scenarios=["chat"]
+        )
+
+        self.assertEqual(set(results["2x2"]), {"wsgi:chat@4", "asgi:chat@4"})
+        for stats in results["2x2"].values():
+            self.assertGreater(stats["rps"], 0)
+            self.assertLessEqual(stats["p50_ms"], stats["p95_ms"])
+
+    def test_parse_dataset(self):
+        self.assertEqual(parse_dataset("500x300"), (500, 300))
+        with self.assertRaises(ValueError):
+            parse_dataset("500")
+
+    def test_compare_flags_only_regressions_beyond_threshold(self):
+        baseline = {"results": {"45x30": {"main": {"p50_ms": 10.0, "p95_ms": 12.0, "queries": 2, "peak_kb": 100.0}}}}
+        current = {"results": {"45x30": {"main": {"p50_ms": 11.0, "p95_ms": 20.0, "queries": 3, "peak_kb": 100.0}}}}
+
+        rows = compare_results(baseline, current, threshold=0.2)
+
+        regressed = {metric for _, _, metric, _, _, _, flag in rows if flag}
+        self.assertEqual(regressed, {"p95_ms", "queries"})
+
+    def test_command_compares_saved_results(self):
+        baseline = {"results": {"45x30": {"main": {"p50_ms": 10.0, "p95_ms": 12.0, "queries": 2, "peak_kb": 100.0}}}}
+        slower = {"results": {"45x30": {"main": {"p50_ms": 30.0, "p95_ms": 12.0, "queries": 2, "peak_kb": 100.0}}}}
+        with tempfile.TemporaryDirectory() as directory:
+            baseline_path = Path(directory) / "baseline.json"
+            current_path = Path(directory) / "current.json"
+            baseline_path.write_text(json.dumps(baseline))
+            current_path.write_text(json.dumps(baseline))
+            out = StringIO()
+            call_command("benchmark", "--compare", str(baseline_path), str(current_path), stdout=out)
+            self.assertIn("No regressions", out.getvalue())
+
+            current_path.write_text(json.dumps(slower))
+            with self.assertRaises(CommandError):
+                call_command("benchmark", "--compare", str(baseline_path), str(current_path), stdout=StringIO())
+
+
+@override_settings(PERFORMANCE_METRICS=True, PERFORMANCE_METRICS_TOKEN="secret")
+class PerformanceMetricsTests(CacheResetTestCase):
+    def setUp(self):
+        super().setUp()
+        registry.reset()
+        make_city("تهران", {"میزان شادی": 80})
+
+    def test_server_timing_reports_queries_cache_and_templates(self):
+        first = self.client.get(reverse("Authenticate:Main"))
+        timing = first["Server-Timing"]
+        self.assertIn('cache;desc="0 hit, 1 miss"', timing)
+        self.assertRegex(timing, r'db;dur=[\d.]+;desc="[1-9]\d* queries"')
+        self.assertRegex(timing, r"tpl;dur=[\d.]+")
+        self.assertRegex(timing, r"total;dur=[\d.]+")
+
+        second = self.client.get(reverse("Authenticate:Main"))
+        self.assertIn('cache;desc="1 hit, 0 miss"', second["Server-Timing"])
+        self.assertIn('db;dur=0.0;desc="0 queries"', second["Server-Timing"])
+
+    def test_metrics_endpoint_aggregates_per_view(self):
+        self.client.get(reverse("Authenticate:Main"))
+        self.client.get(reverse("Authenticate:Main"))
+        self.client.get(reverse("Authenticate:city_detail", args=["tehran"]))
+        self.client.get("/admin/login/")
+
+        response = self.client.get(reverse("Authenticate:metrics"), HTTP_AUTHORIZATION="Bearer secret")
+
+        self.assertEqual(response.status_code, 200)
+        body = response.content.decode()
+        self.assertIn('iranmap_request_duration_seconds_count{view="Authenticate:Main"} 2', body)
+        self.assertIn('iranmap_request_duration_seconds_bucket{view="Authenticate:Main",le="+Inf"} 2', body)
+        self.assertIn('iranmap_request_duration_seconds_count{view="Authenticate:city_detail"} 1', body)
+        self.assertIn('iranmap_request_duration_seconds_count{view="admin"} 1', body)
+        self.assertIn('iranmap_cache_lookups_total{view="Authenticate:Main",result="hit"} 1', body)
+        self.assertIn('iranmap_responses_total{view="Authenticate:Main",status="2xx"} 2', body)
+
+    async def test_async_views_are_measured(self):
+        with self.settings(ROOT_URLCONF=app_urlconf(async_views=True)):
+            response = await self.async_client.get("/city/tehran/")
+        self.assertRegex(response["Server-Timing"], r'db;dur=[\d.]+;desc="[1-9]\d* queries"')
+        self.assertIn('cache;desc="0 hit, 1 miss"', response["Server-Timing"])
+
+    @override_settings(PERFORMANCE_SLOW_REQUEST_MS=0, PERFORMANCE_SLOW_QUERY_MS=0)
+    def test_slow_requests_and_queries_are_logged(self):
+        with self.assertLogs("MainApplication.performance", "WARNING") as logs:
+            self.client.get(reverse("Authenticate:city_detail", args=["tehran"]))
+        output = "\n".join(logs.output)
+        self.assertIn("Slow request", output)
+        self.assertIn("Slow query", output)
+        self.assertIn("SELECT", output)
+
+    def test_metrics_token_is_required_when_set(self):
+        url = reverse("Authenticate:metrics")
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION="Bearer wrong").status_code, 403)
+        self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION="Bearer secret").status_code, 200)
+
+    @override_settings(PERFORMANCE_METRICS_TOKEN="")
+    def test_without_a_token_only_staff_may_read_metrics(self):
+        url = reverse("Authenticate:metrics")
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION="Bearer ").status_code, 403)
+
+        self.client.force_login(get_user_model().objects.create_superuser("admin", "admin@example.com", "password"))
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+    @override_settings(PERFORMANCE_METRICS=False)
+    def test_disabled_by_default(self):
+        response = self.client.get(reverse("Authenticate:Main"))
+        self.assertNotIn("Server-Timing", response)
+        self.assertEqual(self.client.get(reverse("Authenticate:metrics")).status_code, 404)
+
+
+class AsyncViewTests(CacheResetTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tehran = make_city("تهران", {"میزان شادی": 80, "آلودگی هوا": 30})
+
+    def sync_content(self, url):
+        with self.settings(ROOT_URLCONF=app_urlconf(async_views=False)):
+            return self.client.get(url).content
+
+    async def async_response(self, url):
+        with self.settings(ROOT_URLCONF=app_urlconf(async_views=True)):
+            return await self.async_client.get(url)
+
+    async def test_async_pages_render_like_sync_pages(self):
+        for url in ["/", "/city/tehran/", "/city/tehran/?as_of=2999-01-01"]:
+            response = await self.async_response(url)
+            self.assertEqual(response.status_code, 200)
+            await sync_to_async(cache.clear)()
+            self.assertEqual(response.content, await sync_to_async(self.sync_content)(url))
+
+    async def test_async_pages_use_response_cache_and_404(self):
+        first = await self.async_response("/city/tehran/")
+        second = await self.async_response("/city/tehran/")
+        self.assertEqual(first["ETag"], second["ETag"])
+        self.assertEqual((await self.async_response("/city/unknown/")).status_code, 404)
+
+
+class ScoringProfileTests(CacheResetTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tehran = make_city("تهران", {"میزان شادی": 80, "میزان آلودگی": 90})
+        self.gilan = make_city("گیلان", {"میزان شادی": 60, "میزان آلودگی": 20})
+        make_city("قم", {})
+        self.happiness = FieldType.objects.get(name="میزان شادی")
+        self.pollution = FieldType.objects.get(name="میزان آلودگی")
+        self.profile = ScoringProfile.objects.create(name="هوای پاک", slug="clean-air")
+        ScoringProfileWeight.objects.create(profile=self.profile, field=self.pollution, weight=3, lower_is_better=True)
+
+    def scores(self, **params):
+        response = self.client.get(reverse("Authenticate:api_scores"), params)
+        self.assertEqual(response.status_code, 200)
+        return {slug: (avg, color) for slug, avg, color in response.json()["c"]}
+
+    def test_plain_weights_match_summary_averages(self):
+        scores = self.scores()
+        self.assertEqual(scores["tehran"], (85.0, "#66bb6a"))
+        self.assertEqual(scores["gilan"], (40.0, "#ff9800"))
+        # No scores at all: 0 and the lowest band, like the plain map
+        self.assertEqual(scores["qom"], (0.0, "#f44336"))
+
+    def test_profile_weights_and_inverts_fields(self):
+        scores = self.scores(profile="clean-air")
+        # Pollution counts three times as 101 - score
+        self.assertEqual(scores["tehran"][0], round((80 + 3 * 11) / 4, 2))
+        self.assertEqual(scores["gilan"][0], round((60 + 3 * 81) / 4, 2))
+
+    def test_ad_hoc_weights_override_profile(self):
+        scores = self.scores(profile="clean-air", weights=f"{self.pollution.id}:0")
+        self.assertEqual(scores["tehran"][0], 80.0)
+        scores = self.scores(weights=f"{self.happiness.id}:-1,{self.pollution.id}:0")
+        self.assertEqual(scores["gilan"][0], 41.0)
+
+    def test_bad_profile_or_weights(self):
+        url = reverse("Authenticate:api_scores")
+        self.assertEqual(self.client.get(url, {"profile": "missing"}).status_code, 404)
+        self.assertEqual(self.client.get(url, {"weights": "a:b"}).status_code, 400)
+        self.assertEqual(self.client.get(url, {"weights": "1:1e308"}).status_code, 400)
+        with self.assertRaises(ValueError):
+            parse_weights("1:inf")
+        self.assertEqual(parse_weights("1:-1000"), {1: (1000.0, True)})
+
+    @override_settings(SCORES_WEIGHTS_CACHE_LIMIT=1)
+    def test_only_a_limited_number_of_ad_hoc_weights_are_cached(self):
+        url = reverse("Authenticate:api_scores")
+        self.assertTrue(self.client.get(url, {"weights": f"{self.happiness.id}:2"}).has_header("ETag"))
+        response = self.client.get(url, {"weights": f"{self.happiness.id}:3"})
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header("ETag"))
+        # Profiles and the first weights are still served from the cache
+        self.assertTrue(self.client.get(url, {"profile": "clean-air"}).has_header("ETag"))
+        with self.assertNumQueries(0):
+            self.client.get(url, {"weights": f"{self.happiness.id}:2"})
+
+    def test_matrix_is_built_once_per_version(self):
+        get_score_matrix()
+        with self.assertNumQueries(0):
+            matrix = get_score_matrix()
+            matrix.colored_scores({self.happiness.id: (2.0, False)})
+
+        # Profile edits invalidate it like score edits do
+        with self.committed():
+            ScoringProfileWeight.objects.create(profile=self.profile, field=self.happiness, weight=0)
+        self.assertIsNot(get_score_matrix(), matrix)
+        self.assertEqual(self.scores(profile="clean-air")["tehran"][0], 11.0)
+
+    def test_profiles_endpoint(self):
+        response = self.client.get(reverse("Authenticate:api_profiles"))
+        self.assertEqual(
+            response.json()["p"],
+            [{"s": "clean-air", "n": "هوای پاک", "w": [[self.pollution.id, 3.0, 1]]}],
+        )
+
+
+class AnalyticsTests(CacheResetTestCase):
+    def setUp(self):
+        super().setUp()
+        for name, scores in [
+            ("تهران", (90, 20, 10)),
+            ("اصفهان", (85, 25, 15)),
+            ("گیلان", (20, 90, 95)),
+            ("مازندران", (25, 85, 90)),
+        ]:
+            make_city(name, dict(zip(["میزان شادی", "میزان ترافیک", "میزان آلودگی"], scores)))
+        make_city("یزد", {"میزان شادی": 50, "میزان ترافیک": 50, "میزان امنیت": 70})
+
+    def get(self, name, *args, **params):
+        response = self.client.get(reverse(f"Authenticate:{name}", args=args), params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_similar_cities(self):
+        similar = self.get("api_city_similar", "tehran")["r"]
+        self.assertEqual([row[0] for row in similar], ["isfahan", "yazd", "mazandaran", "gilan"])
+        self.assertGreater(similar[0][2], 0.9)
+
+        # Yazd's missing pollution counts as the field mean, (10 + 15 + 95 + 90) / 4
+        similar = self.get("api_city_similar", "tehran", metric="euclidean", n=1)["r"]
+        self.assertEqual(similar, [["isfahan", "اصفهان", round((3 * 25) ** 0.5, 4)]])
+
+    def test_similar_cities_bad_requests(self):
+        url = reverse("Authenticate:api_city_similar", args=["tehran"])
+        self.assertEqual(self.client.get(url, {"metric": "manhattan"}).status_code, 400)
+        missing = reverse("Authenticate:api_city_similar", args=["qom"])
+        self.assertEqual(self.client.get(missing).status_code, 404)
+
+    def test_correlations_use_cities_scored_in_both_fields(self):
+        data = self.get("api_correlations")
+        index = {name: position for position, (_, name) in enumerate(data["f"])}
+        correlations = data["r"]
+        happiness, pollution = index["میزان شادی"], index["میزان آلودگی"]
+        self.assertEqual(correlations[happiness][happiness], 1.0)
+        expected = np.corrcoef([90, 85, 20, 25], [10, 15, 95, 90])[0, 1]
+        self.assertEqual(correlations[happiness][pollution], round(expected, 3))
+        self.assertEqual(correlations[pollution][happiness], correlations[happiness][pollution])
+        # Only Yazd has a security score: too few cities to correlate
+        self.assertEqual(set(correlations[index["میزان امنیت"]]), {None})
+
+    def test_clusters(self):
+        clusters = self.get("api_clusters", k=2)["c"]
+        self.assertEqual(len(clusters), 2)
+        groups = [set(cluster["s"]) for cluster in clusters]
+        self.assertTrue(any({"tehran", "isfahan"} <= group for group in groups))
+        self.assertTrue(any({"gilan", "mazandaran"} <= group for group in groups))
+        happy = next(cluster for cluster in clusters if "tehran" in cluster["s"])
+        self.assertEqual(happy["t"][0], "میزان شادی")
+
+        # k is capped by the number of cities
+        self.assertEqual(len(self.get("api_clusters", k=20)["c"]), 5)
+
+    def test_results_are_memoized_per_version(self):
+        matrix = get_score_matrix()
+        clusters = analytics.city_clusters(matrix, 3)
+        with self.assertNumQueries(0):
+            self.assertIs(analytics.city_clusters(get_score_matrix(), 3), clusters)
+            analytics.field_correlations(matrix)
+            analytics.similar_cities(matrix, "gilan")
+
+        with self.committed():
+            make_city("قم", {"میزان شادی": 40})
+        self.assertIsNot(analytics.city_clusters(get_score_matrix(), 3), clusters)
+
+
+class HierarchyTests(CacheResetTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tehran = make_city("تهران", {"میزان شادی": 80})
+        self.county = City.objects.create(name="شمیرانات", parent=self.tehran, city_type=City.CityType.county)
+        self.town = City.objects.create(name="تجریش", parent=self.county, city_type=City.CityType.town)
+        self.happiness = FieldType.objects.get(name="میزان شادی")
+        self.traffic = FieldType.objects.create(name="میزان ترافیک")
+        CityFieldScore.objects.create(city=self.county, field=self.traffic, score=60)
+        self.town_score = CityFieldScore.objects.create(city=self.town, field=self.happiness, score=40)
+
+    def rollup(self, city):
+        return CityScoreSummary.objects.get(city=city).rollup_avg
+
+    def test_paths_and_depths(self):
+        self.assertEqual(self.tehran.path, path_segment(self.tehran.id))
+        self.assertEqual(self.town.path, self.tehran.path + path_segment(self.county.id) + path_segment(self.town.id))
+        self.assertEqual([self.tehran.depth, self.county.depth, self.town.depth], [0, 1, 2])
+        # Only top-level units are regions of the map
+        self.assertIsNone(self.town.slug)
+
+    def test_rollups_follow_score_changes(self):
+        summary = CityScoreSummary.objects.get(city=self.tehran)
+        self.assertEqual((summary.avg_score, summary.rollup_avg), (80, 60))
+        self.assertEqual(self.rollup(self.county), 50)
+
+        self.town_score.score = 70
+        self.town_score.save()
+        self.assertEqual(self.rollup(self.tehran), 70)
+        CityFieldScore.objects.filter(city=self.county).delete()
+        self.assertEqual(self.rollup(self.tehran), 75)
+        self.assertEqual(self.rollup(self.county), 70)
+        call_command("rebuild_summaries", check=True, stdout=StringIO())
+
+    def test_map_shows_rollups(self):
+        cities = {city["s"]: city for city in self.client.get(reverse("Authenticate:api_map")).json()["c"]}
+        self.assertEqual(list(cities), ["tehran"])
+        self.assertEqual((cities["tehran"]["a"], cities["tehran"]["c"]), (60, "#ffeb3b"))
+
+        as_of = (timezone.now() + datetime.timedelta(days=1)).date().isoformat()
+        cities = self.client.get(reverse("Authenticate:api_map"), {"as_of": as_of}).json()["c"]
+        self.assertEqual(cities[0]["a"], 60)
+        scores = self.client.get(reverse("Authenticate:api_scores")).json()["c"]
+        self.assertEqual(scores, [["tehran", 60.0, "#ffeb3b"]])
+
+    def test_moving_a_subtree(self):
+        gilan = make_city("گیلان", {})
+        self.county.parent = gilan
+        self.county.save()
+
+        self.town.refresh_from_db()
+        self.assertEqual(self.town.path, gilan.path + path_segment(self.county.id) + path_segment(self.town.id))
+        self.assertEqual(self.rollup(self.tehran), 80)
+        self.assertEqual(self.rollup(gilan), 50)
+        call_command("rebuild_summaries", check=True, stdout=StringIO())
+
+    def test_cycles_are_rejected(self):
+        self.tehran.parent = self.town
+        with self.assertRaises(ValidationError):
+            self.tehran.clean()
+        with self.assertRaises(ValueError):
+            self.tehran.save()
+
+    def test_deleting_a_unit_updates_ancestors(self):
+        self.county.delete()
+        self.assertFalse(City.objects.filter(pk=self.town.pk).exists())
+        self.assertEqual(self.rollup(self.tehran), 80)
+
+    def test_subtree_in_one_query(self):
+        with self.assertNumQueries(1):
+            units = [unit.name for unit in get_subtree(self.tehran)]
+        self.assertEqual(units, ["تهران", "شمیرانات", "تجریش"])
+
+        response = self.client.get(reverse("Authenticate:api_city_units", args=["tehran"]), {"depth": 1})
+        self.assertEqual(
+            response.json()["u"],
+            [
+                [self.tehran.id, None, 0, "تهران", 80.0, 60.0, "#ffeb3b"],
+                [self.county.id, self.tehran.id, 1, "شمیرانات", 60.0, 50.0, "#ffeb3b"],
+            ],
+        )
+        response = self.client.get(reverse("Authenticate:api_units", args=[self.town.id]))
+        self.assertEqual(response.json()["u"], [[self.town.id, self.county.id, 2, "تجریش", 40.0, 40.0, "#ff9800"]])
+
+
+class MapGeometryTests(CacheResetTestCase):
+    def test_levels_file_is_up_to_date(self):
+        call_command("build_map_lods", check=True, stdout=StringIO())
+
+    def test_levels_keep_every_shape_and_shrink(self):
+        keys = [shape["key"] for layer in geometry.map_layers(geometry.FULL) for shape in layer["shapes"]]
+        sizes = []
+        for lod in ("full", "high", "medium", "low"):
+            shapes = [shape for layer in geometry.map_layers(lod) for shape in layer["shapes"]]
+            self.assertEqual([shape["key"] for shape in shapes], keys)
+            self.assertTrue(all(shape["d"] for shape in shapes))
+            sizes.append(sum(len(shape["d"]) for shape in shapes))
+        self.assertEqual(sizes, sorted(sizes, reverse=True))
+        self.assertLess(sizes[2], sizes[0] / 4)
+
+    def test_simplify_and_encode(self):
+        points = [(0, 0), (1, 0.01), (2, 0), (3, 5)]
+        self.assertEqual(geometry.simplify(points, 0.1).tolist(), [[0, 0], [2, 0], [3, 5]])
+        self.assertEqual(geometry.parse_path("M 0 0 C 1 0 2 0 3 0 Z")[0][0][-1], (3.0, 0.0))
+
+        units = geometry.quantize([(0.5, 1), (0.5, 1.2), (1, 0.5), (0.5, 1)], 0.5)
+        self.assertEqual(geometry.encode_subpaths([(units, True)], 0.5), "M.5 1l.5-.5z")
+
+    def test_page_level_of_detail(self):
+        make_city("تهران", {"میزان شادی": 50})
+        low = self.client.get(reverse("Authenticate:Main"), {"lod": "low"})
+        full = self.client.get(reverse("Authenticate:Main"), {"lod": "full"})
+        self.assertContains(low, '<path class="tehran" d="M')
+        self.assertLess(len(low.content), len(full.content) / 3)
+        self.assertEqual(self.client.get(reverse("Authenticate:Main"), {"lod": "tiny"}).status_code, 400)
+
+    def test_standalone_svg(self):
+        response = self.client.get(reverse("Authenticate:map_svg"), {"lod": "low"})
+        self.assertEqual(response["Content-Type"], "image/svg+xml")
+        self.assertIn("max-age=86400", response["Cache-Control"])
+        self.assertIn(b'<path class="tehran"', response.content)
+
+        compressed = self.client.get(
+            reverse("Authenticate:map_svg"), {"lod": "low"}, headers={"accept-encoding": "gzip, br"}
+        )
+        self.assertEqual(compressed["Content-Encoding"], "gzip")
+        self.assertEqual(compressed["ETag"], response["ETag"])
+
+        revalidated = self.client.get(
+            reverse("Authenticate:map_svg"), {"lod": "low"}, headers={"if-none-match": response["ETag"]}
+        )
+        self.assertEqual(revalidated.status_code, 304)
+
+
+class ExportTests(CacheResetTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def import_file(self, rows, *args):
+        path = Path(self.tmp.name) / "import.csv"
+        with open(path, "w", newline="", encoding="utf-8") as f:
+            csv.writer(f).writerows(rows)
+        call_command("import_scores", str(path), "--update", *args, stdout=StringIO())
+
+    def download(self, export_format="csv", **params):
+        response = self.client.get(reverse("Authenticate:api_export", args=[export_format]), params)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def all_scores(self):
+        return set(CityFieldScore.objects.values_list("city__name", "field__name", "score"))
+
+    def test_csv_round_trips_through_import_scores(self):
+        make_city("تهران", {"میزان شادی": 32, "میزان ترافیک": 45})
+        make_city("قم", {"میزان شادی": 67})
+        City.objects.create(name="یزد")
+        expected = self.all_scores()
+
+        response = self.download()
+        self.assertTrue(response.streaming)
+        self.assertIn('filename="scores.csv"', response["Content-Disposition"])
+        path = Path(self.tmp.name) / "scores.csv"
+        path.write_bytes(b"".join(response.streaming_content))
+        rows = list(csv.reader(path.open(newline="", encoding="utf-8-sig")))
+        self.assertEqual(rows[0], ["", "تهران", "قم", "یزد"])
+        self.assertEqual(rows[1], ["میزان شادی", "32", "67", ""])
+
+        CityFieldScore.objects.all().delete()
+        call_command("import_scores", str(path), stdout=StringIO())
+        self.assertEqual(self.all_scores(), expected)
+
+    def test_xlsx_round_trips_through_json_converter(self):
+        make_city("تهران", {"میزان شادی": 32, "میزان ترافیک": 45})
+        make_city("قم", {"میزان شادی": 67, "میزان ترافیک": 12})
+        path = Path(self.tmp.name) / "scores.xlsx"
+
+        out = StringIO()
+        call_command("export_scores", str(path), stdout=out)
+        self.assertIn("Exported 2 fields", out.getvalue())
+        call_command("json_converter", str(path), stdout=StringIO())
+
+        converted = json.loads((Path(self.tmp.name) / "scores_from_excel.json").read_text(encoding="utf-8"))
+        self.assertEqual(converted, {
+            "تهران": {"میزان شادی": 32, "میزان ترافیک": 45},
+            "قم": {"میزان شادی": 67, "میزان ترافیک": 12},
+        })
+
+        response = self.download("xlsx")
+        self.assertEqual(response["Content-Type"], "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+        from openpyxl import load_workbook
+
+        workbook = load_workbook(BytesIO(b"".join(response.streaming_content)), read_only=True)
+        rows = list(workbook.active.iter_rows(values_only=True))
+        self.assertEqual(rows, [(None, "تهران", "قم"), ("میزان شادی", 32, 67), ("میزان ترافیک", 45, 12)])
+
+    def test_as_of_merges_snapshot_and_history(self):
+        self.import_file([["", "تهران", "قم"], ["میزان شادی", "30", "50"], ["میزان ترافیک", "20", ""]],
+                         "--effective-at", "2024-01-01")
+        call_command("compact_score_history", "--at", "2024-02-01", stdout=StringIO())
+        self.import_file([["", "تهران"], ["میزان شادی", "80"]], "--effective-at", "2024-06-01")
+        CityFieldScore.objects.filter(field__name="میزان ترافیک").delete()
+
+        def exported(**params):
+            content = b"".join(self.download(**params).streaming_content).decode("utf-8-sig")
+            # import_scores creates cities and fields in no particular order, so compare cells
+            header, *rows = csv.reader(content.splitlines())
+            return {(city, row[0]): score for row in rows for city, score in zip(header[1:], row[1:]) if score}
+
+        tehran_happiness = ("تهران", "میزان شادی")
+        qom_happiness = ("قم", "میزان شادی")
+        tehran_traffic = ("تهران", "میزان ترافیک")
+        self.assertEqual(exported(as_of="2024-03-01"), {tehran_happiness: "30", qom_happiness: "50", tehran_traffic: "20"})
+        self.assertEqual(exported(as_of="2024-07-01"), {tehran_happiness: "80", qom_happiness: "50", tehran_traffic: "20"})
+        self.assertEqual(exported(), {tehran_happiness: "80", qom_happiness: "50"})
+
+    def test_city_type_filter_and_errors(self):
+        tehran = make_city("تهران", {"میزان شادی": 50})
+        county = City.objects.create(name="شمیرانات", parent=tehran, city_type=City.CityType.county)
+        CityFieldScore.objects.create(city=county, field=FieldType.objects.get(), score=70)
+
+        out = StringIO()
+        call_command("export_scores", "-", "--city-type", "county", stdout=out)
+        self.assertEqual(out.getvalue().lstrip("\ufeff").splitlines(), [",تهران/شمیرانات", "میزان شادی,70"])
+
+        url = reverse("Authenticate:api_export", args=["csv"])
+        self.assertEqual(self.client.get(url, {"type": "village"}).status_code, 400)
+        self.assertEqual(self.client.get(reverse("Authenticate:api_export", args=["pdf"])).status_code, 404)
+        with self.assertRaises(CommandError):
+            call_command("export_scores", "scores.json", stdout=StringIO())
+
+    def test_sub_units_round_trip_by_path(self):
+        tehran = make_city("تهران", {"میزان شادی": 80})
+        county = City.objects.create(name="تهران", parent=tehran, city_type=City.CityType.county)
+        CityFieldScore.objects.create(city=county, field=FieldType.objects.get(), score=20)
+        expected = set(CityFieldScore.objects.values_list("city_id", "field__name", "score"))
+
+        path = Path(self.tmp.name) / "scores.csv"
+        path.write_bytes(b"".join(self.download().streaming_content))
+        self.assertEqual(path.read_text(encoding="utf-8-sig").splitlines()[0], ",تهران,تهران/تهران")
+        CityFieldScore.objects.all().delete()
+        call_command("import_scores", str(path), stdout=StringIO())
+
+        self.assertEqual(set(CityFieldScore.objects.values_list("city_id", "field__name", "score")), expected)
+        self.assertEqual(City.objects.count(), 2)
+
+    def test_names_that_would_import_as_other_cities_are_refused(self):
+        make_city("چهارمحال و بختیاری", {"میزان شادی": 80})
+        make_city("چهارمحال بختیاری", {"میزان شادی": 20})
+
+        # Imported back, both columns would land on the older spelling
+        response = self.client.get(reverse("Authenticate:api_export", args=["csv"]))
+        self.assertEqual(response.status_code, 400)
+        with self.assertRaisesMessage(CommandError, "share the names چهارمحال بختیاری"):
+            call_command("export_scores", "-", stdout=StringIO())
+
+
+# settings_sqlite has a second "replica" alias; as its own test database it starts empty,
+# so anything read from it is visibly missing the rows written to the primary
+@override_settings(DATABASE_REPLICA="replica", DATABASE_REPLICA_STICKY_SECONDS=5)
+class ReplicaRoutingTests(CacheResetTestCase):
+    databases = {"default", "replica"}
+
+    def setUp(self):
+        super().setUp()
+        with self.committed():
+            make_city("تهران", {"میزان شادی": 50})
+
+    def map_slugs(self):
+        return [city["s"] for city in self.client.get(reverse("Authenticate:api_map")).json()["c"]]
+
+    def test_reads_go_to_the_replica_after_the_lag(self):
+        # The scores change just made pins every reader to the primary
+        self.assertEqual(self.map_slugs(), ["tehran"])
+
+        cache.clear()
+        with CaptureQueriesContext(connections["replica"]) as replica_queries:
+            self.assertEqual(self.map_slugs(), [])
+        self.assertGreater(len(replica_queries), 0)
+
+        out = StringIO()
+        call_command("export_scores", "-", stdout=out)
+        self.assertEqual(out.getvalue().lstrip("\ufeff").splitlines(), ['""'])
+
+    def test_writers_stick_to_the_primary(self):
+        get_user_model().objects.create_superuser("admin", "admin@example.com", "secret")
+        # Session and last_login writes are read from the primary anyway
+        response = self.client.post(reverse("admin:login"), {"username": "admin", "password": "secret"})
+        self.assertNotIn(STICKY_COOKIE, response.cookies)
+
+        response = self.client.post(reverse("admin:MainApplication_fieldtype_add"), {"name": "میزان ترافیک"})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response.cookies[STICKY_COOKIE]["max-age"], 5)
+
+        cache.clear()
+        self.assertEqual(self.map_slugs(), ["tehran"])
+        self.client.cookies.pop(STICKY_COOKIE)
+        cache.clear()
+        self.assertEqual(self.map_slugs(), [])
+
+    def test_router(self):
+        router = ReplicaRouter()
+        self.assertEqual(router.db_for_read(City), "default")
+        with reading_from_replica() as state:
+            self.assertEqual(state.alias, None)  # still pinned after setUp's writes
+        cache.clear()
+        with reading_from_replica():
+            self.assertEqual(router.db_for_read(City), "replica")
+            self.assertEqual(router.db_for_read(get_user_model()), "default")
+            self.assertEqual(router.db_for_write(get_user_model()), "default")
+            self.assertEqual(router.db_for_read(City), "replica")
+            self.assertEqual(router.db_for_write(City), "default")
+            self.assertEqual(router.db_for_read(City), "default")
+        self.assertFalse(router.allow_migrate("replica", "MainApplication"))
+
+
+class IngestScoresTests(CacheResetTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.root = Path(self.tmp.name)
+
+    def write(self, name, rows):
+        path = self.root / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w", newline="", encoding="utf-8-sig") as f:
+            csv.writer(f).writerows(rows)
+        return path
+
+    def ingest(self, *args):
+        out = StringIO()
+        call_command("ingest_scores", str(self.root), "--update", "--date-from-path", *args, stdout=out)
+        return out.getvalue()
+
+    def current_scores(self):
+        return dict(
+            ((city, field), score)
+            for city, field, score in CityFieldScore.objects.values_list("city__name", "field__name", "score")
+        )
+
+    def test_months_are_ingested_in_order_and_skipped_on_rerun(self):
+        self.write("2024-01/scores.csv", [["", "تهران", "قم"], ["میزان شادی", "30", "50"]])
+        self.write("2024-02/scores.csv", [["", "تهران"], ["میزان شادی", "80"]])
+        self.write("2024-02/notes.txt", [["not a score file"]])
+
+        output = self.ingest("--jobs", "2")
+
+        self.assertIn("Ingested 2 files, skipped 0", output)
+        self.assertEqual(self.current_scores(), {("تهران", "میزان شادی"): 80, ("قم", "میزان شادی"): 50})
+        january = timezone.make_aware(datetime.datetime(2024, 1, 31))
+        self.assertEqual(sorted(get_scores_as_of(january).values()), [30, 50])
+        ingested = IngestedFile.objects.get(path__contains="2024-01")
+        self.assertEqual(timezone.localtime(ingested.effective_at).date(), datetime.date(2024, 1, 1))
+
+        history = CityFieldScoreHistory.objects.count()
+        self.assertIn("Ingested 0 files, skipped 2", self.ingest())
+        self.assertEqual(CityFieldScoreHistory.objects.count(), history)
+
+        # Changed content is a new file to the manifest
+        self.write("2024-02/scores.csv", [["", "تهران"], ["میزان شادی", "90"]])
+        self.assertIn("Ingested 1 files, skipped 1", self.ingest("--jobs", "1"))
+        self.assertEqual(self.current_scores()[("تهران", "میزان شادی")], 90)
+
+    def test_a_failed_run_resumes_after_the_last_ingested_file(self):
+        self.write("2024-01/a.csv", [["", "تهران"], ["میزان شادی", "30"]])
+        broken = self.root / "2024-02" / "b.xlsx"
+        broken.parent.mkdir()
+        broken.write_bytes(b"not a workbook")
+        self.write("2024-03/c.csv", [["", "قم"], ["میزان شادی", "70"]])
+
+        # The run stops at the broken file: March must not be applied before February
+        with self.assertRaises(CommandError):
+            self.ingest("--jobs", "2")
+        self.assertEqual(IngestedFile.objects.count(), 1)
+
+        broken.unlink()
+        self.write("2024-02/b.csv", [["", "تهران"], ["میزان شادی", "40"]])
+        output = self.ingest("--jobs", "2")
+        self.assertIn("Ingested 2 files, skipped 1", output)
+        self.assertEqual(self.current_scores(), {("تهران", "میزان شادی"): 40, ("قم", "میزان شادی"): 70})
+
+    def test_a_month_reverting_to_an_earlier_months_content_is_ingested(self):
+        self.write("2024-01/scores.csv", [["", "تهران"], ["میزان شادی", "40"]])
+        self.write("2024-02/scores.csv", [["", "تهران"], ["میزان شادی", "90"]])
+        self.assertIn("Ingested 2 files", self.ingest())
+
+        # March has January's bytes but is a different file
+        self.write("2024-03/scores.csv", [["", "تهران"], ["میزان شادی", "40"]])
+        self.assertIn("Ingested 1 files, skipped 2", self.ingest())
+        self.assertEqual(self.current_scores(), {("تهران", "میزان شادی"): 40})
+        self.assertEqual(IngestedFile.objects.count(), 3)
+        self.assertIn("Ingested 0 files, skipped 3", self.ingest())
+
+
+class SampleMakerTests(CacheResetTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.root = Path(self.tmp.name)
+
+    def make(self, *args):
+        out = StringIO()
+        call_command("sample_maker", "--output-dir", str(self.root), *args, stdout=out)
+        return out.getvalue()
+
+    def test_scores_are_in_range_correlated_and_reproducible(self):
+        generator = SampleGenerator(1500, 8, periods=2, seed=7, missing=0.2)
+        january, february = generator
+        self.assertEqual(january.shape, (1500, 8))
+        self.assertEqual(january.dtype, np.uint8)
+        present = january > 0
+        self.assertTrue((january[present] <= 100).all())
+        self.assertAlmostEqual(1 - present.mean(), 0.2, delta=0.02)
+
+        # Fields share factors, and a month follows the previous one
+        full = SampleGenerator(1500, 8, periods=2, seed=7)
+        correlations = np.corrcoef(full.month(0).T.astype(float))
+        self.assertGreater(np.abs(correlations[np.triu_indices(8, 1)]).max(), 0.3)
+        self.assertGreater(np.corrcoef(full.month(0)[:, 0].astype(float), full.month(1)[:, 0].astype(float))[0, 1], 0.5)
+
+        self.assertTrue((SampleGenerator(1500, 8, periods=2, seed=7, missing=0.2).month(1) == february).all())
+        self.assertFalse((SampleGenerator(1500, 8, periods=2, seed=8, missing=0.2).month(1) == february).all())
+
+    def test_monthly_files_round_trip_through_ingest_scores(self):
+        output = self.make("--cities", "40", "--fields", "5", "--periods", "2", "--end", "2024-02", "--seed", "3",
+                           "--format", "csv", "--format", "json")
+        self.assertIn("400 cells (40 cities x 5 fields x 2 months)", output)
+        first = (self.root / "2024-02" / "sample.csv").read_bytes()
+        self.make("--cities", "40", "--fields", "5", "--periods", "2", "--end", "2024-02", "--seed", "3",
+                  "--format", "csv")
+        self.assertEqual((self.root / "2024-02" / "sample.csv").read_bytes(), first)
+        columnar = json.loads((self.root / "2024-01" / "sample.json").read_text(encoding="utf-8"))
+        self.assertEqual(columnar["cities"][0], "آذربایجان شرقی")
+        self.assertEqual(len(columnar["scores"]), 40)
+
+        for path in self.root.glob("*/sample.json"):
+            path.unlink()
+        call_command("ingest_scores", str(self.root), "--update", "--date-from-path", "--jobs", "1", stdout=StringIO())
+        february = SampleGenerator(40, 5, periods=2, seed=3).month(1)
+        self.assertEqual(CityFieldScore.objects.count(), 200)
+        self.assertEqual(sorted(CityFieldScore.objects.values_list("score", flat=True)), sorted(february.ravel().tolist()))
+
+    def test_to_db_loads_every_month_into_the_history(self):
+        make_city("تهران", {"میزان شادی": 1})
+        output = self.make("--cities", "120", "--fields", "4", "--periods", "3", "--end", "2024-03", "--seed", "5",
+                           "--to-db")
+        self.assertIn("Loaded 1440 scores over 3 months (119 cities and 3 field types created)", output)
+        self.assertEqual(CityFieldScoreHistory.objects.filter(effective_at__year=2024).count(), 1440)
+        generator = SampleGenerator(120, 4, periods=3, seed=5)
+        march = generator.month(2)
+        tehran = City.objects.get(name="تهران")
+        happiness = FieldType.objects.get(name="میزان شادی")
+        # Today's score is newer than the sample and stays current; the sample only adds history
+        self.assertEqual(CityFieldScore.objects.get(city=tehran, field=happiness).score, 1)
+        self.assertEqual(
+            CityFieldScoreHistory.objects.get(city=tehran, field=happiness, effective_at__year=2024, effective_at__month=3).score,
+            march[7, 0],
+        )
+        january = timezone.make_aware(datetime.datetime(2024, 1, 31))
+        self.assertEqual(sorted(get_scores_as_of(january).values()), sorted(generator.month(0).ravel().tolist()))
+        # More root cities than SUBTREE_PREFIX_LIMIT: summaries are rebuilt by root segment
+        self.assertAlmostEqual(tehran.summary.avg_score, (1 + march[7, 1:].sum()) / 4, places=1)
+        self.assertEqual(CityScoreSummary.objects.filter(score_count=4).count(), 120)
+        self.assertFalse(list(self.root.iterdir()))
+
+    def test_to_db_removes_current_scores_the_last_month_leaves_empty(self):
+        generator = SampleGenerator(30, 3, periods=2, seed=2, missing=0.3)
+        february = generator.month(1)
+        row, column = (index[0] for index in np.nonzero(february == 0))
+        city_name, field_name = sample_city_names(30)[row], sample_field_names(3)[column]
+        with self.committed():
+            writer = ScoreWriter(update=True, effective_at=timezone.make_aware(datetime.datetime(2023, 6, 1)))
+            writer.add(city_name, field_name, 99)
+            writer.close()
+
+        self.make("--cities", "30", "--fields", "3", "--periods", "2", "--end", "2024-02", "--seed", "2",
+                  "--missing", "0.3", "--to-db")
+        self.assertFalse(CityFieldScore.objects.filter(city__name=city_name, field__name=field_name).exists())
+        removal = CityFieldScoreHistory.objects.filter(city__name=city_name, field__name=field_name).latest("effective_at")
+        self.assertEqual((removal.score, timezone.localdate(removal.effective_at)), (None, datetime.date(2024, 2, 1)))
+        self.assertEqual(CityFieldScore.objects.count(), np.count_nonzero(february))
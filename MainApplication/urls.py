@@ -1,12 +1,35 @@
 from django.urls import path
-from . import views
+from . import api, views
 from django.views.static import serve
 from django.conf import settings
 from django.conf.urls.static import static
 
 app_name = "Authenticate"
 
-urlpatterns = [
-    path("", views.main, name="Main"),
-    path("city/<slug:slug>/", views.city_detail, name="city_detail"),
-]
\ No newline at end of file
+
+def build_urlpatterns(async_views=False):
+    # ASYNC_VIEWS serves the map pages with the async ORM (for ASGI deployments)
+    main_view, city_detail_view = (views.amain, views.acity_detail) if async_views else (views.main, views.city_detail)
+    return [
+        path("", main_view, name="Main"),
+        path("city/<slug:slug>/", city_detail_view, name="city_detail"),
+        path("map.svg", views.map_svg, name="map_svg"),
+        path("api/v1/map/", api.map_data, name="api_map"),
+        path("api/v1/city/<slug:slug>/", api.city_data, name="api_city"),
+        path("api/v1/city/<slug:slug>/context/", api.city_context, name="api_city_context"),
+        path("api/v1/rankings/", api.field_rankings, name="api_rankings"),
+        path("api/v1/profiles/", api.scoring_profiles, name="api_profiles"),
+        path("api/v1/scores/", api.weighted_scores, name="api_scores"),
+        path("api/v1/city/<slug:slug>/units/", api.city_units, name="api_city_units"),
+        path("api/v1/units/<int:pk>/", api.unit_subtree, name="api_units"),
+        path("api/v1/city/<slug:slug>/similar/", api.similar_cities, name="api_city_similar"),
+        path("api/v1/correlations/", api.field_correlations, name="api_correlations"),
+        path("api/v1/clusters/", api.city_clusters, name="api_clusters"),
+        path("api/v1/export/scores.<str:export_format>", api.export_scores, name="api_export"),
+        path("api/v1/chat/text/", api.chat_text, name="api_chat_text"),
+        path("api/v1/chat/voice/", api.chat_voice, name="api_chat_voice"),
+        path("metrics", views.metrics, name="metrics"),
+    ]
+
+
+urlpatterns = build_urlpatterns(getattr(settings, "ASYNC_VIEWS", False))
@@ -1,141 +1,258 @@
+import datetime
+import functools
+import gzip
+import hashlib
 import json
+from urllib.parse import urlencode
 
-from django.http import Http404
-from django.shortcuts import get_object_or_404, render
-from django.urls import reverse
-
-from .models import City, CityFieldScore, FieldType, get_city_average_score
-
-CITY_NAME_TO_SLUG = {
-    "آذربایجان شرقی": "azerbaijan-east",
-    "آذربایجان غربی": "azerbaijan-west",
-    "اردبیل": "ardabil",
-    "اصفهان": "isfahan",
-    "البرز": "alborz",
-    "ایلام": "ilam",
-    "بوشهر": "bushehr",
-    "تهران": "tehran",
-    "چهارمحال بختیاری": "chahar-mahaal-bakhtiari",
-    "خراسان جنوبی": "khorasan-south",
-    "خراسان رضوی": "khorasan-razavi",
-    "خراسان شمالی": "khorasan-north",
-    "خوزستان": "khuzestan",
-    "زنجان": "zanjan",
-    "سمنان": "semnan",
-    "سیستان و بلوچستان": "sistan-baluchestan",
-    "فارس": "fars",
-    "قزوین": "qazvin",
-    "قم": "qom",
-    "کردستان": "kurdistan",
-    "کرمان": "kerman",
-    "کرمانشاه": "kermanshah",
-    "کهگیلویه و بویر احمد": "kohgiluyeh-boyer-ahmad",
-    "گلستان": "golestan",
-    "گیلان": "gilan",
-    "لرستان": "lorestan",
-    "مازندران": "mazandaran",
-    "مرکزی": "markazi",
-    "هرمزگان": "hormozgan",
-    "همدان": "hamadan",
-    "یزد": "yazd",
-    # جزایر – only include if you also have them as City objects
-    "ابو موسی": "abu-musa",
-    "قشم": "qeshm",
-    "فرور بزرگ": "faror-big",
-    "فرور کوچک": "faror-small",
-    "هندروابی": "hendorabi",
-    "هنگام": "hengam",
-    "هرمز": "hormoz",
-    "خارک": "khark",
-    "کیش": "kish",
-    "لارک": "lark",
-    "لاوان": "lavan",
-    "سیری": "siri",
-    "تنب بزرگ": "tunb-big",
-    "تنب کوچک": "tunb-small",
-}
-
-SLUG_TO_CITY_NAME = {slug: name for name, slug in CITY_NAME_TO_SLUG.items()}
-
-
-def _get_color_for_score(avg_score: float) -> str:
+from asgiref.sync import sync_to_async
+
+from django.conf import settings
+from django.core.exceptions import BadRequest
+from django.http import Http404, HttpResponse
+from django.shortcuts import aget_object_or_404, get_object_or_404, render
+from django.template.loader import render_to_string
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.crypto import constant_time_compare
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils.safestring import mark_safe
+from django.views.decorators.csrf import ensure_csrf_cookie
+
+from . import geometry
+from .caching import cache_by_scores_version
+from .metrics import registry
+from .models import City, CityFieldScore, FieldType, get_color_for_score, get_scores_as_of, path_ids
+
+MAP_SVG_MAX_AGE = 60 * 60 * 24
+
+
+def parse_as_of(value):
+    """
+    Parse an ``as_of`` value into an aware datetime; a bare date (``YYYY-MM-DD``)
+    means the end of that day. Raises ValueError for anything else.
     """
-    Return a hex color based on the average score.
+    try:
+        # Dates first: parse_datetime() also accepts a bare date, as midnight
+        day = parse_date(value)
+        moment = datetime.datetime.combine(day, datetime.time.max) if day else parse_datetime(value)
+    except ValueError:
+        moment = None
+    if moment is None:
+        raise ValueError(f"Invalid as_of date: {value}")
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
+
 
-    90 - 100 => green
-    70 - 89.99 => light green
-    50 - 69.99 => yellow
-    20 - 49.99 => orange
-    0  - 19.99 => red
+def get_as_of(request):
+    """Parse ``?as_of=`` (see parse_as_of), or None for the current scores."""
+    value = request.GET.get("as_of")
+    if not value:
+        return None
+    try:
+        return parse_as_of(value)
+    except ValueError:
+        raise BadRequest("Invalid as_of date")
+
+
+def get_average_scores_as_of(as_of, city_id=None, rollup=False):
     """
-    if avg_score >= 90:
-        return "#008000"  # green
-    if avg_score >= 70:
-        return "#66bb6a"  # light green
-    if avg_score >= 50:
-        return "#ffeb3b"  # yellow
-    if avg_score >= 20:
-        return "#ff9800"  # orange
-    return "#f44336"      # red
+    Return ``{city_id: average}`` computed from the scores valid at ``as_of``;
+    with ``rollup``, every score also counts for all ancestors of its city.
+    """
+    # Only sub-units have ancestors; top-level cities add to themselves
+    paths = dict(City.objects.filter(depth__gt=0).values_list("id", "path")) if rollup else {}
+    totals = {}
+    for (score_city_id, _), score in get_scores_as_of(as_of, city_id=city_id).items():
+        path = paths.get(score_city_id)
+        for total_city_id in path_ids(path) if path else [score_city_id]:
+            score_sum, score_count = totals.get(total_city_id, (0, 0))
+            totals[total_city_id] = (score_sum + score, score_count + 1)
+    return {score_city_id: score_sum / score_count for score_city_id, (score_sum, score_count) in totals.items()}
 
 
-def main(request):
-    city_data = {}
-    city_colors_by_slug = {}
+def map_entry(city, averages=None):
+    """Slug, name, rounded average and color of one map city (``averages`` from get_average_scores_as_of)."""
+    if averages is not None:
+        avg = round(averages.get(city.id, 0), 2)
+        color = get_color_for_score(avg)
+    else:
+        # Precomputed by CityScoreSummary, rolled up over the city's sub-units; cities without
+        # scores have no summary yet
+        summary = getattr(city, "summary", None)
+        avg = round(summary.rollup_avg, 2) if summary else 0
+        color = summary.rollup_color if summary else get_color_for_score(0)
+    return {"slug": city.slug, "name": city.name, "avg": avg, "color": color}
 
-    for city in City.objects.all():
-        slug = CITY_NAME_TO_SLUG.get(city.name)
-        if not slug:
-            continue
 
-        key = slug.replace("-", "_")
+def map_cities():
+    # Cities without a map slug (unknown names from imports) have no region to color
+    return City.objects.filter(slug__isnull=False).select_related("summary").order_by("id")
 
-        avg = get_city_average_score(city.id) or 0
-        avg_rounded = round(avg, 2)
-        color = _get_color_for_score(avg_rounded)
 
-        city_data[key] = {
-            "name": city.name,
-            "avg": avg_rounded,
-            "color": color,
-            "detail_url": reverse("Authenticate:city_detail", args=[slug]),
-        }
+def get_map_data(as_of=None):
+    """Return slug, name, rounded average and color for every city shown on the map."""
+    averages = get_average_scores_as_of(as_of, rollup=True) if as_of is not None else None
+    return [map_entry(city, averages) for city in map_cities()]
 
-        city_colors_by_slug[slug] = color
 
-    return render(
-        request,
-        "MainApplication/iranmap.html",
-        {
-            "city_data": city_data,
-            "city_colors_by_slug": city_colors_by_slug,
-        },
-    )
+async def aget_map_data(as_of=None):
+    """Async get_map_data()."""
+    averages = await sync_to_async(get_average_scores_as_of)(as_of, rollup=True) if as_of is not None else None
+    return [map_entry(city, averages) async for city in map_cities()]
 
 
-def city_detail(request, slug: str):
-    city_name = SLUG_TO_CITY_NAME.get(slug)
-    if not city_name:
-        raise Http404("City not found")
+def field_scores(field_types, scores_by_field_id):
+    return [{"name": field.name, "score": scores_by_field_id.get(field.id, 0)} for field in field_types]
+
 
-    city = get_object_or_404(City, name=city_name)
+def get_city_field_data(slug: str, as_of=None):
+    """Return the city, all field types and the city's score per field (0 when missing)."""
+    city = get_object_or_404(City.objects.select_related("summary"), slug=slug)
     field_types = list(FieldType.objects.all().order_by("name"))
-    scores_by_field_id = {
-        score.field_id: score.score
-        for score in CityFieldScore.objects.filter(city=city).select_related("field")
+    if as_of is not None:
+        scores_by_field_id = {
+            field_id: score for (_, field_id), score in get_scores_as_of(as_of, city_id=city.id).items()
+        }
+    else:
+        scores_by_field_id = dict(
+            CityFieldScore.objects.filter(city=city).values_list("field_id", "score")
+        )
+    return city, field_types, field_scores(field_types, scores_by_field_id)
+
+
+async def aget_city_field_data(slug: str, as_of=None):
+    """
+    Async get_city_field_data(). The async ORM runs each query on the one
+    thread that sync_to_async() reserves for database work, so the queries run
+    one after another; the event loop serves other requests while they do.
+    """
+    city = await aget_object_or_404(City.objects.select_related("summary"), slug=slug)
+    field_types = [field_type async for field_type in FieldType.objects.all().order_by("name")]
+    if as_of is not None:
+        scores_as_of = await sync_to_async(get_scores_as_of)(as_of, city_id=city.id)
+        scores_by_field_id = {field_id: score for (_, field_id), score in scores_as_of.items()}
+    else:
+        scores_by_field_id = {
+            field_id: score
+            async for field_id, score in CityFieldScore.objects.filter(city=city).values_list("field_id", "score")
+        }
+    return city, field_types, field_scores(field_types, scores_by_field_id)
+
+
+def get_lod(request):
+    """Return the map level of detail from ``?lod=``, defaulting to settings.MAP_LOD."""
+    lod = request.GET.get("lod") or getattr(settings, "MAP_LOD", "medium")
+    if lod not in geometry.LODS:
+        raise BadRequest(f"Invalid lod; expected one of {', '.join(geometry.LODS)}")
+    return lod
+
+
+@functools.cache
+def get_map_shell(lod):
+    """
+    Render the static SVG map and province list once per process and level of detail.
+
+    The shell has no per-request data; main() only adds a small JSON block that
+    iranmap.html applies to it client-side. The outlines are most of its size:
+    ~170 KB at "full", ~30 KB at the default "medium" (MainApplication/geometry.py).
+    """
+    context = {"layers": geometry.map_layers(lod), "view_box": geometry.view_box()}
+    return mark_safe(render_to_string("MainApplication/iranmap_shell.html", context))
+
+
+@functools.cache
+def get_map_svg(lod):
+    """The standalone map SVG at ``lod`` as ``(body, gzipped body, etag)``, built once per process."""
+    context = {"layers": geometry.map_layers(lod), "view_box": geometry.view_box()}
+    body = render_to_string("MainApplication/map.svg", context).encode("utf-8")
+    return body, gzip.compress(body, mtime=0), f'"{hashlib.md5(body).hexdigest()}"'
+
+
+def map_context(request, as_of, cities):
+    cities = {item["slug"]: {"name": item["name"], "avg": item["avg"], "color": item["color"]} for item in cities}
+    # Keep following links on the same date
+    detail_query = "?" + urlencode({"as_of": request.GET["as_of"]}) if as_of else ""
+    return {
+        "map_shell": get_map_shell(get_lod(request)),
+        "map_data": {"cities": cities, "query": detail_query},
+    }
+
+
+def city_detail_context(slug, city, field_types, field_data):
+    return {
+        "city_name": city.name,
+        "city_slug": slug,
+        "fields": field_types,
+        "field_data_json": json.dumps(field_data, ensure_ascii=False),
     }
-    field_data = [
-        {"name": field.name, "score": scores_by_field_id.get(field.id, 0)}
-        for field in field_types
-    ]
-
-    return render(
-        request,
-        "MainApplication/city_detail.html",
-        {
-            "city_name": city_name,
-            "city_slug": slug,
-            "fields": field_types,
-            "field_data_json": json.dumps(field_data, ensure_ascii=False),
-        },
-    )
+
+
+# The pages are cached, so the chat's CSRF token travels in the cookie, set on hits too, not in the HTML
+@ensure_csrf_cookie
+@cache_by_scores_version(query_params=("as_of", "lod"))
+def main(request):
+    as_of = get_as_of(request)
+    return render(request, "MainApplication/iranmap.html", map_context(request, as_of, get_map_data(as_of)))
+
+
+@ensure_csrf_cookie
+@cache_by_scores_version(query_params=("as_of",))
+def city_detail(request, slug: str):
+    context = city_detail_context(slug, *get_city_field_data(slug, get_as_of(request)))
+    return render(request, "MainApplication/city_detail.html", context)
+
+
+# Async versions of the pages, routed instead of main/city_detail when ASYNC_VIEWS is set
+# (ASGI deployments): a worker keeps serving other requests while these wait on the database.
+@ensure_csrf_cookie
+@cache_by_scores_version(query_params=("as_of", "lod"))
+async def amain(request):
+    as_of = get_as_of(request)
+    return render(request, "MainApplication/iranmap.html", map_context(request, as_of, await aget_map_data(as_of)))
+
+
+@ensure_csrf_cookie
+@cache_by_scores_version(query_params=("as_of",))
+async def acity_detail(request, slug: str):
+    context = city_detail_context(slug, *await aget_city_field_data(slug, get_as_of(request)))
+    return render(request, "MainApplication/city_detail.html", context)
+
+
+def map_svg(request):
+    """
+    The map outlines alone as an SVG file at ``?lod=``, for thumbnails and embeds.
+
+    The body only changes with the geometry files, so it is served with a
+    content ETag and cached by browsers and proxies for MAP_SVG_MAX_AGE.
+    """
+    body, compressed, etag = get_map_svg(get_lod(request))
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        if "gzip" in request.headers.get("Accept-Encoding", ""):
+            response = HttpResponse(compressed, content_type="image/svg+xml")
+            response["Content-Encoding"] = "gzip"
+        else:
+            response = HttpResponse(body, content_type="image/svg+xml")
+    response["ETag"] = etag
+    patch_cache_control(response, public=True, max_age=MAP_SVG_MAX_AGE)
+    patch_vary_headers(response, ("Accept-Encoding",))
+    return response
+
+
+def metrics(request):
+    """
+    Per-view request metrics in Prometheus text format (see MainApplication/middleware.py),
+    for a bearer of PERFORMANCE_METRICS_TOKEN, or for staff users when no token is set.
+    """
+    if not getattr(settings, "PERFORMANCE_METRICS", False):
+        raise Http404
+    token = getattr(settings, "PERFORMANCE_METRICS_TOKEN", "")
+    if token:
+        allowed = constant_time_compare(request.headers.get("Authorization", ""), f"Bearer {token}")
+    else:
+        allowed = request.user.is_staff
+    if not allowed:
+        return HttpResponse(status=403)
+    return HttpResponse(registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8")